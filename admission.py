@@ -0,0 +1,172 @@
+"""
+Admission control for the mail servers.
+
+Admission bounds the number of concurrent sessions and the rate at which a
+client address may open connections. A connection arriving while every
+session slot is taken waits up to 'queue_timeout' seconds for one; after that,
+or straight away when its address is over its connection rate or
+'max_queued' connections are waiting already, it is sent 'busy_message' and
+closed. RateLimiter is the per-address token bucket, also
+used by the SMTP server to limit messages.
+"""
+import asyncio
+import threading
+import time
+
+MAX_SESSIONS = 10000
+QUEUE_TIMEOUT = 5.0
+# Connections waiting for a session slot; each holds a thread in threaded mode
+MAX_QUEUED = 1000
+# Connections per second and burst allowed from one client address
+CONNECTION_RATE = 20.0
+CONNECTION_BURST = 50
+# Messages per second and burst accepted from one client address (SMTP)
+MESSAGE_RATE = 5.0
+MESSAGE_BURST = 50
+# Seconds a started command or message transfer may stall
+COMMAND_TIMEOUT = 60.0
+# Buckets kept before full (idle) ones are dropped
+MAX_TRACKED_CLIENTS = 100000
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def take(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class RateLimiter:
+    """
+    One token bucket per key; a rate of 0 disables the limit.
+    """
+    def __init__(self, rate, burst, max_keys=MAX_TRACKED_CLIENTS):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def allow(self, key):
+        if not self.rate:
+            return True
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                if len(self.buckets) >= self.max_keys:
+                    self._prune(now)
+                bucket = self.buckets[key] = TokenBucket(self.rate, self.burst)
+            return bucket.take(now)
+
+    def _prune(self, now):
+        # A bucket that has refilled completely holds no state worth keeping.
+        full = [key for key, bucket in self.buckets.items()
+                if bucket.tokens + (now - bucket.stamp) * bucket.rate >= bucket.burst]
+        for key in full:
+            del self.buckets[key]
+
+
+class Admission:
+    def __init__(self, busy_message, max_sessions=MAX_SESSIONS, queue_timeout=QUEUE_TIMEOUT,
+                 connection_rate=CONNECTION_RATE, connection_burst=CONNECTION_BURST, max_queued=MAX_QUEUED):
+        self.busy_message = busy_message
+        self.max_sessions = max_sessions
+        self.queue_timeout = queue_timeout
+        self.max_queued = max_queued
+        self.connections = RateLimiter(connection_rate, connection_burst)
+        self.slots = threading.BoundedSemaphore(max_sessions)
+        self.async_slots = None
+        self.queued = 0  # connections waiting for a slot
+        self.lock = threading.Lock()
+
+    def allow(self, address):
+        """
+        Check a new connection against the rate of its client address and
+        the number of connections waiting, without waiting. Returns False
+        when the client must be turned away.
+        """
+        if not self.connections.allow(address):
+            print(f"Connection rate exceeded by {address}")
+            return False
+        if self.queued >= self.max_queued:
+            print(f"Session queue full, rejecting {address}")
+            return False
+        return True
+
+    def acquire(self, address):
+        """
+        Take a session slot for an allowed client, waiting for one if needed
+        and fewer than 'max_queued' others wait. Returns False when the
+        client must be turned away.
+        """
+        if self.slots.acquire(blocking=False):
+            return True
+        with self.lock:
+            if self.queued >= self.max_queued:
+                print(f"Session queue full, rejecting {address}")
+                return False
+            self.queued += 1
+        try:
+            acquired = self.slots.acquire(timeout=self.queue_timeout)
+        finally:
+            with self.lock:
+                self.queued -= 1
+        if not acquired:
+            print(f"Session limit reached, rejecting {address}")
+        return acquired
+
+    def release(self):
+        self.slots.release()
+
+    async def admit_async(self, address):
+        if self.async_slots is None:
+            self.async_slots = asyncio.BoundedSemaphore(self.max_sessions)
+        if not self.allow(address):
+            return False
+        if not self.async_slots.locked():
+            await self.async_slots.acquire()
+            return True
+        self.queued += 1
+        try:
+            await asyncio.wait_for(self.async_slots.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            print(f"Session limit reached, rejecting {address}")
+            return False
+        finally:
+            self.queued -= 1
+        return True
+
+    def release_async(self):
+        self.async_slots.release()
+
+
+def add_arguments(parser, idle_timeout):
+    """
+    Add the admission and timeout options shared by both servers.
+    """
+    parser.add_argument('--max-sessions', type=int, default=MAX_SESSIONS,
+                        help='Concurrent sessions per process before new connections queue')
+    parser.add_argument('--queue-timeout', type=float, default=QUEUE_TIMEOUT,
+                        help='Seconds a connection waits for a free session before it is rejected')
+    parser.add_argument('--max-queued', type=int, default=MAX_QUEUED,
+                        help='Connections waiting for a free session before new ones are rejected at once')
+    parser.add_argument('--connection-rate', type=float, default=CONNECTION_RATE,
+                        help='Connections per second allowed from one client address (0 disables)')
+    parser.add_argument('--idle-timeout', type=float, default=idle_timeout,
+                        help='Seconds a session may wait for its next command')
+    parser.add_argument('--command-timeout', type=float, default=COMMAND_TIMEOUT,
+                        help='Seconds a started command or message transfer may stall')
+
+def from_arguments(args, busy_message):
+    return Admission(busy_message, args.max_sessions, args.queue_timeout, args.connection_rate, CONNECTION_BURST,
+                     args.max_queued)
@@ -0,0 +1,369 @@
+"""
+Load and latency benchmark for the SMTP and POP3 servers.
+
+Starts mailserver_smtp.py and pop_server.py in a scratch directory holding a
+set of generated accounts, then drives concurrent synthetic sessions from one
+asyncio event loop:
+
+  smtp  HELO, MAIL FROM, RCPT TO per recipient, DATA, the message, QUIT
+  pop   USER, PASS, LIST, RETR and DELE of the first messages, QUIT
+
+The POP3 phase runs after the SMTP phase and reads the mail it delivered.
+Throughput and p50/p99/p999 latency per command are printed and saved as
+JSON; passing an earlier result file with --baseline reports how the p99
+latencies moved and fails when one got worse than --tolerance allows.
+
+  python bench.py --sessions 5000 --concurrency 1000 --mode asyncio --output after.json --baseline before.json
+"""
+import argparse
+import asyncio
+import collections
+import datetime
+import json
+import math
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import serving
+
+HOST = "127.0.0.1"
+DOMAIN = "email.com"
+# Seconds the servers get to start listening
+STARTUP_TIMEOUT = 10.0
+PERCENTILES = (("p50", 0.50), ("p99", 0.99), ("p999", 0.999))
+LINE_LENGTH = 76
+
+SERVER_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class BenchError(Exception):
+    pass
+
+
+class Recorder:
+    """
+    Latencies per command and error counts of one benchmark phase.
+    """
+    def __init__(self):
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.Counter()
+        self.sessions = 0
+        self.messages = 0
+        self.bytes = 0
+
+    def record(self, command, seconds):
+        self.latencies[command].append(seconds)
+
+    def summary(self, elapsed):
+        commands = {}
+        for command, samples in self.latencies.items():
+            samples.sort()
+            stats = {"count": len(samples),
+                     "mean_ms": round(1000 * sum(samples) / len(samples), 3),
+                     "max_ms": round(1000 * samples[-1], 3)}
+            for name, fraction in PERCENTILES:
+                # Nearest-rank percentile
+                rank = max(math.ceil(fraction * len(samples)), 1)
+                stats[name + "_ms"] = round(1000 * samples[rank - 1], 3)
+            commands[command] = stats
+        return {"sessions": self.sessions,
+                "errors": dict(self.errors),
+                "elapsed_s": round(elapsed, 3),
+                "sessions_per_s": round(self.sessions / elapsed, 1) if elapsed else 0.0,
+                "messages_per_s": round(self.messages / elapsed, 1) if elapsed else 0.0,
+                "bytes_per_s": round(self.bytes / elapsed) if elapsed else 0,
+                "commands": commands}
+
+
+# ---------------------------
+# Synthetic sessions
+# ---------------------------
+def make_message(sender, recipients, size):
+    """
+    Build a message of about 'size' body bytes, without blank lines since the
+    mailbox format uses those to separate messages.
+    """
+    received = datetime.datetime.now().strftime("%m/%d/%Y : %H : %M")
+    headers = (f"From: {sender}\r\nTo: {', '.join(recipients)}\r\n"
+               f"Subject: bench {size} bytes\r\nReceived: {received}\r\n")
+    line = (b"benchmark " * (LINE_LENGTH // 10 + 1))[:LINE_LENGTH - 2] + b"\r\n"
+    count, rest = divmod(size, LINE_LENGTH)
+    body = line * count + (line[-rest:] if rest > 2 else b"")
+    return headers.encode() + body
+
+
+async def timed(recorder, command, action):
+    start = time.perf_counter()
+    result = await action
+    recorder.record(command, time.perf_counter() - start)
+    return result
+
+
+async def smtp_command(reader, writer, recorder, command, data):
+    async def exchange():
+        writer.write(data)
+        # Replies carry no line terminator; each arrives in one read.
+        return await reader.read(4096)
+    reply = await timed(recorder, command, exchange())
+    if not reply or reply[:1] in b"45":
+        raise BenchError(f"{command}: {reply[:80]!r}")
+    return reply
+
+
+async def smtp_session(port, sender, recipients, message, recorder):
+    reader, writer = await timed(recorder, "CONNECT", asyncio.open_connection(HOST, port))
+    try:
+        await smtp_command(reader, writer, recorder, "HELO", b"HELO\r\n")
+        await smtp_command(reader, writer, recorder, "MAIL", f"MAIL FROM: <{sender}>\r\n".encode())
+        for rcpt in recipients:
+            await smtp_command(reader, writer, recorder, "RCPT", f"RCPT TO: <{rcpt}>\r\n".encode())
+        await smtp_command(reader, writer, recorder, "DATA", b"DATA\r\n")
+        await smtp_command(reader, writer, recorder, "MESSAGE", message + b".\r\n")
+        await smtp_command(reader, writer, recorder, "QUIT", b"QUIT\r\n")
+    finally:
+        writer.close()
+    recorder.messages += 1
+    recorder.bytes += len(message)
+
+
+async def pop_command(reader, writer, recorder, command, data, multiline=False):
+    async def exchange():
+        writer.write(data)
+        reply = b""
+        while True:
+            chunk = await reader.read(64 * 1024)
+            if not chunk:
+                raise BenchError(f"{command}: connection closed")
+            reply += chunk
+            if reply.startswith(b"-ERR") or not multiline:
+                if reply.endswith(b"\n"):
+                    return reply
+            elif reply.endswith(b"\n.\n") or reply.endswith(b"\r\n.\r\n"):
+                return reply
+    reply = await timed(recorder, command, exchange())
+    if not reply.startswith(b"+OK"):
+        raise BenchError(f"{command}: {reply[:80]!r}")
+    return reply
+
+
+async def pop_session(port, user, password, retrieve, recorder):
+    reader, writer = await timed(recorder, "CONNECT", asyncio.open_connection(HOST, port))
+    try:
+        greeting = await reader.readline()
+        if not greeting.startswith(b"+OK"):
+            raise BenchError(f"greeting: {greeting[:80]!r}")
+        await pop_command(reader, writer, recorder, "USER", f"USER {user}\r\n".encode())
+        await pop_command(reader, writer, recorder, "PASS", f"PASS {password}\r\n".encode())
+        listing = await pop_command(reader, writer, recorder, "LIST", b"LIST\r\n", multiline=True)
+        available = int(listing.split()[1])
+        for number in range(1, min(available, retrieve) + 1):
+            message = await pop_command(reader, writer, recorder, "RETR", f"RETR {number}\r\n".encode(), multiline=True)
+            await pop_command(reader, writer, recorder, "DELE", f"DELE {number}\r\n".encode())
+            recorder.messages += 1
+            recorder.bytes += len(message)
+        await pop_command(reader, writer, recorder, "QUIT", b"QUIT\r\n")
+    finally:
+        writer.close()
+
+
+async def run_phase(sessions, concurrency, recorder):
+    """
+    Run the session coroutines with at most 'concurrency' open at once.
+    Returns the elapsed wall-clock time.
+    """
+    slots = asyncio.Semaphore(concurrency)
+
+    async def limited(session):
+        async with slots:
+            try:
+                await session
+                recorder.sessions += 1
+            except BenchError as e:
+                # Counted per failing command
+                recorder.errors[str(e).split(":")[0]] += 1
+            except (OSError, ValueError, IndexError) as e:
+                recorder.errors[type(e).__name__] += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(limited(session) for session in sessions))
+    return time.perf_counter() - start
+
+
+async def run_benchmark(args, smtp_port, pop_port):
+    results = {}
+    users = [f"bench{i}" for i in range(args.users)]
+
+    if args.sessions:
+        recorder = Recorder()
+        sessions = []
+        for i in range(args.sessions):
+            recipients = [f"{users[(i + k) % len(users)]}@{DOMAIN}" for k in range(args.recipients)]
+            message = make_message(f"sender{i}@example.com", recipients, args.message_size)
+            sessions.append(smtp_session(smtp_port, f"sender{i}@example.com", recipients, message, recorder))
+        elapsed = await run_phase(sessions, args.concurrency, recorder)
+        results["smtp"] = recorder.summary(elapsed)
+
+    if args.pop_sessions:
+        # Give the delivery queue time to write the accepted mail.
+        await asyncio.sleep(args.settle)
+        recorder = Recorder()
+        # A maildrop is locked by one session at a time, as in RFC 1939.
+        locks = {user: asyncio.Lock() for user in users}
+
+        async def locked_session(user):
+            async with locks[user]:
+                await pop_session(pop_port, user, f"pw-{user}", args.retrieve, recorder)
+
+        sessions = [locked_session(users[i % len(users)]) for i in range(args.pop_sessions)]
+        elapsed = await run_phase(sessions, args.concurrency, recorder)
+        results["pop"] = recorder.summary(elapsed)
+    return results
+
+
+# ---------------------------
+# Servers
+# ---------------------------
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind((HOST, 0))
+        return s.getsockname()[1]
+
+def wait_listening(port, process):
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise BenchError(f"server on port {port} exited with code {process.returncode}")
+        try:
+            socket.create_connection((HOST, port), timeout=1.0).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise BenchError(f"server on port {port} did not start listening")
+
+def start_servers(args, workdir):
+    with open(os.path.join(workdir, "userinfo.txt"), "w") as f:
+        for i in range(args.users):
+            f.write(f"bench{i} pw-bench{i}\n")
+    common = ["--mode", args.mode, "--workers", str(args.workers), "--userinfo", "userinfo.txt",
+              "--connection-rate", "0", "--max-sessions", str(max(args.concurrency, 1))]
+    smtp_port, pop_port = free_port(), free_port()
+    servers = []
+    for script, port, extra in (("mailserver_smtp.py", smtp_port, ["--message-rate", "0"]),
+                                ("pop_server.py", pop_port, [])):
+        log = open(os.path.join(workdir, script.replace(".py", ".log")), "w")
+        servers.append(subprocess.Popen([sys.executable, os.path.join(SERVER_DIR, script), str(port)] + common + extra,
+                                        cwd=workdir, stdout=log, stderr=subprocess.STDOUT))
+        log.close()
+    try:
+        wait_listening(smtp_port, servers[0])
+        wait_listening(pop_port, servers[1])
+    except BenchError:
+        stop_servers(servers)
+        raise
+    return servers, smtp_port, pop_port
+
+def stop_servers(servers):
+    for process in servers:
+        if process.poll() is None:
+            process.terminate()
+    for process in servers:
+        try:
+            process.wait(serving.SHUTDOWN_GRACE + 5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+
+# ---------------------------
+# Reporting
+# ---------------------------
+def print_results(results):
+    for phase, summary in results.items():
+        print(f"\n{phase.upper()}: {summary['sessions']} sessions in {summary['elapsed_s']} s, "
+              f"{summary['sessions_per_s']} sessions/s, {summary['messages_per_s']} messages/s, "
+              f"{summary['bytes_per_s'] / 1e6:.2f} MB/s")
+        if summary["errors"]:
+            print(f"  errors: {summary['errors']}")
+        print(f"  {'command':<10}{'count':>8}{'mean':>10}{'p50':>10}{'p99':>10}{'p999':>10}{'max':>10}  (ms)")
+        for command, stats in summary["commands"].items():
+            print(f"  {command:<10}{stats['count']:>8}{stats['mean_ms']:>10}{stats['p50_ms']:>10}"
+                  f"{stats['p99_ms']:>10}{stats['p999_ms']:>10}{stats['max_ms']:>10}")
+
+def compare(results, baseline, tolerance):
+    """
+    Print the change of every p99 latency against a baseline run.
+    Returns the commands that got slower than 'tolerance' allows.
+    """
+    regressions = []
+    print("\nChange of p99 latency against the baseline:")
+    for phase, summary in results.items():
+        for command, stats in summary["commands"].items():
+            before = baseline.get(phase, {}).get("commands", {}).get(command)
+            if not before or not before["p99_ms"]:
+                continue
+            change = stats["p99_ms"] / before["p99_ms"] - 1
+            flag = ""
+            if change > tolerance:
+                regressions.append(f"{phase} {command}")
+                flag = "  REGRESSION"
+            print(f"  {phase:<5} {command:<10}{before['p99_ms']:>10} -> {stats['p99_ms']:<10} {change:+.0%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the SMTP and POP3 servers under concurrent load")
+    parser.add_argument('--mode', choices=['threaded', 'asyncio'], default='threaded', help='Engine the servers run')
+    parser.add_argument('--workers', type=int, default=1, help='Worker processes per server')
+    parser.add_argument('--users', type=int, default=200, help='Number of generated accounts')
+    parser.add_argument('--sessions', type=int, default=1000, help='SMTP sessions, one message each (0 skips SMTP)')
+    parser.add_argument('--pop-sessions', type=int, default=1000, help='POP3 sessions (0 skips POP3)')
+    parser.add_argument('--concurrency', type=int, default=500, help='Sessions open at the same time')
+    parser.add_argument('--message-size', type=int, default=4096, help='Body size of each message in bytes')
+    parser.add_argument('--recipients', type=int, default=1, help='Recipients per message')
+    parser.add_argument('--retrieve', type=int, default=1, help='Messages each POP3 session retrieves and deletes')
+    parser.add_argument('--settle', type=float, default=1.0,
+                        help='Seconds between the phases for queued deliveries to land')
+    parser.add_argument('--workdir', help='Directory for the servers (default: a temporary one, removed afterwards)')
+    parser.add_argument('--output', default='bench_results.json', help='File the JSON results are written to')
+    parser.add_argument('--baseline', help='Earlier JSON results to compare the p99 latencies with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed p99 slowdown against the baseline, as a fraction')
+    args = parser.parse_args()
+    if args.users < 1 or args.recipients > args.users:
+        parser.error("--recipients cannot exceed --users, and at least one user is needed")
+
+    serving.raise_file_limit()
+    workdir = args.workdir or tempfile.mkdtemp(prefix="mailbench-")
+    os.makedirs(workdir, exist_ok=True)
+    servers, smtp_port, pop_port = start_servers(args, workdir)
+    try:
+        results = asyncio.run(run_benchmark(args, smtp_port, pop_port))
+    finally:
+        stop_servers(servers)
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    config = {key: value for key, value in vars(args).items() if key not in ("output", "baseline", "workdir")}
+    with open(args.output, "w") as f:
+        json.dump({"config": config, "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+                   **results}, f, indent=2)
+    print_results(results)
+    print(f"\nResults written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("config") != config:
+            print("\nNote: the baseline was run with different settings.")
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"Slower than the baseline: {', '.join(regressions)}")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
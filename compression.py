@@ -0,0 +1,146 @@
+"""
+Per-message compression for Maildir storage.
+
+A compressed message holds its text (without the surrounding blank lines)
+as one zlib or lzma stream. zlib streams may be compressed against a preset
+dictionary trained from the mailbox: the header lines every message repeats
+then cost next to nothing. Which codec and dictionary a message uses is kept
+in its file name (see storage.MaildirStorage).
+"""
+import collections
+import hashlib
+import lzma
+import zlib
+
+CODECS = ("zlib", "lzma")
+# Bytes decompressed or read at a time
+BLOCK = 64 * 1024
+# zlib uses at most the last 32 KiB of a preset dictionary
+DICTIONARY_SIZE = 32 * 1024
+# Messages sampled to train a dictionary
+DICTIONARY_SAMPLES = 500
+
+
+def _compressor(codec, zdict=None):
+    if codec == "lzma":
+        return lzma.LZMACompressor()
+    if zdict:
+        return zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zdict=zdict)
+    return zlib.compressobj()
+
+def _decompressor(codec, zdict=None):
+    if codec == "lzma":
+        return lzma.LZMADecompressor()
+    if zdict:
+        return zlib.decompressobj(zdict=zdict)
+    return zlib.decompressobj()
+
+
+class CompressedWriter:
+    """
+    Binary file-like object that compresses the message written to it into
+    'file'. Whitespace around the message is dropped, so what decompresses
+    is the message text itself, 'size' bytes of it, 'crlf' of its line
+    ends being CRLF.
+    """
+    def __init__(self, file, codec, zdict=None):
+        self.file = file
+        self.compressor = _compressor(codec, zdict)
+        self.started = False
+        # Trailing whitespace, written once more text follows it
+        self.held = b""
+        self.size = 0
+        self.crlf = 0
+        self.last = b""
+
+    def write(self, data):
+        data = bytes(data)
+        if not self.started:
+            data = data.lstrip()
+            if not data:
+                return
+            self.started = True
+        text = data.rstrip()
+        if not text:
+            self.held += data
+            return
+        self._put(self.held + text)
+        self.held = data[len(text):]
+
+    def _put(self, data):
+        self.size += len(data)
+        self.crlf += data.count(b"\r\n") + (self.last == b"\r" and data[:1] == b"\n")
+        self.last = data[-1:]
+        self.file.write(self.compressor.compress(data))
+
+    def close(self):
+        self.file.write(self.compressor.flush())
+
+
+def decompressed(f, codec, zdict=None):
+    """
+    Yield the decompressed content of the open file 'f', at most BLOCK
+    bytes at a time.
+    """
+    decompressor = _decompressor(codec, zdict)
+    while True:
+        chunk = f.read(BLOCK)
+        if codec == "lzma":
+            if decompressor.eof:
+                return
+            yield decompressor.decompress(chunk, BLOCK)
+            while not decompressor.needs_input and not decompressor.eof:
+                yield decompressor.decompress(b"", BLOCK)
+            if not chunk:
+                return
+        else:
+            yield decompressor.decompress(chunk, BLOCK)
+            while decompressor.unconsumed_tail:
+                yield decompressor.decompress(decompressor.unconsumed_tail, BLOCK)
+            if not chunk or decompressor.eof:
+                yield decompressor.flush()
+                return
+
+def decompress_head(f, codec, zdict, limit):
+    """
+    Return the first 'limit' bytes of the decompressed content of 'f'.
+    """
+    head = bytearray()
+    for block in decompressed(f, codec, zdict):
+        head += block
+        if len(head) >= limit:
+            break
+    return bytes(head[:limit])
+
+def decompress_to(f, codec, zdict, dst, limit=None):
+    """
+    Decompress 'f' into the open file 'dst', stopping after 'limit' bytes.
+    Returns the number of bytes written.
+    """
+    written = 0
+    for block in decompressed(f, codec, zdict):
+        if limit is not None:
+            block = block[:limit - written]
+        dst.write(block)
+        written += len(block)
+        if limit is not None and written >= limit:
+            break
+    return written
+
+
+def train_dictionary(texts, size=DICTIONARY_SIZE):
+    """
+    Build a zlib preset dictionary from sample message texts: the lines
+    they share, the most common last, since zlib finds those at the
+    shortest distances.
+    """
+    counts = collections.Counter()
+    for text in texts:
+        counts.update(set(text.splitlines(keepends=True)))
+    shared = [line for line, count in counts.items() if count > 1]
+    shared.sort(key=lambda line: (counts[line], len(line)))
+    zdict = b"".join(shared)
+    return zdict[-size:]
+
+def dictionary_id(zdict):
+    return hashlib.sha256(zdict).hexdigest()[:16]
@@ -0,0 +1,160 @@
+"""
+Fixtures shared by the pytest modules: a copy of the repository to run the
+servers in, and servers started on free ports.
+"""
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+REPO = os.path.dirname(os.path.abspath(__file__))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class LineClient:
+    """
+    A client of the SMTP and POP3 servers, one command at a time.
+    """
+    def __init__(self, port, timeout=10.0):
+        self.sock = socket.create_connection(("127.0.0.1", port), timeout=timeout)
+        self.buffer = b""
+
+    def send(self, data):
+        self.sock.sendall(data)
+
+    def reply(self, multiline=False):
+        """
+        Read one POP3 reply: a line, or with 'multiline' up to the line
+        holding "." (an error is a single line all the same).
+        """
+        while True:
+            ending = b"\n.\n" if multiline and not self.buffer.startswith(b"-ERR") else b"\n"
+            end = self.buffer.find(ending)
+            if end >= 0:
+                end += len(ending)
+                reply, self.buffer = self.buffer[:end], self.buffer[end:]
+                return reply
+            data = self.sock.recv(65536)
+            if not data:
+                raise ConnectionError("connection closed")
+            self.buffer += data
+
+    def command(self, line, multiline=False):
+        self.send(line.encode() + b"\n")
+        return self.reply(multiline)
+
+    def smtp(self, line):
+        """
+        Send an SMTP command and return the reply, which has no line ending
+        and is sent in one piece.
+        """
+        self.send(line.encode() + b"\r\n")
+        return self.sock.recv(65536)
+
+    def close(self):
+        self.sock.close()
+
+
+@pytest.fixture
+def workdir(tmp_path):
+    """
+    A copy of the repository with its maildrops, where servers may write.
+    """
+    path = tmp_path / "repo"
+    shutil.copytree(REPO, path, ignore=shutil.ignore_patterns(".git", "__pycache__", ".pytest_cache",
+                                                               "queue", "blobs", "Maildir"))
+    return path
+
+
+@pytest.fixture
+def start_server(workdir):
+    """
+    Start 'script' in the work directory on a free port and return the
+    port once it accepts connections. Servers are stopped after the test.
+    """
+    processes = []
+
+    def start(script, *args):
+        port = free_port()
+        process = subprocess.Popen([sys.executable, script, str(port)] + list(args), cwd=workdir,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        processes.append(process)
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                return port
+            except OSError:
+                if process.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError(f"{script} did not start")
+                time.sleep(0.05)
+
+    yield start
+    for process in processes:
+        process.kill()
+        process.wait()
+
+
+@pytest.fixture
+def connect():
+    """
+    Open LineClients to a port; they are closed after the test.
+    """
+    clients = []
+
+    def open_client(port):
+        client = LineClient(port)
+        clients.append(client)
+        return client
+
+    yield open_client
+    for client in clients:
+        client.close()
+
+
+@pytest.fixture
+def send_mail(connect):
+    """
+    Send a message (lines separated by CRLF) with DATA; returns the reply.
+    """
+    def send(port, rcpts, message, sender="a@b.c"):
+        client = connect(port)
+        for command in ["HELO me", f"MAIL FROM: <{sender}>"] + [f"RCPT TO: <{rcpt}>" for rcpt in rcpts] + ["DATA"]:
+            client.smtp(command)
+        reply = client.smtp(message + "\r\n.")
+        client.smtp("QUIT")
+        return reply
+
+    return send
+
+
+@pytest.fixture
+def pop_login(connect):
+    """
+    Log in to the POP3 server once the maildrop holds at least
+    'count' messages, as delivery goes on after SMTP accepted the mail.
+    """
+    def login(port, count=0, username="lander", password="wachtwoord"):
+        deadline = time.monotonic() + 10
+        while True:
+            client = connect(port)
+            client.reply()
+            client.command(f"USER {username}")
+            assert client.command(f"PASS {password}").startswith(b"+OK")
+            messages = int(client.command("STAT").split()[1])
+            if messages >= count:
+                return client
+            assert time.monotonic() < deadline, f"{messages} of {count} messages delivered"
+            client.command("QUIT")
+            time.sleep(0.1)
+
+    return login
@@ -0,0 +1,227 @@
+"""
+Delivery queue for the SMTP server.
+
+Accepted mails are appended to a journal and acknowledged once the journal has
+been fsynced. One fsync covers every mail submitted during the same commit
+window, so the cost of durability is shared between sessions. A pool of
+writer threads then appends each mail to the recipients' mailboxes under a
+mailbox lock; the mailboxes written are fsynced in the next commit, after
+which the journal records the mail as done. A delivery that fails is tried
+again RETRY_ATTEMPTS times, RETRY_BASE seconds later and doubling; after that
+it stays pending in the journal until the next start.
+
+Journal records:
+  M <json meta with "id" and "size">\n<size bytes of payload>\n
+  D <id>\n
+"""
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+
+# How long the committer waits for more submissions before one fsync
+COMMIT_WINDOW = 0.005
+# Number of writer threads appending to mailboxes
+WORKERS = 4
+# The journal is emptied once nothing is pending and it grew past this size
+JOURNAL_LIMIT = 16 * 1024 * 1024
+# Retries of a failed delivery, the first after RETRY_BASE seconds, doubling
+RETRY_ATTEMPTS = 4
+RETRY_BASE = 0.5
+
+def fsync_path(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except FileNotFoundError:
+        # Removed since it was written, e.g. a relay entry already sent.
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def read_journal(path):
+    """
+    Return the records of the journal at 'path' that were not marked done,
+    as a list of (meta, payload). A record cut short by a crash is ignored.
+    """
+    pending = {}
+    if not os.path.exists(path):
+        return []
+    with open(path, "rb") as f:
+        while True:
+            line = f.readline()
+            if not line.endswith(b"\n"):
+                break
+            if line.startswith(b"M "):
+                meta = json.loads(line[2:])
+                payload = f.read(meta["size"])
+                if len(payload) < meta["size"] or f.read(1) != b"\n":
+                    break
+                pending[meta["id"]] = (meta, payload)
+            elif line.startswith(b"D "):
+                pending.pop(line[2:].strip().decode(), None)
+    return list(pending.values())
+
+def merge_journal(source, target):
+    """
+    Move the records of the journal at 'source' that were not marked done
+    into the one at 'target', for a journal no process uses any more.
+    Records keep their ids, so merging again after a crash adds nothing.
+    """
+    records = read_journal(target) + read_journal(source)
+    tmp_path = target + ".tmp"
+    with open(tmp_path, "wb") as f:
+        for meta, payload in records:
+            DeliveryQueue._write_record(f, meta, [payload])
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, target)
+    os.remove(source)
+    return len(records)
+
+class DeliveryQueue:
+    def __init__(self, journal_path, deliver, restore, commit_window=COMMIT_WINDOW, workers=WORKERS,
+                 retry_attempts=RETRY_ATTEMPTS, retry_base=RETRY_BASE, release=None):
+        """
+        'deliver(item)' writes an item to its mailboxes and returns the paths
+        it appended to; a retry gets the same item, so 'deliver' may skip what
+        it already wrote. 'restore(meta, payload)' rebuilds an item from a
+        journal record so mail accepted before a crash is still delivered.
+        'release(item)' is called once the item is delivered or given up.
+        """
+        self.journal_path = journal_path
+        self.deliver = deliver
+        self.release = release
+        self.commit_window = commit_window
+        self.retry_attempts = retry_attempts
+        self.retry_base = retry_base
+        # Serializes writes to the journal; taken before 'cond', never inside it
+        self.journal_lock = threading.Lock()
+        self.cond = threading.Condition()
+        self.written = 0      # records appended to the journal
+        self.committed = 0    # records known to be on disk
+        self.outstanding = 0  # records not yet marked done or given up
+        self.abandoned = 0    # records given up, left pending for the next start
+        self.delivered = []   # ids delivered since the last commit
+        self.dirty = set()    # mailboxes appended to since the last commit
+        self.work = queue.Queue()
+
+        directory = os.path.dirname(journal_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        recovered = read_journal(journal_path)
+        # Rewrite the journal with only the pending records, dropping a torn tail.
+        tmp_path = journal_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            for meta, payload in recovered:
+                self._write_record(f, meta, [payload])
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, journal_path)
+        self.journal = open(journal_path, "ab")
+        self.outstanding = len(recovered)
+        for meta, payload in recovered:
+            print(f"Recovering queued mail {meta['id']}")
+            self.work.put((meta["id"], restore(meta, payload), 0))
+
+        threading.Thread(target=self._commit_loop, daemon=True).start()
+        for _ in range(workers):
+            threading.Thread(target=self._worker, daemon=True).start()
+
+    @staticmethod
+    def _write_record(f, meta, chunks):
+        f.write(b"M " + json.dumps(meta).encode() + b"\n")
+        for chunk in chunks:
+            f.write(chunk)
+        f.write(b"\n")
+
+    def submit(self, meta, size, chunks, item):
+        """
+        Journal an item and block until the journal is on disk; the item is
+        then handed to the writer threads. 'chunks' yields 'size' payload bytes.
+        """
+        meta = dict(meta, id=uuid.uuid4().hex, size=size)
+        # The payload is written outside 'cond', so a large mail does not
+        # stall the sessions waiting for their commit.
+        with self.journal_lock:
+            self._write_record(self.journal, meta, chunks)
+            with self.cond:
+                self.written += 1
+                self.outstanding += 1
+                seq = self.written
+                self.cond.notify_all()
+        with self.cond:
+            while self.committed < seq:
+                self.cond.wait()
+        self.work.put((meta["id"], item, 0))
+
+    def _worker(self):
+        while True:
+            item_id, item, attempt = self.work.get()
+            try:
+                paths = self.deliver(item)
+            except Exception as e:
+                print(f"ERROR: delivery of {item_id} failed: {e}")
+                if attempt < self.retry_attempts:
+                    retry = threading.Timer(self.retry_base * 2 ** attempt, self.work.put,
+                                            ((item_id, item, attempt + 1),))
+                    retry.daemon = True
+                    retry.start()
+                    continue
+                # Left pending in the journal; delivered again on the next start.
+                with self.cond:
+                    self.outstanding -= 1
+                    self.abandoned += 1
+                    self.cond.notify_all()
+            else:
+                with self.cond:
+                    self.dirty.update(paths)
+                    self.delivered.append(item_id)
+                    self.cond.notify_all()
+            if self.release is not None:
+                self.release(item)
+
+    def _commit_loop(self):
+        while True:
+            with self.cond:
+                while self.written == self.committed and not self.delivered:
+                    self.cond.wait()
+            # Let other sessions join this commit.
+            time.sleep(self.commit_window)
+            with self.cond:
+                dirty, self.dirty = self.dirty, set()
+                done, self.delivered = self.delivered, []
+            # Mailbox appends must be durable before the journal forgets them.
+            for path in dirty:
+                fsync_path(path)
+            with self.journal_lock:
+                for item_id in done:
+                    self.journal.write(b"D " + item_id.encode() + b"\n")
+                self.journal.flush()
+                with self.cond:
+                    target = self.written
+            os.fsync(self.journal.fileno())
+            with self.cond:
+                self.committed = max(self.committed, target)
+                self.outstanding -= len(done)
+                self.cond.notify_all()
+            with self.journal_lock:
+                with self.cond:
+                    empty = self.outstanding == 0 and not self.abandoned and self.written == target
+                if empty and self.journal.tell() > JOURNAL_LIMIT:
+                    self.journal.truncate(0)
+                    self.journal.seek(0)
+                    os.fsync(self.journal.fileno())
+
+    def drain(self, timeout):
+        """
+        Wait up to 'timeout' seconds for every queued mail to be delivered
+        and marked done, before the process exits.
+        """
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while self.outstanding and time.monotonic() < deadline:
+                self.cond.wait(deadline - time.monotonic())
@@ -0,0 +1,241 @@
+"""
+Line framing for the mail servers.
+
+A LineBuffer holds received bytes in one preallocated bytearray and hands out
+complete CRLF/LF terminated lines, or raw views for payloads that must not be
+split into lines (SMTP DATA). LineReader fills it straight from a blocking
+socket with recv_into; AsyncLineReader does the same for an asyncio stream.
+
+Both readers raise TimeoutError when the peer stays silent for longer than
+'idle_timeout' while no command is pending, or stalls for longer than
+'command_timeout' in the middle of a line or payload.
+"""
+import asyncio
+import time
+
+# Initial receive buffer size per connection
+BUFFER_SIZE = 64 * 1024
+# Longest line kept waiting for its terminator; longer input is returned as is
+MAX_LINE = 64 * 1024
+
+
+class LineBuffer:
+    def __init__(self, size=BUFFER_SIZE, max_line=MAX_LINE):
+        self._buf = bytearray(size)
+        self._start = 0
+        self._end = 0
+        self._scanned = 0
+        self.max_line = max_line
+
+    def __len__(self):
+        return self._end - self._start
+
+    def writable(self):
+        """
+        Return a view of the free space at the end of the buffer, compacting
+        or growing it first when there is no room left.
+        """
+        if self._end == len(self._buf):
+            pending = self._end - self._start
+            if self._start > 0:
+                # Same-length slice assignment never resizes, so views still held
+                # by callers do not block the compaction.
+                self._buf[:pending] = self._buf[self._start:self._end]
+            else:
+                grown = bytearray(2 * len(self._buf))
+                grown[:pending] = self._buf[:pending]
+                self._buf = grown
+            self._scanned -= self._start
+            self._start, self._end = 0, pending
+        return memoryview(self._buf)[self._end:]
+
+    def commit(self, n):
+        """
+        Mark 'n' bytes written into the view returned by writable() as received.
+        """
+        self._end += n
+
+    def feed(self, data):
+        """
+        Copy received bytes into the buffer.
+        """
+        data = memoryview(data)
+        while data:
+            space = self.writable()
+            n = min(len(space), len(data))
+            space[:n] = data[:n]
+            self.commit(n)
+            data = data[n:]
+
+    def readline(self):
+        """
+        Return the next complete line including its terminator, or None when
+        no complete line has been received yet.
+        """
+        # Skip the bytes already searched for a newline by an earlier call.
+        index = self._buf.find(b"\n", max(self._start, self._scanned), self._end)
+        if index < 0:
+            if self._end - self._start < self.max_line:
+                self._scanned = self._end
+                return None
+            index = self._end - 1
+        line = bytes(self._buf[self._start:index + 1])
+        self._start = index + 1
+        self._reset_if_empty()
+        return line
+
+    def has_line(self):
+        """
+        Tell whether a complete line is waiting in the buffer.
+        """
+        return self._buf.find(b"\n", max(self._start, self._scanned), self._end) >= 0
+
+    def peek(self):
+        """
+        Return a view of every buffered byte without consuming it.
+        """
+        return memoryview(self._buf)[self._start:self._end]
+
+    def consume(self, n):
+        """
+        Drop 'n' bytes from the front of the buffer.
+        """
+        self._start += n
+        self._reset_if_empty()
+
+    def _reset_if_empty(self):
+        if self._start == self._end:
+            self._start = self._end = self._scanned = 0
+
+
+def _line_timeout(reader, deadline):
+    """
+    Return how long a reader may wait for more of a line: the idle timeout
+    between commands, else what is left of the command timeout.
+    """
+    if not len(reader.buffer):
+        return reader.idle_timeout
+    if deadline is None:
+        return reader.command_timeout
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise TimeoutError("command not completed in time")
+    return remaining
+
+
+class LineReader:
+    """
+    Frame lines read from a blocking socket.
+    """
+    def __init__(self, sock, size=BUFFER_SIZE, idle_timeout=None, command_timeout=None):
+        self.sock = sock
+        self.buffer = LineBuffer(size)
+        self.idle_timeout = idle_timeout
+        self.command_timeout = command_timeout
+
+    def fill(self, timeout=None):
+        """
+        Receive once into the buffer. Returns the byte count, 0 at end of stream.
+        """
+        self.sock.settimeout(timeout)
+        n = self.sock.recv_into(self.buffer.writable())
+        self.buffer.commit(n)
+        return n
+
+    def readline(self):
+        """
+        Return the next line as bytes, b"" once the peer closed the connection.
+        An unterminated last line is returned as is.
+        """
+        deadline = None
+        while True:
+            line = self.buffer.readline()
+            if line is not None:
+                return line
+            if not self.fill(_line_timeout(self, deadline)):
+                rest = bytes(self.buffer.peek())
+                self.buffer.consume(len(rest))
+                return rest
+            if deadline is None and self.command_timeout:
+                deadline = time.monotonic() + self.command_timeout
+
+    def read_some(self):
+        """
+        Return a view of the buffered bytes, receiving first if there are none.
+        The view is empty once the peer closed the connection.
+        """
+        if not len(self.buffer):
+            self.fill(self.command_timeout)
+        return self.buffer.peek()
+
+    def read_into(self, n, sink):
+        """
+        Pass the next 'n' bytes to 'sink' as views into the receive buffer,
+        without looking for line ends. Returns the number of bytes passed,
+        less than 'n' only when the peer closed the connection.
+        """
+        remaining = n
+        while remaining:
+            if not len(self.buffer) and not self.fill(self.command_timeout):
+                break
+            view = self.buffer.peek()[:remaining]
+            sink(view)
+            self.buffer.consume(len(view))
+            remaining -= len(view)
+        return n - remaining
+
+
+class AsyncLineReader:
+    """
+    Frame lines read from an asyncio StreamReader.
+    """
+    def __init__(self, reader, size=BUFFER_SIZE, idle_timeout=None, command_timeout=None):
+        self.reader = reader
+        self.size = size
+        self.buffer = LineBuffer(size)
+        self.idle_timeout = idle_timeout
+        self.command_timeout = command_timeout
+
+    async def _read(self, n, timeout):
+        if timeout is None:
+            return await self.reader.read(n)
+        return await asyncio.wait_for(self.reader.read(n), timeout)
+
+    async def fill(self, timeout=None):
+        data = await self._read(self.size, timeout)
+        self.buffer.feed(data)
+        return len(data)
+
+    async def readline(self):
+        deadline = None
+        while True:
+            line = self.buffer.readline()
+            if line is not None:
+                return line
+            if not await self.fill(_line_timeout(self, deadline)):
+                rest = bytes(self.buffer.peek())
+                self.buffer.consume(len(rest))
+                return rest
+            if deadline is None and self.command_timeout:
+                deadline = time.monotonic() + self.command_timeout
+
+    async def read_some(self):
+        if not len(self.buffer):
+            await self.fill(self.command_timeout)
+        return self.buffer.peek()
+
+    async def read_into(self, n, sink):
+        remaining = n
+        while remaining:
+            if len(self.buffer):
+                view = self.buffer.peek()[:remaining]
+                sink(view)
+                self.buffer.consume(len(view))
+            else:
+                # Nothing buffered: hand over what the stream returns directly.
+                view = memoryview(await self._read(min(remaining, self.size), self.command_timeout))
+                if not view:
+                    break
+                sink(view)
+            remaining -= len(view)
+        return n - remaining
@@ -0,0 +1,128 @@
+"""
+Sorted indexes on the Received time and the sender of a maildrop's messages.
+
+A HeaderIndex keeps the entries of a maildrop (see mailbox_index) sorted by
+the parsed 'received' field and by the normalized address in 'from'. A date
+range or the start of an address is then found by bisecting either list,
+and the matches come back in maildrop order. It only needs the "id", "from"
+and "received" fields. An index is extended with the mail appended to its
+maildrop rather than built again.
+
+Received lines look like 'MM/DD/YYYY : HH : MM' (see mail_client); messages
+without a readable one are left out of date queries.
+"""
+import bisect
+import datetime
+import re
+
+RECEIVED_FORMAT = "%m/%d/%Y : %H : %M"
+DAY_FORMAT = "%m/%d/%Y"
+ADDRESS = re.compile(r"<([^<>]*)>")
+LAST_DAYS = re.compile(r"last\s+(\d+)\s+days?$")
+
+
+def parse_received(received):
+    """
+    Return the time in a Received field as a datetime, or None.
+    """
+    for fmt in (RECEIVED_FORMAT, DAY_FORMAT):
+        try:
+            return datetime.datetime.strptime(received.strip(), fmt)
+        except ValueError:
+            continue
+    return None
+
+def parse_day(text):
+    try:
+        return datetime.datetime.strptime(text.strip(), DAY_FORMAT)
+    except ValueError:
+        return None
+
+def day_range(text, today=None):
+    """
+    Turn 'MM/DD/YYYY', 'MM/DD/YYYY MM/DD/YYYY' (both days included) or
+    'last N days' (today included) into (first day, day after the last),
+    or None when it is none of those.
+    """
+    text = text.strip().lower()
+    match = LAST_DAYS.match(text)
+    if match:
+        today = datetime.datetime.combine(today or datetime.date.today(), datetime.time())
+        return today - datetime.timedelta(days=int(match.group(1)) - 1), today + datetime.timedelta(days=1)
+    days = [parse_day(part) for part in text.split()]
+    if not 1 <= len(days) <= 2 or None in days:
+        return None
+    return days[0], days[-1] + datetime.timedelta(days=1)
+
+def normalize_address(sender):
+    """
+    Reduce a From field ('Name <user@host>' or 'user@host') to the lowercased address.
+    """
+    match = ADDRESS.search(sender)
+    return (match.group(1) if match else sender).strip().lower()
+
+
+class HeaderIndex:
+    def __init__(self, entries=()):
+        # Position in the maildrop, to give matches back in maildrop order
+        self.positions = {}
+        # (time, position) and (address, position), sorted, with the entries alongside
+        self.times = []
+        self.by_time = []
+        self.senders = []
+        self.by_sender = []
+        self._insert(entries)
+
+    def _insert(self, entries):
+        """
+        Add entries after the indexed ones. The sorted lists are replaced, not
+        changed, and sorting them again only merges the new entries in.
+        """
+        timed = list(zip(self.times, self.by_time))
+        senders = list(zip(self.senders, self.by_sender))
+        for entry in entries:
+            position = self.positions[entry["id"]] = len(self.positions)
+            received = parse_received(entry["received"])
+            if received is not None:
+                timed.append(((received, position), entry))
+            senders.append(((normalize_address(entry["from"]), position), entry))
+        timed.sort(key=lambda item: item[0])
+        senders.sort(key=lambda item: item[0])
+        self.times = [item[0] for item in timed]
+        self.by_time = [item[1] for item in timed]
+        self.senders = [item[0] for item in senders]
+        self.by_sender = [item[1] for item in senders]
+
+    def extended(self, entries):
+        """
+        Return a new index of these entries followed by 'entries'. Only the
+        new entries are parsed; this one is left as it is for the sessions
+        still using it.
+        """
+        index = HeaderIndex()
+        index.positions = dict(self.positions)
+        index.times, index.by_time = self.times, self.by_time
+        index.senders, index.by_sender = self.senders, self.by_sender
+        index._insert(entries)
+        return index
+
+    def _in_order(self, entries):
+        return sorted(entries, key=lambda entry: self.positions[entry["id"]])
+
+    def received_between(self, start=None, stop=None):
+        """
+        Return the entries received at or after 'start' and before 'stop'
+        (datetimes; None leaves that end open).
+        """
+        low = 0 if start is None else bisect.bisect_left(self.times, (start,))
+        high = len(self.times) if stop is None else bisect.bisect_left(self.times, (stop,))
+        return self._in_order(self.by_time[low:high])
+
+    def from_prefix(self, prefix):
+        """
+        Return the entries whose sender address starts with 'prefix'.
+        """
+        prefix = prefix.strip().lower()
+        low = bisect.bisect_left(self.senders, (prefix,))
+        high = bisect.bisect_left(self.senders, (prefix + "\U0010ffff",))
+        return self._in_order(self.by_sender[low:high])
@@ -0,0 +1,44 @@
+"""
+Locks shared between threads and between the SMTP and POP3 processes.
+"""
+import contextlib
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+_thread_locks = {}
+_thread_locks_guard = threading.Lock()
+
+def _thread_lock(path):
+    with _thread_locks_guard:
+        lock = _thread_locks.get(path)
+        if lock is None:
+            lock = _thread_locks[path] = threading.Lock()
+        return lock
+
+@contextlib.contextmanager
+def file_lock(path):
+    """
+    Hold an exclusive lock named by the file at 'path' (created if missing).
+    Threads of this process queue on a thread lock; other processes are kept
+    out with flock where the platform has it.
+    """
+    with _thread_lock(path):
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if fcntl:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+def mailbox_lock(mailbox_path):
+    """
+    Return the lock held while the mailbox file at 'mailbox_path' is read or
+    written, by SMTP delivery and POP3 sessions in any process.
+    """
+    return file_lock(mailbox_path + ".lock")
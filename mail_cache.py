@@ -0,0 +1,105 @@
+"""
+Local cache of the messages mail_client has fetched, in SQLite.
+
+Messages are kept per server and user under their UIDL, which POP3 keeps
+the same for the life of a message, so a session only needs the UIDL
+listing to tell which messages are new (fetched once) and which were
+deleted (dropped here too). Along with the text every row holds the message
+number of the last session and the From, Received and Subject fields, so
+searches run against the cache without the network. The cache holds other
+people's mail, so its directory and file are private to the user.
+"""
+import os
+import sqlite3
+
+CACHE_PATH = os.path.join("~", ".mail_client", "cache.sqlite3")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    server TEXT NOT NULL,
+    username TEXT NOT NULL,
+    uid TEXT NOT NULL,
+    number INTEGER NOT NULL,
+    sender TEXT NOT NULL,
+    received TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    content TEXT NOT NULL,
+    PRIMARY KEY (server, username, uid)
+)
+"""
+
+
+def parse_fields(content):
+    """
+    Return the sender, received time and subject of a message's header lines.
+    """
+    sender = received = subject = ""
+    for line in content.splitlines():
+        if line.startswith("From:"):
+            sender = line[len("From:"):].strip()
+        elif line.startswith("Received:"):
+            received = line[len("Received:"):].strip()
+        elif line.startswith("Subject:"):
+            subject = line[len("Subject:"):].strip()
+    return sender, received, subject
+
+
+class MailCache:
+    def __init__(self, path=CACHE_PATH):
+        path = os.path.expanduser(path)
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+        # Created private before SQLite opens it; its journal files copy the mode.
+        os.close(os.open(path, os.O_RDWR | os.O_CREAT, 0o600))
+        os.chmod(path, 0o600)
+        self.db = sqlite3.connect(path)
+        with self.db:
+            self.db.execute(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def uids(self, server, username):
+        rows = self.db.execute("SELECT uid FROM messages WHERE server = ? AND username = ?", (server, username))
+        return {uid for uid, in rows}
+
+    def synchronize(self, server, username, numbers):
+        """
+        Match the cache to the server's UIDL listing 'numbers' (uid ->
+        message number): drop the messages it no longer has and renumber
+        the others. Returns the uids still to fetch.
+        """
+        cached = self.uids(server, username)
+        with self.db:
+            self.db.executemany("DELETE FROM messages WHERE server = ? AND username = ? AND uid = ?",
+                                [(server, username, uid) for uid in cached - numbers.keys()])
+            self.db.executemany("UPDATE messages SET number = ? WHERE server = ? AND username = ? AND uid = ?",
+                                [(numbers[uid], server, username, uid) for uid in cached & numbers.keys()])
+        return [uid for uid in numbers if uid not in cached]
+
+    def store(self, server, username, uid, number, content):
+        sender, received, subject = parse_fields(content)
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                            (server, username, uid, number, sender, received, subject, content))
+
+    def remove(self, server, username, uids):
+        with self.db:
+            self.db.executemany("DELETE FROM messages WHERE server = ? AND username = ? AND uid = ?",
+                                [(server, username, uid) for uid in uids])
+
+    def messages(self, server, username):
+        """
+        Return the cached messages in server order as entries
+        {"id": number, "uid", "from", "received", "subject", "content"}.
+        """
+        rows = self.db.execute("SELECT number, uid, sender, received, subject, content FROM messages "
+                               "WHERE server = ? AND username = ? ORDER BY number", (server, username))
+        return [{"id": number, "uid": uid, "from": sender, "received": received, "subject": subject, "content": content}
+                for number, uid, sender, received, subject, content in rows]
+
+    def content(self, server, username, uid):
+        row = self.db.execute("SELECT content FROM messages WHERE server = ? AND username = ? AND uid = ?",
+                              (server, username, uid)).fetchone()
+        return None if row is None else row[0]
@@ -2,16 +2,30 @@ import socket
 import getpass
 import datetime
 import argparse
+import re
+
+import header_index
+import mail_cache
+
+# A LIST line: "<number>. <sender> <MM/DD/YYYY : HH : MM> <subject>", the time possibly missing
+LIST_LINE = re.compile(r"(\d+)\. (\S*) (\d\d/\d\d/\d{4} : \d\d : \d\d)? ?(.*)")
 
 class MailClient:
-    def __init__(self, server_ip):
+    def __init__(self, server_ip, cache=None):
         self.server_ip = server_ip
         self.smtp_socket = None
         self.pop3_socket = None
         self.SMTP_PORT = 2000  # Specified SMTP port
         self.POP3_PORT = 3000  # Specified POP3 port
+        # Local copy of fetched messages (a mail_cache.MailCache), or None
+        self.cache = cache
         self.connectSMTP()
 
+    @property
+    def server(self):
+        # Key of this server's messages in the cache
+        return f"{self.server_ip}:{self.POP3_PORT}"
+
     def connectSMTP(self):
         self.smtp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.smtp_socket.connect((self.server_ip, self.SMTP_PORT))
@@ -45,14 +59,17 @@ class MailClient:
             response = self.pop3_socket.recv(1024).decode()
             return response
         else:
-            # Read lines until termination sequence is detected
-            lines = []
+            # Read until the termination sequence, which may be split over
+            # chunks, or an error line; decoded once, so no character is split
+            chunks = []
+            tail = b""
             while True:
-                chunk = self.pop3_socket.recv(1024).decode()
-                lines.append(chunk)
-                if "\n.\n" in chunk or chunk.strip() == ".":
+                chunk = self.pop3_socket.recv(65536)
+                chunks.append(chunk)
+                tail = (tail + chunk)[-3:]
+                if not chunk or tail.endswith(b"\n.\n") or (chunks[0].startswith(b"-ERR") and tail.endswith(b"\n")):
                     break
-            return "".join(lines)
+            return b"".join(chunks).decode(errors="replace")
 
     # --------------------------
     # Sending Email (SMTP)
@@ -93,10 +110,12 @@ class MailClient:
         print("Enter message body, end with a line containing only '.':")
         while True:
             line = input() + "\n"
-            self._sendSMTP(line)
             if line == ".\n":
+                self._sendSMTP(line)
                 print("EMAIL COMPLETE")
                 break
+            # Other lines starting with "." get a second one, which the server drops
+            self._sendSMTP("." + line if line.startswith(".") else line)
 
         # End DATA with termination sequence
         # self._sendSMTP("\n.\n")
@@ -133,6 +152,12 @@ class MailClient:
             else:
                 print("Authentication failed. Please try again.")
 
+        # Fetch only the messages the local cache does not have yet
+        numbers = {}
+        if self.cache is not None:
+            numbers = {number: uid for uid, number in self._sync(pop_username).items()}
+        deleted = set()
+
         # Retrieve and display email summary using LIST
         self._sendPOP("LIST\n")
         list_response = self._receivePOP(multiline=True)
@@ -146,13 +171,27 @@ class MailClient:
             command = input("POP3> ").strip()
             if not command:
                 continue
+            parts = command.split()
+            verb = parts[0].upper()
+            number = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else None
+            if verb == "RETR" and number in numbers and number not in deleted:
+                content = self.cache.content(self.server, pop_username, numbers[number])
+                if content is not None:
+                    print(f"+OK message follows (local cache)\n{content}\n.")
+                    continue
             self._sendPOP(command + "\n")
             if command.upper().startswith("RETR"):
                 resp = self._receivePOP(multiline=True)
             else:
                 resp = self._receivePOP()
             print(resp.strip())
+            if verb == "DELE" and resp.startswith("+OK"):
+                deleted.add(number)
+            elif verb == "RSET" and resp.startswith("+OK"):
+                deleted.clear()
             if command.upper() == "QUIT":
+                if resp.startswith("+OK") and self.cache is not None:
+                    self.cache.remove(self.server, pop_username, [numbers[n] for n in deleted if n in numbers])
                 break
 
         self.pop3_socket.close()
@@ -184,81 +223,55 @@ class MailClient:
             else:
                 print("Authentication failed. Please try again.")
 
-        # Get a list of message numbers using LIST
-        self._sendPOP("LIST\n")
-        list_response = self._receivePOP(multiline=True)
-        # Parse the LIST response into message numbers
-        # Expected format:
-        # +OK N messages
-        # 1. sender time subject
-        # 2. sender time subject
-        # .
-        lines = list_response.splitlines()
-        message_nums = []
-        for line in lines:
-            # Skip the initial +OK and the terminating dot
-            if line.startswith("+OK") or line.strip() == ".":
-                continue
-            # Assume each line starts with a number followed by a dot
-            parts = line.split('.', 1)
-            if parts and parts[0].isdigit():
-                message_nums.append(int(parts[0]))
-        if not message_nums:
-            print("No messages to search.")
+        server_search = False
+        if self.cache is not None:
+            # Fetch only new messages; the search runs on the local cache
+            self._sync(pop_username)
             self._sendPOP("QUIT\n")
             self._receivePOP()
             self.pop3_socket.close()
+            listed = self.cache.messages(self.server, pop_username)
+        else:
+            # Servers with the SEARCH extension answer the query themselves
+            self._sendPOP("CAPA\n")
+            capa_response = self._receivePOP(multiline=True)
+            server_search = capa_response.startswith("+OK") and "SEARCH" in capa_response.splitlines()
+
+            # Get a list of message numbers using LIST
+            listed = []
+            if not server_search:
+                listed = self._list_messages()
+        if not server_search and not listed:
+            print("No messages to search.")
+            if self.cache is None:
+                self._sendPOP("QUIT\n")
+                self._receivePOP()
+                self.pop3_socket.close()
             return
 
         # Present search options
         print("\nSearch Options:")
         print("1) Search by words/sentences")
-        print("2) Search by time (format MM/DD/YYYY)")
-        print("3) Search by sender address")
+        print("2) Search by time (MM/DD/YYYY, a range MM/DD/YYYY MM/DD/YYYY, or last N days)")
+        print("3) Search by sender address (or its start)")
         option = input("Select search option (1/2/3): ").strip()
 
         criteria = input("Enter search term: ").strip().lower()
 
-        # For each message number, retrieve the full message and check if it matches the criteria.
         found_messages = []
-        for num in message_nums:
-            self._sendPOP(f"RETR {num}\n")
-            msg_response = self._receivePOP(multiline=True)
-            # Remove POP3 protocol response lines for searching.
-            msg_lines = msg_response.splitlines()
-            # Filter out the status and termination lines.
-            content_lines = [line for line in msg_lines if not line.startswith("+OK") and line.strip() != "."]
-            content = "\n".join(content_lines)
-            content_lower = content.lower()
-            if option == "1":
-                # Search the entire content for the term.
-                if criteria in content_lower:
-                    found_messages.append((num, content))
-            elif option == "2":
-                # Look for the Received: header. The date is expected to be in MM/DD/YYYY format.
-                for line in content_lines:
-                    if line.lower().startswith("received:"):
-                        # Extract the date portion.
-                        # For example: "Received: 03/18/2025 : 10 : 59"
-                        header = line[len("Received:"):].strip()
-                        # Split by ":"; the first token should be the date.
-                        tokens = header.split()
-                        if tokens:
-                            date_str = tokens[0]
-                            if criteria == date_str:
-                                found_messages.append((num, content))
-                        break
-            elif option == "3":
-                # Look for the From: header.
-                for line in content_lines:
-                    if line.lower().startswith("from:"):
-                        header = line[len("From:"):].strip().lower()
-                        if criteria in header:
-                            found_messages.append((num, content))
-                        break
-            else:
-                print("Invalid search option.")
-                break
+        if option not in ("1", "2", "3"):
+            print("Invalid search option.")
+        elif option == "2" and header_index.day_range(criteria) is None:
+            print("Invalid time; use MM/DD/YYYY, two such days or last N days.")
+        elif self.cache is not None:
+            found_messages = self._search_cached(listed, option, criteria)
+        elif server_search:
+            found_messages = self._search_on_server(option, criteria)
+        elif option == "1":
+            found_messages = self._search_locally([entry["id"] for entry in listed], criteria)
+        else:
+            found_messages = [(entry["id"], "\n".join(self._retrieve(entry["id"])))
+                              for entry in self._match_headers(listed, option, criteria)]
 
         if found_messages:
             print("\nSearch Results:")
@@ -269,9 +282,131 @@ class MailClient:
         else:
             print("No messages found matching the criteria.")
 
-        self._sendPOP("QUIT\n")
-        self._receivePOP()
-        self.pop3_socket.close()
+        if self.cache is None:
+            self._sendPOP("QUIT\n")
+            self._receivePOP()
+            self.pop3_socket.close()
+
+    def _retrieve(self, num):
+        """
+        Retrieve message 'num' with RETR; returns its lines without the
+        status and termination lines, dot-stuffing undone.
+        """
+        self._sendPOP(f"RETR {num}\n")
+        msg_response = self._receivePOP(multiline=True)
+        if not msg_response.startswith("+OK"):
+            return []
+        msg_lines = msg_response.splitlines()[1:]
+        if msg_lines and msg_lines[-1] == ".":
+            msg_lines.pop()
+        return [line[1:] if line.startswith(".") else line for line in msg_lines]
+
+    def _uidl(self):
+        """
+        Return the UIDL listing as {uid: message number}.
+        """
+        self._sendPOP("UIDL\n")
+        uidl_response = self._receivePOP(multiline=True)
+        numbers = {}
+        if not uidl_response.startswith("+OK"):
+            return numbers
+        for line in uidl_response.splitlines()[1:]:
+            parts = line.split()
+            if len(parts) == 2 and parts[0].isdigit():
+                numbers[parts[1]] = int(parts[0])
+        return numbers
+
+    def _sync(self, username):
+        """
+        Bring the local cache up to date with the maildrop: retrieve the
+        messages it does not have yet and forget the deleted ones.
+        Returns the UIDL listing, {uid: message number}.
+        """
+        numbers = self._uidl()
+        missing = self.cache.synchronize(self.server, username, numbers)
+        for uid in missing:
+            self.cache.store(self.server, username, uid, numbers[uid], "\n".join(self._retrieve(numbers[uid])))
+        print(f"{len(numbers)} messages, {len(missing)} fetched, the others from the local cache.")
+        return numbers
+
+    def _search_cached(self, listed, option, criteria):
+        """
+        Search the cached messages 'listed', without the server.
+        """
+        if option == "1":
+            matched = [entry for entry in listed if criteria in entry["content"].lower()]
+        else:
+            matched = self._match_headers(listed, option, criteria)
+        return [(entry["id"], entry["content"]) for entry in matched]
+
+    def _search_on_server(self, option, criteria):
+        """
+        Let the server find the matching messages with SEARCH, then retrieve
+        only those.
+        """
+        kinds = {"1": "TEXT", "2": "DATE", "3": "FROM"}
+        if option == "2":
+            # Sent as first and last day, so "last N days" counts from the client's today
+            first, stop = header_index.day_range(criteria)
+            criteria = f"{first:%m/%d/%Y} {stop - datetime.timedelta(days=1):%m/%d/%Y}"
+        self._sendPOP(f"SEARCH {kinds[option]} {criteria}\n")
+        search_response = self._receivePOP(multiline=True)
+        if not search_response.startswith("+OK"):
+            print("Search failed:", search_response.strip())
+            return []
+        found_messages = []
+        for line in search_response.splitlines()[1:]:
+            if line.strip().isdigit():
+                num = int(line)
+                found_messages.append((num, "\n".join(self._retrieve(num))))
+        return found_messages
+
+    def _match_headers(self, listed, option, criteria):
+        """
+        Answer date and sender queries from the listed entries (from LIST
+        or the cache) in one pass; a single query does not pay for sorting.
+        """
+        if option == "2":
+            start, stop = header_index.day_range(criteria)
+            times = ((entry, header_index.parse_received(entry["received"])) for entry in listed)
+            return [entry for entry, received in times if received is not None and start <= received < stop]
+        prefix = criteria.strip().lower()
+        return [entry for entry in listed if header_index.normalize_address(entry["from"]).startswith(prefix)]
+
+    def _list_messages(self):
+        """
+        Return the messages LIST describes, as {"id": number, "from",
+        "received", "subject"} entries.
+        """
+        self._sendPOP("LIST\n")
+        list_response = self._receivePOP(multiline=True)
+        # Parse the LIST response into message numbers
+        # Expected format:
+        # +OK N messages
+        # 1. sender time subject
+        # 2. sender time subject
+        # .
+        lines = list_response.splitlines()
+        listed = []
+        for line in lines:
+            # Skip the initial +OK and the terminating dot
+            if line.startswith("+OK") or line.strip() == ".":
+                continue
+            match = LIST_LINE.match(line)
+            if match:
+                num, sender, received, subject = match.groups()
+                listed.append({"id": int(num), "from": sender, "received": received or "", "subject": subject})
+        return listed
+
+    def _search_locally(self, message_nums, criteria):
+        # For each message number, retrieve the full message and check if it matches the criteria.
+        found_messages = []
+        for num in message_nums:
+            content = "\n".join(self._retrieve(num))
+            # Search the entire content for the term.
+            if criteria in content.lower():
+                found_messages.append((num, content))
+        return found_messages
 
     # --------------------------
     # Main Client Loop
@@ -299,9 +434,12 @@ class MailClient:
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="The adress of the SMPTY and POP3 server")
     parser.add_argument('adress', type=str, help='A string as adress')
+    parser.add_argument('--cache', default=mail_cache.CACHE_PATH, help='SQLite file keeping fetched messages')
+    parser.add_argument('--no-cache', action='store_true', help='Fetch messages from the server every time')
     args = parser.parse_args()
     server_ip = args.adress
-    client = MailClient(server_ip)
+    cache = None if args.no_cache else mail_cache.MailCache(args.cache)
+    client = MailClient(server_ip, cache)
     client.start()
 
 # =======================
@@ -0,0 +1,508 @@
+"""
+Sidecar index of a mailbox file.
+
+Next to every 'my_mailbox' the servers keep 'my_mailbox.idx', one JSON line
+per message:
+
+  {"id", "offset", "length", "headers", "end", "size", "from", "received",
+   "subject", "blob", "deleted"}
+
+'offset' and 'length' locate the message text (without the surrounding blank
+lines) in the mailbox, 'headers' is how many bytes of it are header lines
+(see message_store.header_length) and 'end' is the byte after the blank line
+closing it, so the last entry tells how much of the mailbox is indexed.
+'size' is the size of the message as served, blob body included, and 'blob'
+the digest it refers to, if any. 'id' is a unique identifier kept for the
+life of the message, through compaction and through rebuilds that find it
+where it was; POP3 serves it as the UIDL.
+
+Deleting messages appends a tombstone per message, {"deleted": id, "end"},
+which sets the deleted flag of that entry when the index is read; the message
+stays in the mailbox until compact() rewrites it without the deleted ones.
+
+SMTP delivery indexes each message right after appending it. Readers bring
+the index up to date before using it: a mailbox that grew is scanned from the
+indexed end only, one that shrank or an index that cannot be read is rebuilt
+from scratch. Every function here except compact() expects the mailbox lock
+to be held.
+"""
+import json
+import os
+import uuid
+
+import locking
+import message_store
+
+INDEX_SUFFIX = ".idx"
+# Bytes read from the end of an index to find its last entry
+TAIL_READ = 8192
+# Bytes at the start of a message held to index it; the rest is only counted
+HEADER_READ = 64 * 1024
+# Deleted messages are compacted away once they take up this many bytes...
+COMPACT_MIN_BYTES = 1024 * 1024
+# ...and this share of the mailbox
+COMPACT_RATIO = 0.25
+# Block size used when copying messages during compaction
+COPY_BLOCK = 1024 * 1024
+# Compaction writes the new mailbox and index under these names before the swap
+COMPACT_SUFFIX = ".compact.tmp"
+
+
+def index_path(mailbox_path):
+    return mailbox_path + INDEX_SUFFIX
+
+def parse_fields(msg):
+    """
+    Parse the email message and extract the sender, received time, and subject.
+    Expected lines:
+      From: <sender>
+      Received: <date : hour : minute>
+      Subject: <subject>
+    """
+    sender = ""
+    received = ""
+    subject = ""
+    for line in msg.splitlines():
+        if line.startswith("From:"):
+            sender = line[len("From:"):].strip()
+        elif line.startswith("Received:"):
+            received = line[len("Received:"):].strip()
+        elif line.startswith("Subject:"):
+            subject = line[len("Subject:"):].strip()
+    return sender, received, subject
+
+def decode(raw):
+    """
+    Turn stored message bytes into the text served to clients.
+    """
+    return raw.decode(errors="replace").replace("\r\n", "\n")
+
+def read_message(f, entry):
+    """
+    Return the text of an indexed message from the open mailbox file 'f'.
+    """
+    f.seek(entry["offset"])
+    return decode(f.read(entry["length"]))
+
+def make_entry(offset, raw, end, store):
+    stripped = raw.strip()
+    text = decode(stripped)
+    sender, received, subject = parse_fields(text)
+    _, blob = message_store.blob_reference(text)
+    return {"id": uuid.uuid4().hex,
+            "offset": offset + len(raw) - len(raw.lstrip()),
+            "length": len(stripped),
+            "headers": message_store.header_length(stripped),
+            "end": end,
+            "size": message_store.message_size(text, store),
+            "from": sender,
+            "received": received,
+            "subject": subject,
+            "blob": blob,
+            "deleted": False}
+
+def make_long_entry(offset, head, length, end, size):
+    """
+    Return the entry of a message longer than HEADER_READ from its first
+    bytes 'head': 'offset' and 'length' locate its text and 'size' is its
+    size as served. Such messages carry their body inline, never a blob
+    reference.
+    """
+    sender, received, subject = parse_fields(decode(head))
+    return {"id": uuid.uuid4().hex,
+            "offset": offset,
+            "length": length,
+            "headers": message_store.header_length(head),
+            "end": end,
+            "size": size,
+            "from": sender,
+            "received": received,
+            "subject": subject,
+            "blob": None,
+            "deleted": False}
+
+def scan(f, start, store):
+    """
+    Index the messages of the open mailbox 'f' from byte 'start' on.
+    Returns (entries, partial): the messages closed by a blank line, and the
+    entry of a last message without one, which may still grow, or None.
+    Only the first HEADER_READ bytes of a message are held at a time.
+    """
+    entries = []
+    f.seek(start)
+    pos = start
+    message = None
+
+    def entry(end):
+        first, text_start, text_end, head, crlf_lines, last_crlf = message
+        if text_end - first <= len(head):
+            return make_entry(first, bytes(head), end, store)
+        # Served with LF line ends; the line end of the last line is not part of the text.
+        return make_long_entry(text_start, bytes(head).lstrip(), text_end - text_start, end,
+                               text_end - text_start - (crlf_lines - last_crlf))
+
+    for line in f:
+        if line.strip():
+            if message is None:
+                # [first byte, text start, text end, head, lines ending in CRLF, last one does]
+                message = [pos, pos + len(line) - len(line.lstrip()), 0, bytearray(), 0, 0]
+            message[2] = pos + len(line.rstrip())
+            if len(message[3]) < HEADER_READ:
+                message[3] += line
+            message[5] = int(line.endswith(b"\r\n"))
+            message[4] += message[5]
+        elif message is not None:
+            entries.append(entry(pos + len(line)))
+            message = None
+        pos += len(line)
+    partial = None
+    if message is not None:
+        partial = entry(None)
+        # Not stored, so the id must come out the same on every scan.
+        partial["id"] = f"partial-{partial['offset']}-{partial['length']}"
+    return entries, partial
+
+def _read_lines(mailbox_path, offset=0):
+    try:
+        with open(index_path(mailbox_path), "rb") as f:
+            f.seek(offset)
+            return [json.loads(line) for line in f]
+    except (FileNotFoundError, ValueError):
+        return None
+
+def _apply(entries, lines):
+    """
+    Return 'entries' followed by the entries among the index 'lines', with
+    the tombstones among them applied. 'entries' itself is left as it is.
+    """
+    entries = list(entries)
+    position = {entry["id"]: i for i, entry in enumerate(entries)}
+    for line in lines:
+        if "deleted" in line and "id" not in line:
+            i = position.get(line["deleted"])
+            if i is not None:
+                entries[i] = dict(entries[i], deleted=True)
+        else:
+            position[line["id"]] = len(entries)
+            entries.append(line)
+    return entries
+
+def read_index(mailbox_path):
+    """
+    Return the entries stored in the index with their tombstones applied,
+    or None when it is missing or damaged (for instance cut short by a crash).
+    """
+    lines = _read_lines(mailbox_path)
+    return None if lines is None else _apply([], lines)
+
+def _last_entry(mailbox_path):
+    """
+    Return the last entry of the index without reading all of it, {} when
+    the index is empty, or None when it is missing or damaged.
+    """
+    try:
+        with open(index_path(mailbox_path), "rb") as f:
+            size = f.seek(0, os.SEEK_END)
+            window = TAIL_READ
+            while True:
+                f.seek(max(size - window, 0))
+                tail = f.read()
+                # The last line starts after the newline before it.
+                cut = tail.rfind(b"\n", 0, len(tail) - 1)
+                if cut >= 0 or window >= size:
+                    break
+                window *= 2
+    except FileNotFoundError:
+        return None
+    if not tail:
+        return {}
+    if not tail.endswith(b"\n"):
+        return None
+    try:
+        return json.loads(tail[cut + 1:])
+    except ValueError:
+        return None
+
+def _append(mailbox_path, entries):
+    if entries:
+        with open(index_path(mailbox_path), "ab") as f:
+            f.write(b"".join(json.dumps(entry).encode() + b"\n" for entry in entries))
+
+def _write_entries(path, entries):
+    with open(path, "wb") as f:
+        f.write(b"".join(json.dumps(entry).encode() + b"\n" for entry in entries))
+        f.flush()
+        os.fsync(f.fileno())
+
+def write_index(mailbox_path, entries):
+    """
+    Replace the index with 'entries'.
+    """
+    path = index_path(mailbox_path)
+    _write_entries(path + ".tmp", entries)
+    os.replace(path + ".tmp", path)
+
+def _finish_compaction(mailbox_path):
+    """
+    Complete a compaction that a crash cut short between swapping in the
+    new mailbox and swapping in its index. Returns True when the index was
+    replaced.
+    """
+    pending = index_path(mailbox_path) + COMPACT_SUFFIX
+    if not os.path.exists(pending):
+        return False
+    if os.path.exists(mailbox_path + COMPACT_SUFFIX):
+        # Not swapped yet: the old mailbox and index still belong together.
+        os.remove(pending)
+        return False
+    os.replace(pending, index_path(mailbox_path))
+    return True
+
+def _refresh(mailbox_path, indexed_end, store):
+    """
+    Scan what the index does not cover yet. Returns (new entries, partial),
+    or None when the index no longer matches the mailbox.
+    """
+    size = os.path.getsize(mailbox_path)
+    if size < indexed_end:
+        return None
+    if size == indexed_end:
+        return [], None
+    with open(mailbox_path, "rb") as f:
+        return scan(f, indexed_end, store)
+
+def _known_ids(mailbox_path):
+    """
+    Return the ids of the old index by message position, from whatever
+    lines of it can still be read.
+    """
+    known = {}
+    try:
+        with open(index_path(mailbox_path), "rb") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    known[entry["offset"], entry["length"]] = entry["id"]
+                except (ValueError, KeyError, TypeError):
+                    continue
+    except FileNotFoundError:
+        pass
+    return known
+
+def rebuild(mailbox_path, store):
+    """
+    Index the whole mailbox again. Returns (entries, partial). Messages
+    still where the old index had them keep their ids.
+    """
+    with open(mailbox_path, "rb") as f:
+        entries, partial = scan(f, 0, store)
+    known = _known_ids(mailbox_path)
+    for entry in entries:
+        entry["id"] = known.get((entry["offset"], entry["length"]), entry["id"])
+    write_index(mailbox_path, entries)
+    return entries, partial
+
+def load_stored(mailbox_path, store):
+    """
+    Return (entries, partial): the entries stored in the index after
+    updating it, and the entry of an unterminated last message or None.
+    Reads only the index and the bytes appended since it was updated.
+    """
+    if not os.path.exists(mailbox_path):
+        return [], None
+    _finish_compaction(mailbox_path)
+    entries = read_index(mailbox_path)
+    found = None
+    if entries is not None:
+        found = _refresh(mailbox_path, indexed_end(entries), store)
+    if found is None:
+        return rebuild(mailbox_path, store)
+    added, partial = found
+    _append(mailbox_path, added)
+    return entries + added, partial
+
+def load_since(mailbox_path, entries, index_offset, store):
+    """
+    Like load_stored(), for a caller that kept the stored 'entries' from an
+    earlier call along with the size the index had then: only what was
+    appended to the index and the mailbox since is read. Returns None when
+    the index does not continue from 'index_offset'.
+    """
+    if _finish_compaction(mailbox_path):
+        return None
+    lines = _read_lines(mailbox_path, index_offset)
+    if lines is None:
+        return None
+    entries = _apply(entries, lines)
+    found = _refresh(mailbox_path, indexed_end(entries), store)
+    if found is None:
+        return None
+    added, partial = found
+    _append(mailbox_path, added)
+    return entries + added, partial
+
+def open_stored(mailbox_path, store):
+    """
+    Bring the index up to date and open it, so its entries can be read with
+    read_stored() after the mailbox lock is released: the lock is then held
+    for the work of finding the end of the index only, however long it is.
+    Returns (index file, index size, partial), or None without a mailbox.
+    """
+    if not os.path.exists(mailbox_path):
+        return None
+    _finish_compaction(mailbox_path)
+    last = _last_entry(mailbox_path)
+    found = None
+    if last is not None:
+        found = _refresh(mailbox_path, last.get("end", 0), store)
+    if found is None:
+        _, partial = rebuild(mailbox_path, store)
+    else:
+        added, partial = found
+        _append(mailbox_path, added)
+    f = open(index_path(mailbox_path), "rb")
+    return f, os.fstat(f.fileno()).st_size, partial
+
+def read_stored(index_file, size):
+    """
+    Return the entries in the first 'size' bytes of an index opened by
+    open_stored(), with their tombstones applied, or None when it is damaged.
+    Lines appended after 'size' bytes were read are left out.
+    """
+    try:
+        lines = [json.loads(line) for line in index_file.read(size).splitlines()]
+    except ValueError:
+        return None
+    return _apply([], lines)
+
+def load(mailbox_path, store):
+    """
+    Return the entries of every message in the mailbox, updating the index
+    first. Reads only the index and the bytes appended since it was updated.
+    """
+    entries, partial = load_stored(mailbox_path, store)
+    return entries + [partial] if partial else entries
+
+def indexed_end(entries):
+    """
+    Return how many bytes of the mailbox the stored 'entries' cover.
+    """
+    for entry in reversed(entries):
+        if entry["end"] is not None:
+            return entry["end"]
+    return 0
+
+def delete(mailbox_path, ids, store):
+    """
+    Mark the messages with the given ids as deleted by appending tombstones,
+    without reading the index or the mailbox.
+    """
+    _finish_compaction(mailbox_path)
+    last = _last_entry(mailbox_path)
+    if last is None:
+        load(mailbox_path, store)
+        last = _last_entry(mailbox_path) or {}
+    end = last.get("end", 0)
+    _append(mailbox_path, [{"deleted": entry_id, "end": end} for entry_id in ids])
+
+def _copy(src, dst, offset, length):
+    src.seek(offset)
+    while length > 0:
+        block = src.read(min(length, COPY_BLOCK))
+        if not block:
+            break
+        dst.write(block)
+        length -= len(block)
+
+def _fsync_directory(path):
+    if os.name == "nt":
+        return
+    fd = os.open(os.path.dirname(path) or ".", os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def compact(mailbox_path, store, min_bytes=COMPACT_MIN_BYTES, ratio=COMPACT_RATIO):
+    """
+    Rewrite the mailbox without its deleted messages once they take up at
+    least 'min_bytes' and 'ratio' of it, and release their blobs. Returns
+    True when the mailbox was compacted.
+
+    The live messages are copied to a new file without holding the mailbox
+    lock, so deliveries go on meanwhile. The lock is only taken again to copy
+    what was appended during the copy, carry over deletions made during it
+    and swap in the new mailbox and index. Sessions that opened the old
+    mailbox keep reading it through their open file.
+    """
+    # One compaction per mailbox at a time, also across processes
+    with locking.file_lock(mailbox_path + ".compact.lock"):
+        with locking.mailbox_lock(mailbox_path):
+            entries = [entry for entry in load(mailbox_path, store) if entry["end"] is not None]
+        end = indexed_end(entries)
+        garbage = sum(entry["end"] - entry["offset"] for entry in entries if entry["deleted"])
+        if not garbage or garbage < min_bytes or garbage < ratio * end:
+            return False
+
+        tmp_path = mailbox_path + COMPACT_SUFFIX
+        kept = []
+        with open(mailbox_path, "rb") as src, open(tmp_path, "wb") as dst:
+            for entry in entries:
+                if entry["deleted"]:
+                    continue
+                offset = dst.tell()
+                _copy(src, dst, entry["offset"], entry["length"])
+                dst.write(b"\n\n")
+                kept.append(dict(entry, offset=offset, end=dst.tell()))
+            # Flushed before taking the lock, which then waits on the tail only
+            dst.flush()
+            os.fsync(dst.fileno())
+
+            with locking.mailbox_lock(mailbox_path):
+                current = {entry["id"]: entry for entry in load(mailbox_path, store)}
+                if any(entry["id"] not in current for entry in kept):
+                    # The index was rebuilt meanwhile; try again another time.
+                    os.remove(tmp_path)
+                    return False
+                for entry in kept:
+                    entry["deleted"] = current[entry["id"]]["deleted"]
+                # Mail delivered during the copy moves along with its raw bytes.
+                shift = dst.tell() - end
+                size = os.path.getsize(mailbox_path)
+                _copy(src, dst, end, size - end)
+                for entry in current.values():
+                    if entry["end"] is not None and entry["offset"] >= end:
+                        kept.append(dict(entry, offset=entry["offset"] + shift, end=entry["end"] + shift))
+                dst.flush()
+                os.fsync(dst.fileno())
+                # The new index is on disk before the mailbox is swapped and
+                # renamed right after it; _finish_compaction() does the
+                # rename when a crash came in between.
+                index_tmp = index_path(mailbox_path) + COMPACT_SUFFIX
+                _write_entries(index_tmp, kept)
+                os.replace(tmp_path, mailbox_path)
+                os.replace(index_tmp, index_path(mailbox_path))
+                _fsync_directory(mailbox_path)
+
+    print(f"Compacted {mailbox_path}, {garbage} bytes reclaimed")
+    for entry in entries:
+        if entry["deleted"] and entry["blob"] is not None:
+            store.release(entry["blob"])
+    return True
+
+def update(mailbox_path, store):
+    """
+    Index the messages appended to the mailbox since the last update, as
+    SMTP delivery does after every append. Returns the entries added, or
+    None when the index had to be rebuilt.
+    """
+    _finish_compaction(mailbox_path)
+    last = _last_entry(mailbox_path)
+    found = None
+    if last is not None:
+        found = _refresh(mailbox_path, last.get("end", 0), store)
+    if found is None:
+        rebuild(mailbox_path, store)
+        return None
+    _append(mailbox_path, found[0])
+    return found[0]
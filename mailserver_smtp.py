@@ -1,21 +1,100 @@
 import argparse
-import socket
+import asyncio
+import io
+import ipaddress
+import itertools
 import os
-import threading
+import re
+import tempfile
 
-# Sample user list (for VRFY command)
-users = [("lander", "lander@email.com"),
-         ("robbe", "robbe@email.com")]
+import admission
+import compression
+import delivery
+import framing
+import message_store
+import relay
+import search_index
+import serving
+import storage
+import user_directory
+
+# Bodies of mail for several local recipients are stored once in here
+blobStore = message_store.BlobStore()
+# Maildrops of the local accounts; the backend is chosen with --storage
+mailStorage = storage.MboxStorage(blobStore)
+
+# Queue accepted mail goes through; set up by main(), mail is written inline without it
+deliveryQueue = None
+
+# Queue for mail to remote recipients; None unless relaying is enabled
+relayQueue = None
+# Client networks allowed to relay mail to remote recipients
+relayClients = []
+
+# Seconds a session may wait for its next command (RFC 5321 suggests 5 minutes)
+IDLE_TIMEOUT = 300.0
+idleTimeout = IDLE_TIMEOUT
+commandTimeout = admission.COMMAND_TIMEOUT
+# Messages accepted per client address
+messageLimiter = admission.RateLimiter(admission.MESSAGE_RATE, admission.MESSAGE_BURST)
+
+# Local accounts (for VRFY and RCPT TO), reloaded when userinfo.txt changes
+users = user_directory.UserDirectory()
+
+def findTerminator(data):
+    """
+    Return (offset, length) of the first end-of-data sequence in data, or None.
+    """
+    lf = data.find(b"\n.\n")
+    crlf = data.find(b"\n.\r\n")
+    if crlf >= 0 and (lf < 0 or crlf < lf):
+        return crlf, 4
+    if lf >= 0:
+        return lf, 3
+    return None
 
 class Mail:
+    # Bodies larger than this many bytes are spooled to a temporary file
+    spoolThreshold = 1024 * 1024
+    # Header lines are only looked for within this many leading bytes
+    maxHeaderSize = 64 * 1024
+
     def __init__(self, sender):
         self.sender = sender
         self.rcpts = []
         self.receivedDataCMD = False
-        self.body = ""
         self.bodyComplete = False
         self.time = ""
         self.subject = ""
+        # Received DATA (with CRLF turned into LF) as a list of chunks, or in
+        # 'spool' once it outgrew spoolThreshold.
+        self.chunks = []
+        self.spool = None
+        self.size = 0
+        self.bodyLength = 0
+        # Last raw bytes seen, so an end-of-data line split over two chunks is
+        # still found. It starts with the newline that ended the DATA command.
+        # With BDAT it is the last byte stored instead.
+        self.tail = b"\n"
+        self.pendingCR = b""
+        # Whether the next DATA byte starts a line, whose leading "." the
+        # client added for transparency (RFC 5321 4.5.2)
+        self.lineStart = True
+        # Header lines, parsed once up to the first blank or non-header line.
+        self.headers = []
+        self.headerLength = 0
+        self.headerBuf = bytearray()
+        # Size of the BDAT chunk being received, None outside of one.
+        self.chunkSize = None
+        self.lastChunk = False
+        self.chunked = False
+        # Delivery progress, kept so a retried delivery skips what succeeded:
+        # the recipients written, whether the relay took the remote ones, the
+        # shared blob and every path written so far.
+        self.deliveredTo = set()
+        self.relayed = False
+        self.blob = None
+        self.writtenPaths = []
 
     def __str__(self):
         msg = "From: " + self.sender + "\n"
@@ -24,20 +103,73 @@ class Mail:
         msg += self.body + "\n"
         return msg
 
+    @property
+    def body(self):
+        return b"".join(self.iterRaw(0, self.bodyLength)).decode(errors="replace")
+
+    def writeTo(self, file, mail, blob=None):
+        """
+        Write the copy of this mail for recipient 'mail' to a binary file:
+        its own From/To lines, the received headers except From/To, the body
+        and a blank separator line. With 'blob' the body is replaced by a
+        reference to that blob.
+        """
+        file.write(f"From: {self.sender}\nTo: {mail}\n".encode())
+        for line in self.headers:
+            if not re.match(rb"(?i)(from|to):", line):
+                file.write(line)
+        if blob is not None:
+            if self.headers and not self.headers[-1].endswith(b"\n"):
+                file.write(b"\n")
+            file.write(f"{message_store.REF_HEADER}{blob}\n\n".encode())
+            return
+        for chunk in self.iterRaw(self.headerLength, self.bodyLength):
+            file.write(chunk)
+        file.write(b"\n\n")
+
+    def iterBody(self):
+        """
+        Yield the body below the headers as it is stored in a blob.
+        """
+        yield from self.iterRaw(self.headerLength, self.bodyLength)
+        yield b"\n"
+
     def toString(self, mail):
         if mail not in self.rcpts:
             print("ERROR: mailadress not in recipientslist")
             return ""
-        newBody = ""
-        splitBody = self.body.split("\n")
-        for elem in splitBody:
-            if "From: " in elem or "To: " in elem:
-                continue
-            newBody += elem + "\n"
-        msg = "From: " + self.sender + "\n"
-        msg += "To: " + mail + "\n"
-        msg += newBody + "\n"
-        return msg
+        out = io.BytesIO()
+        self.writeTo(out, mail)
+        return out.getvalue().decode(errors="replace")
+
+    def iterRaw(self, start, stop, blockSize=64 * 1024):
+        """
+        Yield the stored DATA bytes in [start, stop) without joining them.
+        """
+        if self.spool is not None:
+            self.spool.seek(start)
+            while start < stop:
+                block = self.spool.read(min(blockSize, stop - start))
+                if not block:
+                    break
+                start += len(block)
+                yield block
+            return
+        offset = 0
+        for chunk in self.chunks:
+            end = offset + len(chunk)
+            if end > start and offset < stop:
+                yield chunk[max(start - offset, 0):min(stop, end) - offset]
+            offset = end
+
+    def close(self):
+        """
+        Release the spool file, if any.
+        """
+        if self.spool is not None:
+            self.spool.close()
+            self.spool = None
+        self.chunks = []
 
     def addRcpt(self, rcpt):
         if rcpt in self.rcpts or self.receivedDataCMD:
@@ -47,31 +179,245 @@ class Mail:
     def startReceivingData(self):
         self.receivedDataCMD = True
 
-    def appendToBody(self, msg):
-        self.body += msg
-        chunks = msg.split("\n")
-        # Filter metadata to extract subject.
-        for chunk in chunks:
-            if "Subject: " in chunk:
-                self.subject = chunk[len("Subject: "):]
-        if self.body[-3:] == "\n.\n":
-            self.bodyComplete = True
-            self.body = self.body[:-3]
-            return True
-        return False
+    def startChunk(self, size, last):
+        """
+        Expect a BDAT chunk of 'size' bytes, the final one when 'last' is set.
+        """
+        if not self.chunked:
+            self.chunked = True
+            self.tail = b""
+        self.chunkSize = size
+        self.lastChunk = last
+
+    def appendChunk(self, data):
+        """
+        Append part of a BDAT chunk with CRLF turned into LF, as DATA is
+        stored; unlike DATA there is no end-of-data line to look for.
+        """
+        kept = self.store(bytes(data), final=False)
+        if kept:
+            self.tail = kept[-1:]
+
+    def endChunk(self):
+        """
+        Close the current BDAT chunk. Returns True when it completed the mail.
+        """
+        self.chunkSize = None
+        if not self.lastChunk:
+            return False
+        self.bodyComplete = True
+        # A CR held back in case an LF followed in the next chunk is data.
+        if self.pendingCR:
+            self.tail = self.pendingCR
+            self.pendingCR = b""
+            self.keep(self.tail)
+        # As with DATA, the newline ending the last line is not part of the body.
+        self.bodyLength = self.size - 1 if self.tail == b"\n" else self.size
+        self.finishHeaders()
+        return True
+
+    def appendToBody(self, data):
+        """
+        Append raw DATA bytes and look for the end-of-data line ("." alone).
+        Only the few bytes kept in 'tail' are searched again, so a message is
+        accepted in time linear to its size.
+        Returns the number of bytes used; anything after the terminator is
+        left to the caller as the next command.
+        """
+        raw = bytes(data)
+        found = findTerminator(self.tail + raw[:3])
+        if not found or found[0] >= len(self.tail):
+            found = findTerminator(raw)
+            shift = 0
+        else:
+            shift = len(self.tail)
+        if not found:
+            self.tail = (self.tail + raw[-3:])[-3:]
+            self.store(self.unstuff(raw), final=False)
+            return len(raw)
+        used = found[0] + found[1] - shift
+        self.store(self.unstuff(raw[:used]), final=True)
+        self.bodyComplete = True
+        # Stored data now ends with the newline of the last line and what is
+        # left of the end-of-data line, "\n"; the body stops before both.
+        self.bodyLength = max(self.size - 2, 0)
+        self.finishHeaders()
+        return used
+
+    def unstuff(self, raw):
+        """
+        Drop the "." a client puts before every DATA line starting with one,
+        including the end-of-data line. Line starts are followed across chunks.
+        """
+        if not raw:
+            return raw
+        lineStart, self.lineStart = self.lineStart, raw.endswith(b"\n")
+        if lineStart and raw.startswith(b"."):
+            raw = raw[1:]
+        return raw.replace(b"\n.", b"\n")
+
+    def store(self, raw, final):
+        """
+        Keep a chunk of raw DATA, turning CRLF into LF even when the pair is
+        split between chunks. Returns the bytes kept.
+        """
+        raw = self.pendingCR + raw
+        self.pendingCR = b""
+        if raw.endswith(b"\r") and not final:
+            self.pendingCR = b"\r"
+            raw = raw[:-1]
+        raw = raw.replace(b"\r\n", b"\n")
+        if not raw:
+            return raw
+        if self.headerBuf is not None:
+            self.parseHeaders(raw[:self.maxHeaderSize])
+        self.keep(raw)
+        return raw
+
+    def keep(self, data):
+        """
+        Add bytes to the stored data, in memory or in the spool file.
+        """
+        self.size += len(data)
+        if self.spool is not None:
+            self.spool.write(data)
+            return
+        self.chunks.append(bytes(data))
+        if self.size > self.spoolThreshold:
+            self.spool = tempfile.TemporaryFile()
+            for chunk in self.chunks:
+                self.spool.write(chunk)
+            self.chunks = []
+
+    def parseHeaders(self, raw):
+        """
+        Collect complete header lines from the start of the data. Parsing
+        stops for good at the first blank or non-header line.
+        """
+        self.headerBuf += raw
+        pos = 0
+        while True:
+            newline = self.headerBuf.find(b"\n", pos)
+            if newline < 0:
+                if len(self.headerBuf) - pos + self.headerLength > self.maxHeaderSize:
+                    self.headerBuf = None
+                else:
+                    del self.headerBuf[:pos]
+                return
+            line = bytes(self.headerBuf[pos:newline + 1])
+            if not message_store.HEADER_LINE.match(line) or (line[:1] in b" \t" and not self.headers):
+                self.headerBuf = None
+                return
+            self.headers.append(line)
+            self.headerLength += len(line)
+            if line.lower().startswith(b"subject: "):
+                self.subject = line[len("Subject: "):].decode(errors="replace").rstrip("\r\n")
+            pos = newline + 1
+
+    def finishHeaders(self):
+        """
+        Settle the header section once the end-of-data line has arrived.
+        """
+        self.headerBuf = None
+        # The newline before the terminator does not belong to the message.
+        if self.headerLength > self.bodyLength:
+            self.headers[-1] = self.headers[-1][:-1]
+            self.headerLength = self.bodyLength
+
+class RejectedChunk:
+    """
+    A refused BDAT command. Its 'size' bytes of data follow all the same and
+    are read and dropped before 'reply' is sent; the session then goes on
+    with 'mail', the mail it was receiving before.
+    """
+    def __init__(self, size, reply, mail):
+        self.size = size
+        self.reply = reply
+        self.mail = mail
+
+def dropChunk(data):
+    pass
 
 def send(connection, msg):
     connection.sendall(msg.encode())
     print("Server:", msg)
 
+def isRemote(address):
+    domain = address.rpartition("@")[2].lower()
+    return bool(domain) and domain != users.domain
+
+def mayRelay(connection):
+    """
+    Tell whether the client on 'connection' may send mail to remote recipients.
+    """
+    if relayQueue is None:
+        return False
+    address = ipaddress.ip_address(connection.getpeername()[0])
+    return any(address in network for network in relayClients)
+
 def writeMailOnDisk(mail):
+    """
+    Store the mail in every recipient's maildrop and return the paths
+    written. A body shared by several mailboxes is stored once as a blob.
+    When called again after a failure, recipients already written and a
+    relay already queued are skipped; the mail is left open for that retry.
+    """
+    targets = []
+    remote = []
     for rcpt in mail.rcpts:
-        name = rcpt[:rcpt.find("@")]
-        if os.path.exists(name):
-            with open(os.path.join(name, "my_mailbox"), "a") as file:
-                file.write(mail.toString(rcpt))
+        user = users.by_address(rcpt)
+        if user:
+            targets.append((rcpt, user.name))
+        elif relayQueue is not None and isRemote(rcpt):
+            remote.append(rcpt)
         else:
-            print(f"ERROR: directory {name} not found")
+            print(f"ERROR: no mailbox for {rcpt}")
+    if remote and not mail.relayed:
+        mail.writtenPaths += relayQueue.enqueue(mail.sender, remote, mail.iterRaw(0, mail.bodyLength))
+        mail.relayed = True
+    if mail.blob is None and len(targets) > 1 and mail.bodyLength > mail.headerLength:
+        mail.blob = blobStore.put(mail.iterBody(), len(targets))
+    pending = [(rcpt, username) for rcpt, username in targets if rcpt not in mail.deliveredTo]
+    # The search index gets the words of the mail, read once for every copy.
+    words = search_index.words(mail.iterRaw(0, mail.bodyLength)) if pending else None
+    for rcpt, username in pending:
+        rcptWords = words | search_index.words([f"{mail.sender} {rcpt}".encode()])
+        mail.writtenPaths += mailStorage.deliver(username, lambda file: mail.writeTo(file, rcpt, mail.blob),
+                                                 rcptWords)
+        mail.deliveredTo.add(rcpt)
+    return list(mail.writtenPaths)
+
+def restoreMail(meta, payload):
+    """
+    Rebuild a mail from its delivery journal record.
+    """
+    mail = Mail(meta["sender"])
+    for rcpt in meta["rcpts"]:
+        mail.addRcpt(rcpt)
+    # Records hold the body as stored plus a newline; older ones, the bytes a
+    # BDAT mail stored, or DATA still with its dots and end-of-data line.
+    if meta.get("chunked") or meta.get("stored"):
+        mail.startChunk(len(payload), True)
+        mail.appendChunk(payload)
+        mail.endChunk()
+    else:
+        mail.startReceivingData()
+        mail.appendToBody(payload)
+    return mail
+
+def queueMail(mail):
+    """
+    Hand a completed mail to the delivery queue; returns once it is durable.
+    """
+    if deliveryQueue is None:
+        try:
+            writeMailOnDisk(mail)
+        finally:
+            mail.close()
+        return
+    meta = {"sender": mail.sender, "rcpts": mail.rcpts, "stored": True}
+    chunks = itertools.chain(mail.iterRaw(0, mail.bodyLength), [b"\n"])
+    deliveryQueue.submit(meta, mail.bodyLength + 1, chunks, mail)
 
 def handleCommand(connection, data, receivingMail):
     """
@@ -84,8 +430,15 @@ def handleCommand(connection, data, receivingMail):
         send(connection, "250 OK")
         return True, receivingMail
 
+    if cmd == "EHLO" or cmd.startswith("EHLO "):
+        send(connection, "250-localhost\n250 CHUNKING")
+        return True, receivingMail
+
     if "MAIL FROM: <" in cmd:
         mail_addr = cmd[len("MAIL FROM: <"):-1]
+        if not messageLimiter.allow(connection.getpeername()[0]):
+            send(connection, "450 Too many messages, try again later")
+            return True, receivingMail
         if "@" in mail_addr:
             send(connection, "250 OK")
             receivingMail = Mail(mail_addr)
@@ -104,85 +457,293 @@ def handleCommand(connection, data, receivingMail):
         return False, receivingMail
 
     if "VRFY " in cmd:
-        user = cmd[len("VRFY "):]
-        for i in range(len(users)):
-            if user == users[i][0] or user == users[i][1]:
-                name = users[i][0]
-                mail_addr = users[i][1]
-                send(connection, f"250 {name} {mail_addr}")
-                return True, receivingMail
-        send(connection, "550 No such user here")
+        user = users.lookup(cmd[len("VRFY "):])
+        if user:
+            send(connection, f"250 {user.name} {user.address}")
+        else:
+            send(connection, "550 No such user here")
         return True, receivingMail
 
     if cmd == "NOOP":
         send(connection, "250 OK")
         return True, receivingMail
 
+    if cmd.startswith("BDAT "):
+        parts = cmd.split()
+        if not parts[1:] or not parts[1].isdigit():
+            # Without a size the data cannot be told apart from commands.
+            send(connection, "501 Syntax: BDAT <size> [LAST]")
+            return True, receivingMail
+        size = int(parts[1])
+        if len(parts) > 3 or parts[2:] not in ([], ["LAST"]):
+            receivingMail = RejectedChunk(size, "501 Syntax: BDAT <size> [LAST]", receivingMail)
+        elif not receivingMail:
+            receivingMail = RejectedChunk(size, "500 unknown command", receivingMail)
+        elif receivingMail.receivedDataCMD:
+            receivingMail = RejectedChunk(size, "503 BDAT not allowed after DATA", receivingMail)
+        else:
+            receivingMail.startChunk(size, len(parts) == 3)
+        return True, receivingMail
+
     if not receivingMail:
         send(connection, "500 unknown command")
         return True, receivingMail
 
     if "RCPT TO: <" in cmd:
         mail_addr = cmd[len("RCPT TO: <"):-1]
-        if mail_addr in [user[1] for user in users]:
+        if users.by_address(mail_addr):
             receivingMail.addRcpt(mail_addr)
             send(connection, "250 OK")
+        elif isRemote(mail_addr) and mayRelay(connection):
+            receivingMail.addRcpt(mail_addr)
+            send(connection, "250 OK, will relay")
         else:
             send(connection, "550 No such user here")
         return True, receivingMail
 
     if cmd == "DATA":
+        if receivingMail.chunked:
+            send(connection, "503 DATA not allowed after BDAT")
+            return True, receivingMail
         receivingMail.startReceivingData()
         send(connection, "354 Start mail input; end with <CRLF>.<CRLF>")
         return True, receivingMail
 
-    if receivingMail.receivedDataCMD:
-        if receivingMail.appendToBody(data):
-            send(connection, "250 OK, message accepted for delivery")
-            writeMailOnDisk(receivingMail)
-            receivingMail = None
-        else:
-            send(connection, "200 OK, received correctly")
-        return True, receivingMail
-
     return True, receivingMail
 
+def timedOut(connection, client_address):
+    print(f"Connection with {client_address} timed out.")
+    try:
+        send(connection, "421 Timeout, closing connection")
+    except OSError:
+        pass
+
 def client_thread(connection, client_address):
     receivingMail = None  # Local variable for each connection
+    reader = framing.LineReader(connection, idle_timeout=idleTimeout, command_timeout=commandTimeout)
     try:
         run = True
         while run:
-            data = connection.recv(1024)
+            if isinstance(receivingMail, RejectedChunk):
+                rejected = receivingMail
+                if reader.read_into(rejected.size, dropChunk) < rejected.size:
+                    print("No data received. Closing connection.")
+                    break
+                send(connection, rejected.reply)
+                receivingMail = rejected.mail
+                continue
+            if receivingMail and receivingMail.chunkSize is not None:
+                size = receivingMail.chunkSize
+                if reader.read_into(size, receivingMail.appendChunk) < size:
+                    print("No data received. Closing connection.")
+                    break
+                if receivingMail.endChunk():
+                    queueMail(receivingMail)
+                    send(connection, "250 OK, message accepted for delivery")
+                    receivingMail = None
+                else:
+                    send(connection, f"250 {size} octets received")
+                continue
+            if receivingMail and receivingMail.receivedDataCMD:
+                chunk = reader.read_some()
+                if not chunk:
+                    print("No data received. Closing connection.")
+                    break
+                reader.buffer.consume(receivingMail.appendToBody(chunk))
+                if receivingMail.bodyComplete:
+                    queueMail(receivingMail)
+                    send(connection, "250 OK, message accepted for delivery")
+                    receivingMail = None
+                continue
+            data = reader.readline()
             if data:
-                decoded = data.decode()
+                decoded = data.decode(errors="replace")
                 print("Received data:", repr(decoded))
                 run, receivingMail = handleCommand(connection, decoded, receivingMail)
             else:
                 print("No data received. Closing connection.")
                 break
+    except TimeoutError:
+        timedOut(connection, client_address)
     finally:
         connection.close()
         print(f"Connection with {client_address} closed.")
 
+# ---------------------------
+# asyncio engine
+# ---------------------------
+class StreamConnection:
+    """
+    Give an asyncio StreamWriter the sendall() interface used by handleCommand.
+    Writes are buffered by the transport and flushed by the session's drain().
+    """
+    def __init__(self, writer):
+        self.writer = writer
+
+    def sendall(self, data):
+        self.writer.write(data)
+
+    def getpeername(self):
+        return self.writer.get_extra_info("peername")
+
+async def client_session(reader, writer):
+    client_address = writer.get_extra_info("peername")
+    print(f"Connection from {client_address} has been established.")
+    connection = StreamConnection(writer)
+    loop = asyncio.get_running_loop()
+    receivingMail = None  # Local variable for each connection
+    reader = framing.AsyncLineReader(reader, idle_timeout=idleTimeout, command_timeout=commandTimeout)
+    try:
+        run = True
+        while run:
+            if isinstance(receivingMail, RejectedChunk):
+                rejected = receivingMail
+                if await reader.read_into(rejected.size, dropChunk) < rejected.size:
+                    print("No data received. Closing connection.")
+                    break
+                send(connection, rejected.reply)
+                receivingMail = rejected.mail
+                await writer.drain()
+                continue
+            if receivingMail and receivingMail.chunkSize is not None:
+                size = receivingMail.chunkSize
+                if await reader.read_into(size, receivingMail.appendChunk) < size:
+                    print("No data received. Closing connection.")
+                    break
+                if receivingMail.endChunk():
+                    await loop.run_in_executor(None, queueMail, receivingMail)
+                    send(connection, "250 OK, message accepted for delivery")
+                    receivingMail = None
+                else:
+                    send(connection, f"250 {size} octets received")
+                await writer.drain()
+                continue
+            if receivingMail and receivingMail.receivedDataCMD:
+                chunk = await reader.read_some()
+                if not chunk:
+                    print("No data received. Closing connection.")
+                    break
+                reader.buffer.consume(receivingMail.appendToBody(chunk))
+                if receivingMail.bodyComplete:
+                    await loop.run_in_executor(None, queueMail, receivingMail)
+                    send(connection, "250 OK, message accepted for delivery")
+                    receivingMail = None
+                    await writer.drain()
+                continue
+            data = await reader.readline()
+            if data:
+                decoded = data.decode(errors="replace")
+                print("Received data:", repr(decoded))
+                run, receivingMail = handleCommand(connection, decoded, receivingMail)
+                await writer.drain()
+            else:
+                print("No data received. Closing connection.")
+                break
+    except TimeoutError:
+        timedOut(connection, client_address)
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+        print(f"Connection with {client_address} closed.")
+
+def adoptQueues(queueDir, suffixes):
+    """
+    Merge the delivery journals and relay queues in 'queueDir' that no
+    process of this run uses, such as those of workers a run with fewer
+    --workers no longer starts, into the first ones used. 'suffixes' are
+    the suffixes of the journals and queues in use.
+    """
+    if not os.path.isdir(queueDir):
+        return
+    inUse = {base + suffix for base in ("journal", "outbound") for suffix in suffixes}
+    for name in sorted(os.listdir(queueDir)):
+        base, dot, number = name.partition(".")
+        if name in inUse or base not in ("journal", "outbound") or dot and not number.isdigit():
+            continue
+        source = os.path.join(queueDir, name)
+        target = os.path.join(queueDir, base + suffixes[0])
+        if base == "journal":
+            count = delivery.merge_journal(source, target)
+        else:
+            count = relay.merge_queue(source, target)
+        print(f"Merged {count} queued mails from {source} into {target}")
+
+def startServer(sock, args, index=None):
+    """
+    Set up the delivery and relay queues and serve connections on 'sock'
+    until shut down. Worker processes each get their own journal and relay
+    queue, numbered by 'index'; adoptQueues() hands theirs on when a later
+    run starts fewer workers.
+    """
+    global deliveryQueue, relayQueue, mailStorage
+    mailStorage = storage.open_storage(args.storage, blobStore, compression=args.compress)
+    suffix = "" if index is None else f".{index}"
+    if args.relay:
+        relayQueue = relay.OutboundQueue(os.path.join(args.queue_dir, "outbound" + suffix), args.relay_host,
+                                         retry_base=args.relay_retry)
+    journal = "journal" + suffix
+    deliveryQueue = delivery.DeliveryQueue(os.path.join(args.queue_dir, journal), writeMailOnDisk, restoreMail,
+                                           args.commit_window, args.delivery_workers, release=Mail.close)
+    limits = admission.from_arguments(args, b"421 Too many connections, try again later")
+    if args.mode == 'asyncio':
+        serving.run_asyncio(client_session, sock, limits)
+    else:
+        serving.run_threaded(client_thread, sock, limits)
+    deliveryQueue.drain(serving.SHUTDOWN_GRACE)
+    if relayQueue is not None:
+        relayQueue.close()
+
 def main():
     parser = argparse.ArgumentParser(description="Start a TCP server that listens for connections on a specified port.")
     parser.add_argument('port', type=int, help='An integer for the port number')
+    parser.add_argument('--mode', choices=['threaded', 'asyncio'], default='threaded',
+                        help='Serve every session on its own thread (default) or on one asyncio event loop')
+    parser.add_argument('--spool-threshold', type=int, default=Mail.spoolThreshold,
+                        help='Message size in bytes above which DATA is spooled to a temporary file')
+    parser.add_argument('--storage', choices=sorted(storage.BACKENDS), default='mbox',
+                        help='How maildrops are stored; must match the POP3 server')
+    parser.add_argument('--compress', choices=compression.CODECS,
+                        help='Store new mail compressed with this codec (Maildir storage only)')
+    parser.add_argument('--queue-dir', default='queue', help='Directory holding the delivery journal and the relay queue')
+    parser.add_argument('--commit-window', type=float, default=delivery.COMMIT_WINDOW,
+                        help='Seconds accepted mails wait to share one journal fsync')
+    parser.add_argument('--delivery-workers', type=int, default=delivery.WORKERS,
+                        help='Number of threads appending mail to mailboxes')
+    parser.add_argument('--userinfo', default=user_directory.USERINFO_FILE, help='File listing the local accounts')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of worker processes sharing the port (each runs the chosen mode)')
+    admission.add_arguments(parser, IDLE_TIMEOUT)
+    parser.add_argument('--message-rate', type=float, default=admission.MESSAGE_RATE,
+                        help='Messages per second accepted from one client address (0 disables)')
+    parser.add_argument('--relay', action='store_true',
+                        help='Accept mail for remote recipients from --relay-clients and forward it')
+    parser.add_argument('--relay-clients', default='127.0.0.0/8,::1/128',
+                        help='Comma-separated client networks allowed to relay')
+    parser.add_argument('--relay-host', help='Send all remote mail to this HOST[:PORT] instead of the domain itself')
+    parser.add_argument('--relay-retry', type=float, default=relay.RETRY_BASE,
+                        help='Seconds before the first retry of a failed relay, doubled for every next one')
     args = parser.parse_args()
+    if args.compress and args.storage != 'maildir':
+        parser.error("--compress needs --storage maildir")
+    Mail.spoolThreshold = args.spool_threshold
+    users.path = args.userinfo
+
+    global idleTimeout, commandTimeout, messageLimiter, relayClients
+    relayClients = [ipaddress.ip_network(network.strip()) for network in args.relay_clients.split(",") if network.strip()]
+    idleTimeout = args.idle_timeout
+    commandTimeout = args.command_timeout
+    messageLimiter = admission.RateLimiter(args.message_rate, admission.MESSAGE_BURST)
+
+    # Before any worker opens its journal, so mail left in others is replayed
+    adoptQueues(args.queue_dir, [f".{index}" for index in range(args.workers)] if args.workers > 1 else [""])
 
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_address = ('localhost', args.port)
     print(f"Starting up on {server_address[0]} port {server_address[1]}")
-    server_socket.bind(server_address)
-    server_socket.listen(5)
-    print("Waiting for connections...")
-
-    try:
-        while True:
-            connection, client_address = server_socket.accept()
-            print(f"Connection from {client_address} has been established.")
-            threading.Thread(target=client_thread, args=(connection, client_address)).start()
-    finally:
-        server_socket.close()
+    if args.workers > 1:
+        serving.run_workers(args.workers, lambda sock, index: startServer(sock, args, index), server_address)
+    else:
+        startServer(serving.make_listener(server_address), args)
 
 if __name__ == '__main__':
     import threading
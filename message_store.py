@@ -0,0 +1,146 @@
+"""
+Single-instance store for message bodies.
+
+A mail for several local recipients has its body written once, under the
+SHA-256 of its content, in BLOB_DIR. Each mailbox then holds only the
+recipient's header lines followed by a reference line:
+
+  X-Blob: <sha256>
+
+Every blob has a reference count kept next to it; it is raised for every
+mailbox that refers to the blob and lowered when a POP3 session deletes one
+of those messages, and the blob is removed when it reaches zero.
+"""
+import hashlib
+import os
+import re
+import tempfile
+
+from locking import file_lock
+
+BLOB_DIR = "blobs"
+REF_HEADER = "X-Blob: "
+# Header lines are "Name: value" or folded continuations of the previous one
+HEADER_LINE = re.compile(rb"[!-9;-~]+:|[ \t]")
+
+
+class BlobStore:
+    def __init__(self, root=BLOB_DIR):
+        self.root = root
+
+    def _path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def _lock(self):
+        os.makedirs(self.root, exist_ok=True)
+        return file_lock(os.path.join(self.root, ".lock"))
+
+    def _read_refs(self, digest):
+        try:
+            with open(self._path(digest) + ".refs") as f:
+                return int(f.read())
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def _write_refs(self, digest, count):
+        tmp_path = self._path(digest) + ".refs.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(f"{count}\n")
+        os.replace(tmp_path, self._path(digest) + ".refs")
+
+    def put(self, chunks, refs):
+        """
+        Store the bytes yielded by 'chunks' with 'refs' references and return
+        their digest. Content already stored only gains the references.
+        """
+        os.makedirs(self.root, exist_ok=True)
+        digest = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix=".put-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in chunks:
+                    digest.update(chunk)
+                    f.write(chunk)
+            digest = digest.hexdigest()
+            with self._lock():
+                if os.path.exists(self._path(digest)):
+                    os.unlink(tmp_path)
+                else:
+                    os.makedirs(os.path.dirname(self._path(digest)), exist_ok=True)
+                    os.replace(tmp_path, self._path(digest))
+                self._write_refs(digest, self._read_refs(digest) + refs)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        return digest
+
+    def open(self, digest):
+        return open(self._path(digest), "rb")
+
+    def size(self, digest):
+        return os.path.getsize(self._path(digest))
+
+    def release(self, digest, refs=1):
+        """
+        Drop references to a blob, deleting it once none are left.
+        """
+        with self._lock():
+            count = self._read_refs(digest) - refs
+            if count > 0:
+                self._write_refs(digest, count)
+                return
+            for path in (self._path(digest), self._path(digest) + ".refs"):
+                if os.path.exists(path):
+                    os.unlink(path)
+
+
+def blob_reference(msg):
+    """
+    Return (header text, digest) for a stored message ending in a blob
+    reference, or (msg, None) for a message stored inline.
+    """
+    head, _, last = msg.rpartition("\n")
+    if last.startswith(REF_HEADER):
+        return head, last[len(REF_HEADER):].strip()
+    return msg, None
+
+def expand_message(msg, store):
+    """
+    Return the full text of a stored message, reading its body from the blob
+    store when the mailbox only holds a reference.
+    """
+    head, digest = blob_reference(msg)
+    if digest is None:
+        return msg
+    with store.open(digest) as f:
+        body = f.read().decode(errors="replace")
+    return (head + "\n" + body).strip()
+
+def header_length(raw):
+    """
+    Return how many bytes of the stored message 'raw' are header lines,
+    newline after the last one included. A blob reference is not counted:
+    what follows the headers is then the blob body.
+    """
+    length = 0
+    for line in raw.splitlines(keepends=True):
+        if not HEADER_LINE.match(line) or (line[:1] in b" \t" and not length):
+            break
+        if line.startswith(REF_HEADER.encode()):
+            break
+        length += len(line)
+    return length
+
+def message_size(msg, store):
+    """
+    Return the size in bytes of the full message without reading its blob.
+    """
+    head, digest = blob_reference(msg)
+    if digest is None:
+        return len(msg.encode())
+    try:
+        # The newline joining header and body replaces the stripped final one.
+        return len(head.encode()) + store.size(digest)
+    except FileNotFoundError:
+        return len(head.encode())
@@ -0,0 +1,107 @@
+"""
+Convert mbox maildrops ('<user>/my_mailbox') to compressed Maildirs.
+
+Every message is copied into '<user>/Maildir' compressed with the chosen
+codec, zlib against a dictionary trained from the mailbox itself unless
+--no-dictionary is given, after which the mailbox is renamed to
+'my_mailbox.migrated' and its index removed. Mail already in the Maildir
+stays there.
+
+Run it with both servers stopped, then start them with --storage maildir,
+and the SMTP server with --compress to keep new mail compressed:
+
+  python migrate_mailbox.py --codec zlib
+  python migrate_mailbox.py --codec lzma lander robbe
+"""
+import argparse
+import os
+
+import compression
+import mailbox_index
+import message_store
+import storage
+import user_directory
+
+# Bytes copied at a time
+COPY_BLOCK = 1024 * 1024
+
+
+def copy_range(f, start, stop):
+    """
+    Return a write function for MaildirStorage.deliver() copying bytes
+    [start, stop) of the open file 'f'.
+    """
+    def write(file):
+        f.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            block = f.read(min(remaining, COPY_BLOCK))
+            if not block:
+                break
+            file.write(block)
+            remaining -= len(block)
+    return write
+
+def sample_texts(source, maildrop):
+    """
+    Yield the start of up to DICTIONARY_SAMPLES messages spread over the mailbox.
+    """
+    entries = maildrop.entries
+    step = max(len(entries) // compression.DICTIONARY_SAMPLES, 1)
+    for entry in entries[::step]:
+        f, start, stop = source.fetch(maildrop, entry)
+        with f:
+            f.seek(start)
+            yield f.read(min(stop - start, compression.DICTIONARY_SIZE))
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+def migrate(username, codec, dictionary, store):
+    """
+    Move the messages of one mbox maildrop into a compressed Maildir.
+    Returns (messages, mbox bytes, Maildir bytes).
+    """
+    source = storage.MboxStorage(store)
+    mailbox = source.path(username)
+    if not os.path.exists(mailbox):
+        return 0, 0, 0
+    target = storage.MaildirStorage(store, compression=codec)
+    maildrop = source.list(username)
+    try:
+        if dictionary and codec == "zlib" and maildrop.entries:
+            target.train_dictionary(username, sample_texts(source, maildrop))
+        for entry in maildrop.entries:
+            f, start, stop = source.fetch(maildrop, entry)
+            with f:
+                target.deliver(username, copy_range(f, start, stop))
+    finally:
+        maildrop.close()
+    old_size = os.path.getsize(mailbox)
+    os.replace(mailbox, mailbox + ".migrated")
+    try:
+        os.remove(mailbox_index.index_path(mailbox))
+    except FileNotFoundError:
+        pass
+    return len(maildrop.entries), old_size, directory_size(target.path(username))
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert mbox maildrops to compressed Maildirs")
+    parser.add_argument('users', nargs='*', help='Accounts to convert (default: every account in --userinfo)')
+    parser.add_argument('--codec', choices=compression.CODECS, default='zlib', help='Compression of the messages')
+    parser.add_argument('--no-dictionary', action='store_true',
+                        help='Compress without a dictionary trained from the mailbox (zlib only uses one)')
+    parser.add_argument('--userinfo', default=user_directory.USERINFO_FILE, help='File listing the accounts')
+    args = parser.parse_args()
+
+    users = args.users or sorted(user_directory.load_users(args.userinfo).by_name)
+    store = message_store.BlobStore()
+    for username in users:
+        count, old_size, new_size = migrate(username, args.codec, not args.no_dictionary, store)
+        if count:
+            print(f"{username}: {count} messages, {old_size} bytes as mbox, {new_size} bytes as Maildir")
+        else:
+            print(f"{username}: nothing to migrate")
+
+if __name__ == '__main__':
+    main()
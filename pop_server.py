@@ -1,112 +1,421 @@
 import argparse
-import socket
+import asyncio
+import collections
+import functools
+import hashlib
+import mmap
 import os
-import threading
+
+import admission
+import framing
+import header_index
+import mailbox_index
+import message_store
+import search_index
+import serving
+import storage
+import user_directory
+
+# Seconds a session may wait for its next command (RFC 1939 asks for 10 minutes)
+IDLE_TIMEOUT = 600.0
+idle_timeout = IDLE_TIMEOUT
+# Seconds a started command line may take to arrive in full
+command_timeout = admission.COMMAND_TIMEOUT
+
+# Bodies shared between mailboxes, referenced from the stored messages
+blob_store = message_store.BlobStore()
+
+# Where the maildrops are kept; set up by start_server()
+mail_storage = None
 
 # ---------------------------
-# Mailbox Handling (using blank lines as delimiters)
+# Message Transfer (streamed, without copying message bodies)
 # ---------------------------
-def load_mailbox(username):
-    """
-    Load messages for the user from 'username/my_mailbox'.
-    Messages are separated by one or more empty lines.
-    Returns a list of message strings.
-    """
-    mailbox_file = os.path.join(username, "my_mailbox")
-    messages = []
-    if not os.path.exists(mailbox_file):
-        return messages
-
-    with open(mailbox_file, "r") as f:
-        current_message = []
-        for line in f:
-            if line.strip() == "":
-                if current_message:
-                    messages.append("".join(current_message).strip())
-                    current_message = []
-            else:
-                current_message.append(line)
-        if current_message:
-            messages.append("".join(current_message).strip())
-    return messages
+# Bytes of responses a session holds at once: queued responses to pipelined
+# commands, and the copied parts of a message gathered for one send
+SESSION_MEMORY = 256 * 1024
+session_memory = SESSION_MEMORY
+# Runs of at least this many bytes are sent with sendfile; shorter ones are copied
+SENDFILE_MIN = 64 * 1024
+# Bytes read at a time when looking for the end of a blob body
+TAIL_BLOCK = 4096
+
+# 'count' bytes of an open file from 'offset' on, sent as they are
+FileRange = collections.namedtuple("FileRange", "file offset count")
 
-def save_mailbox(username, messages):
+
+class Stream:
     """
-    Save the list of message strings into 'username/my_mailbox',
-    separating each message with an empty line.
+    A multi-line response produced while it is sent: 'parts' yields bytes
+    and FileRanges. The open 'files' it reads are closed by close(), once
+    it was sent or when it is dropped.
     """
-    mailbox_file = os.path.join(username, "my_mailbox")
-    with open(mailbox_file, "w") as f:
-        for msg in messages:
-            f.write(msg.strip() + "\n\n")
+    def __init__(self, parts, files=()):
+        self.parts = parts
+        self.files = list(files)
 
-# ---------------------------
-# User Data Handling
-# ---------------------------
-def load_user_data():
-    """
-    Load user credentials from userinfo.txt.
-    Each line is in the format: <username> <password>
-    Returns a dictionary mapping username to password.
-    """
-    users = {}
-    if not os.path.exists("userinfo.txt"):
-        print("ERROR: userinfo.txt not found.")
-        return users
-    with open("userinfo.txt", "r") as f:
-        for line in f:
-            parts = line.strip().split()
-            if len(parts) >= 2:
-                username, password = parts[0], parts[1]
-                users[username] = password
-    return users
+    def __iter__(self):
+        return iter(self.parts)
 
-# ---------------------------
-# Helper to Parse Message Fields
-# ---------------------------
-def parse_mail_fields(msg):
-    """
-    Parse the email message and extract the sender, received time, and subject.
-    Expected lines:
-      From: <sender>
-      Received: <date : hour : minute>
-      Subject: <subject>
-    """
-    sender = ""
-    received = ""
-    subject = ""
-    for line in msg.splitlines():
-        if line.startswith("From:"):
-            sender = line[len("From:"):].strip()
-        elif line.startswith("Received:"):
-            received = line[len("Received:"):].strip()
-        elif line.startswith("Subject:"):
-            subject = line[len("Subject:"):].strip()
-    return sender, received, subject
+    def close(self):
+        self.parts.close()
+        for file in self.files:
+            file.close()
+        self.files = []
+
+def stuffed_parts(f, start, stop):
+    """
+    Yield bytes [start, stop) of the open file 'f' as parts to send, with
+    the "." that POP3 puts in front of every line starting with one.
+    'start' must be the start of a line. The dots are found in an mmap of
+    the file; only the runs between them shorter than SENDFILE_MIN (or the
+    session memory) are copied, the others are FileRanges for sendfile.
+    """
+    if stop <= start:
+        return
+    copy_max = min(SENDFILE_MIN, session_memory)
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        pos = start
+        if mm[start:start + 1] == b".":
+            yield b"."
+        dot = mm.find(b"\n.", start, stop)
+        while True:
+            end = stop if dot < 0 else dot + 1
+            if end - pos >= copy_max:
+                yield FileRange(f, pos, end - pos)
+            elif end > pos:
+                yield mm[pos:end]
+            if dot < 0:
+                return
+            yield b"."
+            pos = end
+            dot = mm.find(b"\n.", end, stop)
+
+def blob_body_end(f):
+    """
+    Return the length of the blob in 'f' without its trailing whitespace.
+    """
+    end = os.fstat(f.fileno()).st_size
+    while end > 0:
+        start = max(end - TAIL_BLOCK, 0)
+        f.seek(start)
+        kept = len(f.read(end - start).rstrip())
+        if kept:
+            return start + kept
+        end = start
+    return 0
+
+def open_blob(entry):
+    """
+    Return the blob an entry refers to, opened, or None when it is missing.
+    """
+    try:
+        return blob_store.open(entry["blob"])
+    except FileNotFoundError:
+        return None
+
+def message_stream(maildrop, entry):
+    """
+    Return the message as RETR sends it: straight from the file storage
+    hands out for it, with a blob reference replaced by the blob body.
+    Returns None when the message is gone.
+    """
+    fetched = mail_storage.fetch(maildrop, entry)
+    if fetched is None:
+        return None
+    f, start, stop = fetched
+    if entry["blob"] is None:
+        return Stream(stuffed_parts(f, start, stop), [f])
+    # The last line is the blob reference; the header lines come before it.
+    f.seek(max(start, stop - TAIL_BLOCK))
+    tail = f.read(stop - f.tell())
+    head_stop = stop - len(tail) + max(tail.rfind(b"\n"), 0)
+    blob = open_blob(entry)
+    if blob is None:
+        return Stream(stuffed_parts(f, start, head_stop), [f])
+
+    def parts():
+        yield from stuffed_parts(f, start, head_stop)
+        body_stop = blob_body_end(blob)
+        if body_stop:
+            yield b"\n"
+            yield from stuffed_parts(blob, 0, body_stop)
+    return Stream(parts(), [f, blob])
+
+def message_chunks(maildrop, entry):
+    """
+    Yield the bytes of a message as RETR sends it, for searching it.
+    """
+    stream = message_stream(maildrop, entry)
+    if stream is None:
+        return
+    try:
+        for part in stream:
+            if not isinstance(part, FileRange):
+                yield bytes(part)
+                continue
+            offset, remaining = part.offset, part.count
+            while remaining > 0:
+                block = os.pread(part.file.fileno(), min(remaining, SENDFILE_MIN), offset)
+                if not block:
+                    break
+                yield block
+                offset += len(block)
+                remaining -= len(block)
+    finally:
+        stream.close()
+
+def line_end(f, start, stop, count):
+    """
+    Return where the first 'count' lines of bytes [start, stop) of the open
+    file 'f' end, newline excluded.
+    """
+    if count <= 0 or stop <= start:
+        return start
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        pos = start
+        for _ in range(count):
+            newline = mm.find(b"\n", pos, stop)
+            if newline < 0:
+                return stop
+            pos = newline + 1
+        return pos - 1
+
+def top_stream(maildrop, entry, count):
+    """
+    Return the header lines of one message, a blank line and the first
+    'count' lines of its body, as TOP sends them. The header lines end at
+    the offset kept in the index, so the rest of the message is never read
+    (nor decompressed) when no body lines come from it. Returns None when
+    the message is gone.
+    """
+    headers = entry.get("headers")
+    limit = None
+    if headers is not None and (count <= 0 or entry["blob"] is not None):
+        limit = headers
+    fetched = mail_storage.fetch(maildrop, entry, limit)
+    if fetched is None:
+        return None
+    f, start, stop = fetched
+    if headers is None:
+        # Indexed before header offsets were kept
+        f.seek(start)
+        headers = message_store.header_length(f.read(min(stop - start, mailbox_index.HEADER_READ)))
+    head_stop = start + headers
+    body, body_start, body_stop = f, head_stop, stop
+    files = [f]
+    if entry["blob"] is not None:
+        body = open_blob(entry)
+        if body is None:
+            body_stop = body_start
+            body = f
+        else:
+            files.append(body)
+            body_start, body_stop = 0, blob_body_end(body)
+    if count > 0 and body_stop > body_start:
+        # A blank line after the headers is the separator sent below, not
+        # the first body line.
+        lead = os.pread(body.fileno(), 2, body_start)
+        if lead.startswith(b"\n"):
+            body_start += 1
+        elif lead == b"\r\n":
+            body_start += 2
+
+    def parts():
+        yield from stuffed_parts(f, start, head_stop)
+        # The header lines end with a newline unless nothing follows them.
+        yield b"\n" if headers < entry["length"] or not headers else b"\n\n"
+        if count > 0 and body_stop > body_start:
+            yield from stuffed_parts(body, body_start, line_end(body, body_start, body_stop, count))
+            yield b"\n"
+    return Stream(parts(), files)
+
+def framed(first, stream, last):
+    """
+    Return 'stream' with a status line before it and 'last' after it.
+    """
+    def parts():
+        yield first
+        yield from stream
+        yield last
+    return Stream(parts(), stream.files)
+
+def close_responses(responses):
+    for response in responses:
+        if isinstance(response, Stream):
+            response.close()
+
+def flush_due(pending, buffer):
+    """
+    Tell whether the responses queued for pipelined commands must go out
+    now: when no further command has been received in full, when a stream
+    is queued, as it holds files open, or when the session memory is used.
+    """
+    if not buffer.has_line():
+        return True
+    if any(isinstance(response, Stream) for response in pending):
+        return True
+    return sum(len(response) for response in pending) >= session_memory
+
+def all_parts(responses):
+    for response in responses:
+        if isinstance(response, bytes):
+            yield response
+        else:
+            yield from response
+
+def next_batch(parts, limit):
+    """
+    Gather bytes from the iterator 'parts' until 'limit' bytes are reached
+    or a FileRange comes up. Returns (bytes, FileRange or None); (b"", None)
+    once 'parts' is exhausted.
+    """
+    gathered = []
+    size = 0
+    for part in parts:
+        if isinstance(part, FileRange):
+            return b"".join(gathered), part
+        gathered.append(part)
+        size += len(part)
+        if size >= limit:
+            break
+    return b"".join(gathered), None
+
+def send_responses(connection, responses):
+    """
+    Send queued responses, each bytes or a Stream. Bytes go out in batches
+    of up to the session memory, so however long a message is, no more of
+    it is held at once.
+    """
+    try:
+        if all(isinstance(response, bytes) for response in responses):
+            connection.sendall(b"".join(responses))
+            return
+        parts = all_parts(responses)
+        while True:
+            data, file_range = next_batch(parts, session_memory)
+            if data:
+                connection.sendall(data)
+            if file_range is not None:
+                connection.sendfile(file_range.file, file_range.offset, file_range.count)
+            elif not data:
+                break
+    finally:
+        close_responses(responses)
+
+async def write_responses(writer, responses):
+    """
+    Like send_responses(); streams are read on an executor thread so the
+    event loop never waits on the disk.
+    """
+    try:
+        if all(isinstance(response, bytes) for response in responses):
+            writer.write(b"".join(responses))
+            await writer.drain()
+            return
+        loop = asyncio.get_running_loop()
+        parts = all_parts(responses)
+        while True:
+            data, file_range = await loop.run_in_executor(None, next_batch, parts, session_memory)
+            if data:
+                writer.write(data)
+                await writer.drain()
+            if file_range is not None:
+                await loop.sendfile(writer.transport, file_range.file, file_range.offset, file_range.count)
+            elif not data:
+                break
+    finally:
+        close_responses(responses)
 
 # ---------------------------
 # POP3 Command Handlers
 # ---------------------------
 def handle_stat(mailbox, deletion_marks):
     num = sum(1 for mark in deletion_marks if not mark)
-    total_size = sum(len(msg.encode()) for i, msg in enumerate(mailbox) if not deletion_marks[i])
+    total_size = sum(entry["size"] for i, entry in enumerate(mailbox) if not deletion_marks[i])
     return f"+OK {num} {total_size}\n"
 
 def handle_list(mailbox, deletion_marks):
-    lines = []
-    for i, msg in enumerate(mailbox):
-        if not deletion_marks[i]:
-            sender, received, subject = parse_mail_fields(msg)
-            lines.append(f"{i+1}. {sender} {received} {subject}")
-    response = f"+OK {len(lines)} messages\n" + "\n".join(lines) + "\n.\n"
-    return response
-
-def handle_retr(mailbox, deletion_marks, msg_num):
+    count = sum(1 for mark in deletion_marks if not mark)
+
+    def parts():
+        yield f"+OK {count} messages\n".encode()
+        for i, entry in enumerate(mailbox):
+            if not deletion_marks[i]:
+                yield f"{i+1}. {entry['from']} {entry['received']} {entry['subject']}\n".encode()
+        yield b".\n"
+    return Stream(parts())
+
+def handle_retr(maildrop, mailbox, deletion_marks, msg_num):
     index = msg_num - 1
     if index < 0 or index >= len(mailbox) or deletion_marks[index]:
-        return "-ERR no such message\n"
-    msg = mailbox[index]
-    return f"+OK message follows\n{msg}\n.\n"
+        return b"-ERR no such message\n"
+    stream = message_stream(maildrop, mailbox[index])
+    if stream is None:
+        return b"-ERR no such message\n"
+    return framed(b"+OK message follows\n", stream, b"\n.\n")
+
+def handle_top(maildrop, mailbox, deletion_marks, msg_num, count):
+    index = msg_num - 1
+    if index < 0 or index >= len(mailbox) or deletion_marks[index]:
+        return b"-ERR no such message\n"
+    if count < 0:
+        return b"-ERR Invalid line count\n"
+    stream = top_stream(maildrop, mailbox[index], count)
+    if stream is None:
+        return b"-ERR no such message\n"
+    return framed(b"+OK top of message follows\n", stream, b".\n")
+
+def unique_id(entry):
+    """
+    Return the UIDL of a message: its id, or a digest of it when the id is
+    not 1 to 70 printable characters as RFC 1939 requires.
+    """
+    entry_id = entry["id"]
+    if 0 < len(entry_id) <= 70 and all("!" <= c <= "~" for c in entry_id):
+        return entry_id
+    return hashlib.sha1(entry_id.encode()).hexdigest()
+
+def handle_uidl(mailbox, deletion_marks, msg_num=None):
+    if msg_num is not None:
+        index = msg_num - 1
+        if index < 0 or index >= len(mailbox) or deletion_marks[index]:
+            return b"-ERR no such message\n"
+        return f"+OK {msg_num} {unique_id(mailbox[index])}\n".encode()
+
+    def parts():
+        yield b"+OK unique-id listing follows\n"
+        for i, entry in enumerate(mailbox):
+            if not deletion_marks[i]:
+                yield f"{i+1} {unique_id(entry)}\n".encode()
+        yield b".\n"
+    return Stream(parts())
+
+def handle_search(session, kind, query):
+    """
+    SEARCH extension: list the numbers of the messages matching the query.
+    Words come from search_index; dates and senders from the sorted
+    indexes of header_index.
+    """
+    mailbox, deletion_marks = session.mailbox, session.deletion_marks
+    if kind == "TEXT":
+        live = [entry for i, entry in enumerate(mailbox) if not deletion_marks[i]]
+        found = search_index.search(mail_storage.words_path(session.current_user), live, query,
+                                    functools.partial(message_chunks, session.maildrop))
+    elif kind == "FROM":
+        found = session.maildrop.headers().from_prefix(query)
+    else:
+        days = header_index.day_range(query)
+        if days is None:
+            return b"-ERR SEARCH DATE takes MM/DD/YYYY, optionally followed by a last day\n"
+        found = session.maildrop.headers().received_between(*days)
+    ids = {entry["id"] for entry in found}
+    numbers = [i + 1 for i, entry in enumerate(mailbox) if not deletion_marks[i] and entry["id"] in ids]
+    lines = "".join(f"{number}\n" for number in numbers)
+    return f"+OK {len(numbers)} messages match\n{lines}.\n".encode()
+
+def handle_capa():
+    return b"+OK Capability list follows\nUSER\nTOP\nUIDL\nPIPELINING\nSEARCH\n.\n"
 
 def handle_dele(deletion_marks, msg_num):
     index = msg_num - 1
@@ -120,113 +429,264 @@ def handle_rset(deletion_marks):
         deletion_marks[i] = False
     return "+OK maildrop has been reset\n"
 
+# ---------------------------
+# Session Handling
+# ---------------------------
+# Queries SEARCH answers: words or a phrase, the start of the sender address,
+# a day or a range of days (MM/DD/YYYY [MM/DD/YYYY])
+SEARCH_KINDS = ("TEXT", "FROM", "DATE")
+# Commands that touch the disk; the asyncio engine runs these in an executor.
+BLOCKING_COMMANDS = {"PASS", "RETR", "TOP", "SEARCH", "QUIT"}
+
+class Session:
+    """
+    State of one POP3 connection, shared by the threaded and asyncio engines.
+    'address' is the client's, which failed logins are counted for.
+    """
+    def __init__(self, users, address=None):
+        self.users = users
+        self.address = address
+        self.authenticated = False
+        self.current_user = None
+        self.mailbox = []
+        self.deletion_marks = []
+        self.maildrop = None
+
+    def close(self):
+        if self.maildrop is not None:
+            self.maildrop.close()
+            self.maildrop = None
+
+def parse_command(data):
+    """
+    Split a received command into (COMMAND, args); COMMAND is None when empty.
+    """
+    # Remove \r and \n characters
+    data = data.replace('\r', '').replace('\n', '')
+    print("Received command:", repr(data))
+    parts = data.split()
+    if not parts:
+        return None, []
+    return parts[0].upper(), parts[1:]
+
+def handle_command(session, command, args):
+    """
+    Execute one command for the session.
+    Returns a tuple: (response, continue_connection (bool)), the response
+    being bytes or, for the multi-line responses, a Stream.
+    """
+    if command is None:
+        return b"-ERR empty command\n", True
+    if command == "CAPA":
+        return handle_capa(), True
+
+    if not session.authenticated:
+        if command == "USER" and args:
+            session.current_user = args[0]
+            return b"+OK User name accepted, password please\n", True
+        elif command == "PASS" and args and session.current_user:
+            password = args[0]
+            if session.users.throttled(session.current_user, session.address):
+                return b"-ERR Too many failed logins, try again later\n", True
+            if session.users.authenticate(session.current_user, password, session.address):
+                session.authenticated = True
+                session.maildrop = mail_storage.list(session.current_user)
+                session.mailbox = session.maildrop.entries
+                # One byte per message; the entries themselves are shared
+                # with the maildrop cache.
+                session.deletion_marks = bytearray(len(session.mailbox))
+                print("Authentication successful")
+                return b"+OK POP3 server is ready\n", True
+            else:
+                return b"-ERR Invalid password\n", True
+        else:
+            return b"-ERR Authentication required\n", True
+
+    mailbox = session.mailbox
+    deletion_marks = session.deletion_marks
+    if command == "STAT":
+        response = handle_stat(mailbox, deletion_marks)
+        return response.encode(), True
+    elif command == "LIST":
+        print("LIST COMMAND")
+        return handle_list(mailbox, deletion_marks), True
+    elif command == "RETR":
+        if args:
+            try:
+                msg_num = int(args[0])
+                return handle_retr(session.maildrop, mailbox, deletion_marks, msg_num), True
+            except ValueError:
+                return b"-ERR Invalid message number\n", True
+        else:
+            return b"-ERR RETR requires a message number\n", True
+    elif command == "TOP":
+        if len(args) >= 2:
+            try:
+                msg_num, count = int(args[0]), int(args[1])
+                return handle_top(session.maildrop, mailbox, deletion_marks, msg_num, count), True
+            except ValueError:
+                return b"-ERR Invalid message number\n", True
+        else:
+            return b"-ERR TOP requires a message number and a line count\n", True
+    elif command == "UIDL":
+        try:
+            msg_num = int(args[0]) if args else None
+        except ValueError:
+            return b"-ERR Invalid message number\n", True
+        return handle_uidl(mailbox, deletion_marks, msg_num), True
+    elif command == "SEARCH":
+        if len(args) >= 2 and args[0].upper() in SEARCH_KINDS:
+            return handle_search(session, args[0].upper(), " ".join(args[1:])), True
+        else:
+            return b"-ERR SEARCH requires TEXT, FROM or DATE and a query\n", True
+    elif command == "DELE":
+        if args:
+            try:
+                msg_num = int(args[0])
+                response = handle_dele(deletion_marks, msg_num)
+                return response.encode(), True
+            except ValueError:
+                return b"-ERR Invalid message number\n", True
+        else:
+            return b"-ERR DELE requires a message number\n", True
+    elif command == "RSET":
+        response = handle_rset(deletion_marks)
+        return response.encode(), True
+    elif command == "QUIT":
+        deleted = [entry for i, entry in enumerate(mailbox) if deletion_marks[i]]
+        try:
+            if deleted:
+                mail_storage.delete(session.current_user, deleted)
+            return b"+OK POP3 server signing off\n", False
+        except Exception as e:
+            return f"-ERR {str(e)}\n".encode(), False
+    else:
+        return b"-ERR Command not recognized\n", True
+
+def timed_out(write, client_address):
+    print(f"Connection with {client_address} timed out.")
+    try:
+        write(b"-ERR autologout timer expired\n")
+    except OSError:
+        pass
+
 def client_thread(connection, client_address, users):
+    session = Session(users, client_address[0])
+    reader = framing.LineReader(connection, idle_timeout=idle_timeout, command_timeout=command_timeout)
+    pending = []
     try:
         connection.sendall(b"+OK POP3 server ready\n")
-        authenticated = False
-        current_user = None
-        mailbox = []
-        deletion_marks = []
 
         while True:
-            data = connection.recv(1024).decode()
+            data = reader.readline().decode(errors="replace")
             if not data:
                 break
-            # Remove \r and \n characters
-            data = data.replace('\r', '').replace('\n', '')
-            print("Received command:", repr(data))
-            parts = data.split()
-            if not parts:
-                connection.sendall(b"-ERR empty command\n")
-                continue
+            command, args = parse_command(data)
+            response, keep_going = handle_command(session, command, args)
+            pending.append(response)
+            if not keep_going or flush_due(pending, reader.buffer):
+                responses, pending = pending, []
+                send_responses(connection, responses)
+            if not keep_going:
+                break
+    except TimeoutError:
+        timed_out(connection.sendall, client_address)
+    finally:
+        close_responses(pending)
+        session.close()
+        connection.close()
+        print(f"Connection with {client_address} closed.")
+
+async def client_session(reader, writer, users):
+    client_address = writer.get_extra_info("peername")
+    print(f"Connection from {client_address} has been established.")
+    loop = asyncio.get_running_loop()
+    session = Session(users, client_address[0])
+    reader = framing.AsyncLineReader(reader, idle_timeout=idle_timeout, command_timeout=command_timeout)
+    pending = []
+    try:
+        writer.write(b"+OK POP3 server ready\n")
 
-            command = parts[0].upper()
-            args = parts[1:]
-
-            if not authenticated:
-                if command == "USER" and args:
-                    current_user = args[0]
-                    connection.sendall(b"+OK User name accepted, password please\n")
-                elif command == "PASS" and args and current_user:
-                    password = args[0]
-                    if current_user in users and users[current_user] == password:
-                        authenticated = True
-                        mailbox = load_mailbox(current_user)
-                        deletion_marks = [False] * len(mailbox)
-                        print("Authentication successful")
-                        connection.sendall(b"+OK POP3 server is ready\n")
-                    else:
-                        connection.sendall(b"-ERR Invalid password\n")
-                else:
-                    connection.sendall(b"-ERR Authentication required\n")
+        while True:
+            data = (await reader.readline()).decode(errors="replace")
+            if not data:
+                break
+            command, args = parse_command(data)
+            if command in BLOCKING_COMMANDS:
+                response, keep_going = await loop.run_in_executor(None, handle_command, session, command, args)
             else:
-                if command == "STAT":
-                    response = handle_stat(mailbox, deletion_marks)
-                    connection.sendall(response.encode())
-                elif command == "LIST":
-                    print("LIST COMMAND")
-                    response = handle_list(mailbox, deletion_marks)
-                    connection.sendall(response.encode())
-                elif command == "RETR":
-                    if args:
-                        try:
-                            msg_num = int(args[0])
-                            response = handle_retr(mailbox, deletion_marks, msg_num)
-                            connection.sendall(response.encode())
-                        except ValueError:
-                            connection.sendall(b"-ERR Invalid message number\n")
-                    else:
-                        connection.sendall(b"-ERR RETR requires a message number\n")
-                elif command == "DELE":
-                    if args:
-                        try:
-                            msg_num = int(args[0])
-                            response = handle_dele(deletion_marks, msg_num)
-                            connection.sendall(response.encode())
-                        except ValueError:
-                            connection.sendall(b"-ERR Invalid message number\n")
-                    else:
-                        connection.sendall(b"-ERR DELE requires a message number\n")
-                elif command == "RSET":
-                    response = handle_rset(deletion_marks)
-                    connection.sendall(response.encode())
-                elif command == "QUIT":
-                    new_mailbox = [msg for i, msg in enumerate(mailbox) if not deletion_marks[i]]
-                    try:
-                        save_mailbox(current_user, new_mailbox)
-                        connection.sendall(b"+OK POP3 server signing off\n")
-                    except Exception as e:
-                        connection.sendall(f"-ERR {str(e)}\n".encode())
-                    break
-                else:
-                    connection.sendall(b"-ERR Command not recognized\n")
+                response, keep_going = handle_command(session, command, args)
+            pending.append(response)
+            if not keep_going or flush_due(pending, reader.buffer):
+                responses, pending = pending, []
+                await write_responses(writer, responses)
+            if not keep_going:
+                break
+    except TimeoutError:
+        timed_out(writer.write, client_address)
+    except ConnectionError:
+        pass
     finally:
-        connection.close()
+        close_responses(pending)
+        session.close()
+        writer.close()
         print(f"Connection with {client_address} closed.")
 
+def start_server(sock, args, users):
+    global mail_storage
+    cache = storage.MailboxCache(args.cache_bytes) if args.cache_bytes > 0 else None
+    mail_storage = storage.open_storage(args.storage, blob_store, cache)
+    if args.storage == "mbox":
+        mail_storage.start_compactor(args.compact_min_bytes, args.compact_ratio)
+    limits = admission.from_arguments(args, b"-ERR Too many connections, try again later\n")
+    if args.mode == 'asyncio':
+        serving.run_asyncio(functools.partial(client_session, users=users), sock, limits)
+    else:
+        serving.run_threaded(client_thread, sock, limits, users)
+
 def main():
     parser = argparse.ArgumentParser(description="Start a POP3 server on a specified port")
     parser.add_argument('port', type=int, help='Port number to listen on')
+    parser.add_argument('--mode', choices=['threaded', 'asyncio'], default='threaded',
+                        help='Serve every session on its own thread (default) or on one asyncio event loop')
+    parser.add_argument('--userinfo', default=user_directory.USERINFO_FILE, help='File listing the accounts and passwords')
+    parser.add_argument('--login-cache-ttl', type=float, default=user_directory.VERIFIED_TTL,
+                        help='Seconds a verified login skips the password hash (0 disables)')
+    parser.add_argument('--failure-limit', type=int, default=user_directory.FAILURE_LIMIT,
+                        help='Failed logins after which a user is refused for --failure-window seconds')
+    parser.add_argument('--failure-window', type=float, default=user_directory.FAILURE_WINDOW,
+                        help='Seconds a user is refused after too many failed logins')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of worker processes sharing the port (each runs the chosen mode)')
+    parser.add_argument('--storage', choices=sorted(storage.BACKENDS), default='mbox',
+                        help='How maildrops are stored; must match the SMTP server')
+    parser.add_argument('--session-memory', type=int, default=SESSION_MEMORY,
+                        help='Bytes of responses a session holds at once; longer ones are streamed')
+    parser.add_argument('--cache-bytes', type=int, default=storage.CACHE_BYTES,
+                        help='Memory for maildrops kept listed between sessions (0 disables)')
+    parser.add_argument('--compact-min-bytes', type=int, default=mailbox_index.COMPACT_MIN_BYTES,
+                        help='Bytes of deleted mail a mailbox must hold before it is compacted')
+    parser.add_argument('--compact-ratio', type=float, default=mailbox_index.COMPACT_RATIO,
+                        help='Share of a mailbox deleted mail must take up before it is compacted')
+    admission.add_arguments(parser, IDLE_TIMEOUT)
     args = parser.parse_args()
+    global idle_timeout, command_timeout, session_memory
+    idle_timeout = args.idle_timeout
+    command_timeout = args.command_timeout
+    session_memory = args.session_memory
 
-    users = load_user_data()
-    if not users:
+    users = user_directory.UserDirectory(args.userinfo, verified_ttl=args.login_cache_ttl,
+                                         failure_limit=args.failure_limit, failure_window=args.failure_window)
+    if not len(users):
         print("No user data available. Exiting.")
         return
 
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_address = ('localhost', args.port)
-    server_socket.bind(server_address)
-    server_socket.listen(5)
     print(f"POP3 server starting on {server_address[0]} port {server_address[1]}")
-
-    try:
-        while True:
-            connection, client_address = server_socket.accept()
-            print(f"Connection from {client_address} has been established.")
-            threading.Thread(target=client_thread, args=(connection, client_address, users)).start()
-    finally:
-        server_socket.close()
+    if args.workers > 1:
+        serving.run_workers(args.workers, lambda sock, index: start_server(sock, args, users), server_address)
+    else:
+        start_server(serving.make_listener(server_address), args, users)
 
 if __name__ == '__main__':
     import threading
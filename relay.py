@@ -0,0 +1,285 @@
+"""
+Outbound relay queue for the SMTP server.
+
+Mail for recipients outside the local domain is spooled in a directory, one
+entry per destination host:
+
+  <id>.msg   the message as received (entries of one mail share the file
+             through hard links)
+  <id>.json  {"id", "sender", "rcpts", "host", "queued", "attempts", "next_attempt"}
+
+A scheduler thread groups the entries that are due by host and hands each
+group to a delivery thread, which sends them one after another over a single
+SMTP connection. That connection is kept open for POOL_IDLE seconds so the
+next group for the same host reuses it. Temporary failures (4xx replies,
+refused or dropped connections) are retried after RETRY_BASE seconds,
+doubling with every attempt up to RETRY_MAX, until the entry is MAX_AGE
+seconds old; permanent failures (5xx) drop the recipient.
+
+There is no MX lookup: mail goes to the recipient's domain on port 25, or to
+the smarthost given as 'route' for every domain, which is also how the queue
+is pointed at a local stand-in listener.
+"""
+import concurrent.futures
+import json
+import os
+import smtplib
+import threading
+import time
+import uuid
+
+# Delivery threads; each talks to one host at a time
+WORKERS = 4
+# Entries sent over one connection before the scheduler looks again
+BATCH_SIZE = 100
+# Seconds before the first retry, doubled for every later one
+RETRY_BASE = 60.0
+RETRY_MAX = 3600.0
+# Entries are given up after this many seconds in the queue
+MAX_AGE = 5 * 24 * 3600.0
+# Seconds an idle pooled connection is kept open
+POOL_IDLE = 30.0
+# Seconds a connection attempt or reply may take
+TIMEOUT = 60.0
+SMTP_PORT = 25
+
+
+def split_host(host):
+    name, _, port = host.rpartition(":")
+    if not name or not port.isdigit():
+        return host, SMTP_PORT
+    return name, int(port)
+
+
+def to_wire(data):
+    """
+    Give every line of a stored message a CRLF ending, as SMTP requires.
+    """
+    return data.replace(b"\r\n", b"\n").replace(b"\n", b"\r\n")
+
+
+def merge_queue(source, target):
+    """
+    Move the entries of the queue directory 'source' into 'target', for a
+    queue no process uses any more. Returns the number of entries moved.
+    """
+    os.makedirs(target, exist_ok=True)
+    moved = 0
+    # Messages first: an entry only counts once its .json is there.
+    for name in sorted(os.listdir(source), key=lambda name: name.endswith(".json")):
+        if name.endswith(".tmp"):
+            os.remove(os.path.join(source, name))
+            continue
+        os.replace(os.path.join(source, name), os.path.join(target, name))
+        moved += name.endswith(".json")
+    os.rmdir(source)
+    return moved
+
+
+class OutboundQueue:
+    def __init__(self, directory, route=None, workers=WORKERS, retry_base=RETRY_BASE,
+                 retry_max=RETRY_MAX, max_age=MAX_AGE, timeout=TIMEOUT):
+        self.directory = directory
+        self.route = route
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.max_age = max_age
+        self.timeout = timeout
+        self.cond = threading.Condition()
+        self.entries = {}      # id -> entry, persisted as <id>.json
+        self.busy = set()      # hosts a delivery thread is working on
+        self.connections = {}  # host -> (idle SMTP connection, time it went idle)
+        self.closed = False
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers)
+
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            if name.endswith(".json"):
+                with open(os.path.join(directory, name)) as f:
+                    entry = json.load(f)
+                self.entries[entry["id"]] = entry
+            elif name.endswith(".tmp"):
+                os.remove(os.path.join(directory, name))
+        if self.entries:
+            print(f"Recovered {len(self.entries)} outbound queue entries")
+        threading.Thread(target=self._schedule, daemon=True).start()
+
+    def host_for(self, rcpt):
+        return self.route or rcpt.rpartition("@")[2].lower()
+
+    def _path(self, entry_id, suffix):
+        return os.path.join(self.directory, entry_id + suffix)
+
+    def _save(self, entry):
+        path = self._path(entry["id"], ".json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(entry, f)
+        os.replace(path + ".tmp", path)
+        return path
+
+    def enqueue(self, sender, rcpts, chunks):
+        """
+        Spool a mail for the remote recipients 'rcpts'; 'chunks' yields the
+        message. Returns the paths written, for the caller to fsync.
+        """
+        by_host = {}
+        for rcpt in rcpts:
+            by_host.setdefault(self.host_for(rcpt), []).append(rcpt)
+        entries = []
+        paths = [self.directory]
+        body = None
+        for host, host_rcpts in by_host.items():
+            now = time.time()
+            entry = {"id": uuid.uuid4().hex, "sender": sender, "rcpts": host_rcpts, "host": host,
+                     "queued": now, "attempts": 0, "next_attempt": now}
+            msg_path = self._path(entry["id"], ".msg")
+            if body is None:
+                with open(msg_path, "wb") as f:
+                    for chunk in chunks:
+                        f.write(chunk)
+                body = msg_path
+                paths.append(msg_path)
+            else:
+                os.link(body, msg_path)
+            paths.append(self._save(entry))
+            entries.append(entry)
+        with self.cond:
+            for entry in entries:
+                self.entries[entry["id"]] = entry
+            self.cond.notify_all()
+        return paths
+
+    def _remove(self, entry):
+        with self.cond:
+            self.entries.pop(entry["id"], None)
+        for suffix in (".json", ".msg"):
+            try:
+                os.remove(self._path(entry["id"], suffix))
+            except FileNotFoundError:
+                pass
+
+    def _schedule(self):
+        while True:
+            with self.cond:
+                if self.closed:
+                    return
+                now = time.time()
+                due = {}
+                wake = None
+                for entry in self.entries.values():
+                    if entry["host"] in self.busy:
+                        continue
+                    if entry["next_attempt"] <= now:
+                        batch = due.setdefault(entry["host"], [])
+                        if len(batch) < BATCH_SIZE:
+                            batch.append(entry)
+                    else:
+                        wake = min(wake or entry["next_attempt"], entry["next_attempt"])
+                for host, batch in due.items():
+                    self.busy.add(host)
+                    self.executor.submit(self._deliver, host, batch)
+                idle = self._expired_connections(now)
+                if not due:
+                    self.cond.wait(POOL_IDLE if wake is None else min(max(wake - now, 0.01), POOL_IDLE))
+            for connection in idle:
+                self._quit(connection)
+
+    def _expired_connections(self, now):
+        expired = [host for host, (connection, since) in self.connections.items()
+                   if host not in self.busy and now - since > POOL_IDLE]
+        return [self.connections.pop(host)[0] for host in expired]
+
+    @staticmethod
+    def _quit(connection):
+        try:
+            connection.quit()
+        except (OSError, smtplib.SMTPException):
+            connection.close()
+
+    def _connect(self, host):
+        """
+        Return the pooled connection to 'host' if it still answers, else a new one.
+        """
+        with self.cond:
+            pooled = self.connections.pop(host, None)
+        if pooled:
+            connection = pooled[0]
+            try:
+                if connection.noop()[0] == 250:
+                    return connection
+            except OSError:
+                pass
+            connection.close()
+        name, port = split_host(host)
+        connection = smtplib.SMTP(name, port, local_hostname="localhost", timeout=self.timeout)
+        connection.ehlo_or_helo_if_needed()
+        return connection
+
+    def _deliver(self, host, batch):
+        connection = None
+        try:
+            for number, entry in enumerate(batch):
+                try:
+                    if connection is None:
+                        connection = self._connect(host)
+                    self._send(connection, entry)
+                except OSError as e:
+                    # The host or the connection failed: try the rest later.
+                    print(f"Relay to {host} failed: {e}")
+                    if connection is not None:
+                        connection.close()
+                        connection = None
+                    for pending in batch[number:]:
+                        self._retry(pending, pending["rcpts"])
+                    break
+        finally:
+            with self.cond:
+                if connection is not None:
+                    self.connections[host] = (connection, time.time())
+                self.busy.discard(host)
+                self.cond.notify_all()
+
+    def _send(self, connection, entry):
+        with open(self._path(entry["id"], ".msg"), "rb") as f:
+            data = to_wire(f.read())
+        try:
+            refused = connection.sendmail(entry["sender"], entry["rcpts"], data)
+        except smtplib.SMTPRecipientsRefused as e:
+            refused = e.recipients
+        except (smtplib.SMTPSenderRefused, smtplib.SMTPDataError) as e:
+            refused = {rcpt: (e.smtp_code, e.smtp_error) for rcpt in entry["rcpts"]}
+        temporary = []
+        for rcpt, (code, message) in refused.items():
+            if code >= 500:
+                print(f"Relay of {entry['id']} to {rcpt} failed permanently: {code} {message!r}")
+            else:
+                temporary.append(rcpt)
+        if temporary:
+            self._retry(entry, temporary)
+        else:
+            print(f"Relayed {entry['id']} to {entry['host']}")
+            self._remove(entry)
+
+    def _retry(self, entry, rcpts):
+        now = time.time()
+        if now - entry["queued"] > self.max_age:
+            print(f"Giving up on {entry['id']} for {', '.join(rcpts)} after {entry['attempts']} attempts")
+            self._remove(entry)
+            return
+        delay = min(self.retry_base * 2 ** entry["attempts"], self.retry_max)
+        with self.cond:
+            entry.update(rcpts=rcpts, attempts=entry["attempts"] + 1, next_attempt=now + delay)
+            self._save(entry)
+
+    def close(self):
+        """
+        Stop scheduling and close the pooled connections. Entries left in
+        the queue are picked up again on the next start.
+        """
+        with self.cond:
+            self.closed = True
+            connections, self.connections = self.connections, {}
+            self.cond.notify_all()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        for connection, since in connections.values():
+            self._quit(connection)
@@ -0,0 +1,251 @@
+"""
+Full-text search index of a maildrop.
+
+Next to every maildrop the servers keep a log of the words in its messages
+('my_mailbox.words', 'Maildir/words'), one JSON line per change:
+
+  {"id", "words"}       the distinct words of a message, lowercased
+  {"deleted": [ids]}    messages deleted by a POP3 session
+
+SMTP delivery appends the words of every message it stores and POP3
+deletions append their ids, so the log follows the maildrop without being
+rewritten. A POP3 server reads the log into an inverted index (word ->
+messages) once and afterwards only what was appended to it; messages the
+log does not know yet, such as mail delivered before it existed, are indexed
+on the first search that meets them. Once the log holds more dead lines
+than live ones it is rewritten without them.
+
+Searches intersect the messages of every word in the query; a phrase is
+then confirmed in the few messages left. Searches by sender and by date are
+header_index's.
+"""
+import array
+import codecs
+import collections
+import json
+import os
+import re
+import threading
+
+import locking
+
+WORDS_SUFFIX = ".words"
+WORD = re.compile(r"\w+")
+# Longer runs (base64 lines, hashes) are not words anyone searches for
+MAX_WORD_LENGTH = 64
+# Logs with fewer dead lines than this are never rewritten
+COMPACT_MIN_LINES = 1000
+# Mailboxes whose index is kept in memory
+CACHED_INDEXES = 64
+
+
+def tokens(chunks):
+    """
+    Yield the words in the byte chunks of a message, lowercased, in order.
+    A word split between chunks is yielded once, whole.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    rest = ""
+    for chunk in chunks:
+        text = rest + decoder.decode(chunk)
+        # A word touching the end of the chunk may go on in the next one.
+        cut = len(text)
+        while cut > 0 and (text[cut - 1].isalnum() or text[cut - 1] == "_"):
+            cut -= 1
+        rest = text[cut:]
+        if len(rest) > MAX_WORD_LENGTH:
+            rest = rest[-MAX_WORD_LENGTH - 1:]
+        for match in WORD.finditer(text, 0, cut):
+            if len(match.group()) <= MAX_WORD_LENGTH:
+                yield match.group().lower()
+    text = rest + decoder.decode(b"", final=True)
+    for match in WORD.finditer(text):
+        if len(match.group()) <= MAX_WORD_LENGTH:
+            yield match.group().lower()
+
+def words(chunks):
+    """
+    Return the distinct words in the byte chunks of a message.
+    """
+    return set(tokens(chunks))
+
+def contains_phrase(chunks, phrase):
+    """
+    Tell whether the words of 'phrase' (a list) follow each other in the
+    message, whatever separates them.
+    """
+    window = collections.deque(maxlen=len(phrase))
+    for word in tokens(chunks):
+        window.append(word)
+        if len(window) == len(phrase) and list(window) == phrase:
+            return True
+    return False
+
+
+def _append(path, lines):
+    with locking.file_lock(path + ".lock"):
+        with open(path, "ab") as f:
+            f.write(b"".join(json.dumps(line).encode() + b"\n" for line in lines))
+
+def record(path, entry_id, message_words):
+    """
+    Add the words of a delivered message to the log at 'path'.
+    """
+    _append(path, [{"id": entry_id, "words": sorted(message_words)}])
+
+def record_deleted(path, ids):
+    if ids and os.path.exists(path):
+        _append(path, [{"deleted": list(ids)}])
+
+
+class SearchIndex:
+    """
+    The inverted index of one log, read incrementally. Messages are numbered
+    in the order the log lists them and each word maps to the sorted array
+    of its message numbers. Callers hold 'lock'.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self._reset(None)
+
+    def _reset(self, inode):
+        self.inode = inode
+        self.offset = 0
+        self.numbers = {}
+        self.ids = []
+        self.postings = {}
+        self.dead = 0
+
+    def _apply(self, line):
+        if "deleted" in line:
+            for entry_id in line["deleted"]:
+                number = self.numbers.pop(entry_id, None)
+                if number is not None:
+                    self.ids[number] = None
+                    self.dead += 1
+            return
+        number = self.numbers.get(line["id"])
+        if number is not None:
+            # Indexed again, by another process catching up
+            self.ids[number] = None
+            self.dead += 1
+        number = self.numbers[line["id"]] = len(self.ids)
+        self.ids.append(line["id"])
+        for word in line["words"]:
+            numbers = self.postings.get(word)
+            if numbers is None:
+                numbers = self.postings[word] = array.array("I")
+            numbers.append(number)
+
+    def refresh(self):
+        """
+        Read what was appended to the log since the last call, or all of it
+        when it was replaced. A line still being written is left for later.
+        """
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            self._reset(None)
+            return
+        with f:
+            stat = os.fstat(f.fileno())
+            if stat.st_ino != self.inode or stat.st_size < self.offset:
+                self._reset(stat.st_ino)
+            f.seek(self.offset)
+            data = f.read(stat.st_size - self.offset)
+        data = data[:data.rfind(b"\n") + 1]
+        for raw in data.splitlines():
+            try:
+                self._apply(json.loads(raw))
+            except (ValueError, KeyError, TypeError):
+                continue
+        self.offset += len(data)
+
+    def add(self, entries, read):
+        """
+        Index the messages of 'entries' the log does not know yet, reading
+        them with 'read(entry)', which yields their bytes.
+        """
+        lines = [{"id": entry["id"], "words": sorted(words(read(entry)))}
+                 for entry in entries if entry["id"] not in self.numbers]
+        if not lines:
+            return
+        _append(self.path, lines)
+        self.refresh()
+
+    def matching(self, query_words):
+        """
+        Return the ids of the indexed messages holding all 'query_words'.
+        """
+        found = None
+        for word in sorted(query_words, key=lambda word: len(self.postings.get(word, ()))):
+            numbers = self.postings.get(word)
+            if numbers is None:
+                return set()
+            found = set(numbers) if found is None else found.intersection(numbers)
+            if not found:
+                return set()
+        return {self.ids[number] for number in found or () if self.ids[number] is not None}
+
+    def compact(self):
+        """
+        Rewrite the log without deleted and superseded lines once they
+        outnumber the live ones.
+        """
+        if self.dead < max(COMPACT_MIN_LINES, len(self.numbers)):
+            return
+        with locking.file_lock(self.path + ".lock"):
+            # Brought up to date under the lock, so no line is lost.
+            self.refresh()
+            lines = {}
+            for word, numbers in self.postings.items():
+                for number in numbers:
+                    entry_id = self.ids[number]
+                    if entry_id is not None:
+                        lines.setdefault(entry_id, []).append(word)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                for entry_id, number in sorted(self.numbers.items(), key=lambda item: item[1]):
+                    line = {"id": entry_id, "words": sorted(lines.get(entry_id, []))}
+                    f.write(json.dumps(line).encode() + b"\n")
+            os.replace(tmp_path, self.path)
+        self._reset(None)
+        self.refresh()
+
+
+_indexes = collections.OrderedDict()
+_indexes_guard = threading.Lock()
+
+def open_index(path):
+    """
+    Return the in-memory index of the log at 'path', shared by the sessions
+    of this process; the least recently used ones are dropped.
+    """
+    with _indexes_guard:
+        index = _indexes.pop(path, None)
+        if index is None:
+            index = SearchIndex(path)
+        _indexes[path] = index
+        while len(_indexes) > CACHED_INDEXES:
+            _indexes.popitem(last=False)
+        return index
+
+def search(path, entries, query, read):
+    """
+    Return the entries among 'entries' holding every word of 'query', and
+    for several words the phrase. 'read(entry)' yields the bytes of a message.
+    """
+    phrase = list(tokens([query.encode()]))
+    if not phrase:
+        return []
+    index = open_index(path)
+    with index.lock:
+        index.refresh()
+        index.add(entries, read)
+        found = index.matching(set(phrase))
+        index.compact()
+    matched = [entry for entry in entries if entry["id"] in found]
+    if len(phrase) > 1:
+        matched = [entry for entry in matched if contains_phrase(read(entry), phrase)]
+    return matched
@@ -0,0 +1,216 @@
+"""
+Serving engines shared by the SMTP and POP3 servers.
+
+A server either runs one process (threaded or asyncio) or, with --workers,
+a supervisor that forks worker processes sharing the port through
+SO_REUSEPORT, or through one listening socket created before the fork where
+the platform lacks it. SIGTERM or SIGINT stops accepting, lets open sessions
+finish for up to SHUTDOWN_GRACE seconds, and then exits.
+"""
+import asyncio
+import errno
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+
+# Listen backlog, sized for bursts of thousands of clients
+BACKLOG = 1024
+# Seconds open sessions get to finish once shutdown starts
+SHUTDOWN_GRACE = 10.0
+# Pause before a crashed worker is started again
+RESTART_DELAY = 1.0
+
+def raise_file_limit():
+    """
+    Raise the soft open-file limit to the hard limit so the asyncio engine
+    can hold more sessions than the usual default of 1024 descriptors.
+    """
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+def make_listener(server_address, reuse_port=False):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if os.name != "nt":
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(server_address)
+    sock.listen(BACKLOG)
+    return sock
+
+def _raise_interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+def _reject(connection, message):
+    try:
+        connection.settimeout(1.0)
+        connection.sendall(message)
+    except OSError:
+        pass
+    finally:
+        connection.close()
+
+def _admitted_session(admission, target, connection, client_address, *args):
+    """
+    Wait for a session slot on the session's own thread, so the accept loop
+    never blocks on a full server, then run the session.
+    """
+    if not admission.acquire(client_address[0]):
+        _reject(connection, admission.busy_message)
+        return
+    print(f"Connection from {client_address} has been established.")
+    try:
+        target(connection, client_address, *args)
+    finally:
+        admission.release()
+
+def run_threaded(target, sock, admission, *args):
+    """
+    Accept connections on 'sock' and run target(connection, client_address,
+    *args) on a thread for each, until SIGTERM or SIGINT. Connections over
+    their rate, or arriving while the admission queue is full, are turned
+    away at once; the others wait for a session slot on their own thread.
+    """
+    signal.signal(signal.SIGTERM, _raise_interrupt)
+    print("Waiting for connections...")
+    sessions = []
+    try:
+        while True:
+            try:
+                connection, client_address = sock.accept()
+            except OSError as e:
+                # Out of descriptors or memory: back off instead of dying.
+                if e.errno not in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM):
+                    raise
+                print(f"ERROR: accept failed: {e}")
+                time.sleep(0.1)
+                continue
+            if not admission.allow(client_address[0]):
+                _reject(connection, admission.busy_message)
+                continue
+            thread = threading.Thread(target=_admitted_session,
+                                      args=(admission, target, connection, client_address) + args)
+            try:
+                thread.start()
+            except RuntimeError:
+                _reject(connection, admission.busy_message)
+                continue
+            sessions = [t for t in sessions if t.is_alive()]
+            sessions.append(thread)
+    except KeyboardInterrupt:
+        print("Shutting down, waiting for open sessions...")
+    finally:
+        sock.close()
+    deadline = time.monotonic() + SHUTDOWN_GRACE
+    for thread in sessions:
+        thread.join(max(deadline - time.monotonic(), 0))
+
+def run_asyncio(handler, sock, admission):
+    """
+    Serve handler(reader, writer) for every connection on one event loop
+    until SIGTERM or SIGINT. Connections are first let in by 'admission'.
+    """
+    async def serve():
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(signum, stop.set)
+            except NotImplementedError:
+                pass
+        sessions = set()
+
+        async def tracked(reader, writer):
+            if not await admission.admit_async(writer.get_extra_info("peername")[0]):
+                writer.write(admission.busy_message)
+                writer.close()
+                return
+            task = asyncio.current_task()
+            sessions.add(task)
+            try:
+                await handler(reader, writer)
+            finally:
+                sessions.discard(task)
+                admission.release_async()
+
+        server = await asyncio.start_server(tracked, sock=sock)
+        print("Waiting for connections...")
+        await stop.wait()
+        print("Shutting down, waiting for open sessions...")
+        server.close()
+        if sessions:
+            await asyncio.wait(sessions, timeout=SHUTDOWN_GRACE)
+
+    raise_file_limit()
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+def run_workers(count, start_worker, server_address):
+    """
+    Fork 'count' worker processes calling start_worker(sock, index) and
+    restart any that crash, until SIGTERM or SIGINT.
+    """
+    reuse_port = hasattr(socket, "SO_REUSEPORT")
+    # Without SO_REUSEPORT the workers accept on one socket made before the fork.
+    shared = None if reuse_port else make_listener(server_address)
+    children = {}
+    stopping = []
+
+    def spawn(index):
+        # Output buffered so far would otherwise be written again by the child.
+        sys.stdout.flush()
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            status = 0
+            try:
+                sock = shared or make_listener(server_address, reuse_port=True)
+                start_worker(sock, index)
+            except BaseException:
+                traceback.print_exc()
+                status = 1
+            finally:
+                os._exit(status)
+        children[pid] = index
+        print(f"Started worker {index} (pid {pid})")
+
+    def stop(signum, frame):
+        if not stopping:
+            stopping.append(time.monotonic() + SHUTDOWN_GRACE + 1)
+            for pid in children:
+                os.kill(pid, signal.SIGTERM)
+
+    for index in range(count):
+        spawn(index)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while children:
+        pid, status = os.waitpid(-1, os.WNOHANG)
+        if pid == 0:
+            if stopping and time.monotonic() > stopping[0]:
+                for pid in children:
+                    os.kill(pid, signal.SIGKILL)
+            time.sleep(0.1)
+            continue
+        index = children.pop(pid)
+        if stopping:
+            continue
+        if status != 0:
+            print(f"Worker {index} (pid {pid}) died with exit code {os.waitstatus_to_exitcode(status)}, restarting")
+            time.sleep(RESTART_DELAY)
+            spawn(index)
+    if shared:
+        shared.close()
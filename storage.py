@@ -0,0 +1,630 @@
+"""
+Mail storage backends shared by the SMTP and POP3 servers.
+
+Every backend keeps the maildrop of each user under the user's directory and
+offers the same operations:
+
+  deliver(username, write, words=None)
+                            add one message; 'write' writes it to a binary
+                            file and 'words', when given, go to the search
+                            index. Returns the paths to fsync.
+  list(username)            a Maildrop: the entries of the messages not
+                            deleted, as mailbox_index describes them, plus
+                            whatever keeps them readable until closed and
+                            their header_index
+  fetch(maildrop, entry, limit=None)
+                            (file, start, stop): a newly opened file holding
+                            the message text in bytes [start, stop), or None
+                            when the message is gone; with 'limit' a backend
+                            may stop after that many bytes of the text
+  delete(username, entries) remove the messages of the given entries
+  size(username)            (messages, octets) of the maildrop
+  words_path(username)      the search_index log of the maildrop
+
+MboxStorage is the original layout: all messages in 'my_mailbox', separated
+by blank lines, with the sidecar index of mailbox_index and compaction of
+deleted mail on a background thread. MaildirStorage keeps one file per
+message in 'Maildir/new' (or 'Maildir/cur'), written in 'Maildir/tmp' and
+renamed into place, so a message may contain blank lines and deliveries and
+deletions never wait on each other. It can also store new messages
+compressed (see compression); migrate_mailbox.py converts mbox maildrops.
+
+Both servers must be started with the same backend.
+
+Sessions never rewrite a maildrop. Delivery only adds messages; a POP3
+session works on the messages listed at login, which stay readable for it
+whatever is delivered, deleted or compacted meanwhile, and at QUIT records
+only its deletions. No lock is held for the length of a session, so SMTP
+delivery never waits on one: the mbox backend holds the mailbox lock for as
+long as it takes to open the mailbox and its index, append tombstones, or
+copy the mail delivered during a compaction, and Maildir takes none.
+
+A backend given a MailboxCache keeps the entries it listed between sessions.
+A login that finds the maildrop unchanged, by the inode, size and mtime of
+its files (mbox) or directories (Maildir), then reads nothing from disk; one
+that finds mail added reads only what is new.
+"""
+import collections
+import functools
+import itertools
+import os
+import queue
+import socket
+import tempfile
+import threading
+import time
+
+import compression
+import header_index
+import locking
+import mailbox_index
+import search_index
+
+# Bytes read from the end of a Maildir message longer than HEADER_READ
+TAIL_READ = 4096
+# Default memory budget of the MailboxCache
+CACHE_BYTES = 64 * 1024 * 1024
+# Estimated bytes a cached entry takes besides its strings
+ENTRY_OVERHEAD = 400
+# A directory changed this recently may change again within the same mtime
+RACY_WINDOW = 1.0
+
+
+class Maildrop:
+    """
+    The messages of one user as listed at login. 'file' is the mbox mailbox
+    held open, or None; 'root' the Maildir the entry paths are relative to.
+    """
+    def __init__(self, entries, file=None, root=None, headers=None, keep=None):
+        self.entries = entries
+        self.file = file
+        self.root = root
+        self._headers = headers
+        self._keep = keep
+
+    def headers(self):
+        """
+        The HeaderIndex of the entries, for date and sender queries: the one
+        the MailboxCache kept, or one built on first use and handed to
+        'keep' for the next sessions.
+        """
+        if self._headers is None:
+            self._headers = header_index.HeaderIndex(self.entries)
+            if self._keep is not None:
+                self._keep(self._headers)
+        return self._headers
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def entry_cost(entry):
+    return ENTRY_OVERHEAD + sum(len(value) for value in entry.values() if isinstance(value, str))
+
+def stat_key(stat):
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+class MailboxCache:
+    """
+    Entries of recently listed maildrops by user, with whatever a backend
+    needs to tell whether they are still current, and the HeaderIndex of
+    the entries once a session built one. The least recently used are
+    dropped once the entries take more than 'budget' bytes (estimated).
+    """
+    def __init__(self, budget=CACHE_BYTES):
+        self.budget = budget
+        self.lock = threading.Lock()
+        self.items = collections.OrderedDict()  # username -> (state, cost, entries, headers)
+        self.used = 0
+
+    def get(self, username):
+        with self.lock:
+            item = self.items.get(username)
+            if item is None:
+                return None
+            self.items.move_to_end(username)
+            return item[0]
+
+    def put(self, username, state, entries, headers=None):
+        cost = sum(entry_cost(entry) for entry in entries)
+        with self.lock:
+            old = self.items.pop(username, None)
+            if old is not None:
+                self.used -= old[1]
+            if cost > self.budget:
+                return
+            self.items[username] = (state, cost, entries, headers)
+            self.used += cost
+            while self.used > self.budget:
+                _, (_, dropped, _, _) = self.items.popitem(last=False)
+                self.used -= dropped
+
+    def headers(self, username, entries):
+        """
+        The HeaderIndex kept with 'entries' while they are the cached entries
+        of 'username', or None.
+        """
+        with self.lock:
+            item = self.items.get(username)
+            return item[3] if item is not None and item[2] is entries else None
+
+    def keep_headers(self, username, entries, headers):
+        """
+        Keep the HeaderIndex of 'entries' while they are the cached entries.
+        """
+        with self.lock:
+            item = self.items.get(username)
+            if item is not None and item[2] is entries:
+                self.items[username] = item[:3] + (headers,)
+
+    def discard(self, username):
+        with self.lock:
+            old = self.items.pop(username, None)
+            if old is not None:
+                self.used -= old[1]
+
+
+# ---------------------------
+# mbox: one file, messages separated by blank lines
+# ---------------------------
+def end_previous_message(file):
+    """
+    Make sure the mailbox ends with a blank line, so an appended mail never
+    runs into the last message of a file that was edited by hand.
+    """
+    end = file.seek(0, os.SEEK_END)
+    if end == 0:
+        return
+    file.seek(max(end - 2, 0))
+    tail = file.read()
+    if tail != b"\n\n":
+        file.write(b"\n" if tail.endswith(b"\n") else b"\n\n")
+
+
+class Compactor:
+    """
+    Compacts mailboxes on a background thread once sessions have deleted
+    enough mail from them.
+    """
+    def __init__(self, store, min_bytes=mailbox_index.COMPACT_MIN_BYTES, ratio=mailbox_index.COMPACT_RATIO):
+        self.store = store
+        self.min_bytes = min_bytes
+        self.ratio = ratio
+        self.pending = queue.Queue()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def request(self, mailbox_file):
+        self.pending.put(mailbox_file)
+
+    def _run(self):
+        while True:
+            mailbox_file = self.pending.get()
+            try:
+                mailbox_index.compact(mailbox_file, self.store, self.min_bytes, self.ratio)
+            except Exception as e:
+                print(f"ERROR: compaction of {mailbox_file} failed: {e}")
+
+
+class MboxStorage:
+    name = "mbox"
+
+    def __init__(self, store, cache=None):
+        self.store = store
+        self.cache = cache
+        self.compactor = None
+
+    def start_compactor(self, min_bytes=mailbox_index.COMPACT_MIN_BYTES, ratio=mailbox_index.COMPACT_RATIO):
+        """
+        Compact mailboxes after deletions; the POP3 server does this.
+        """
+        self.compactor = Compactor(self.store, min_bytes, ratio)
+
+    def path(self, username):
+        return os.path.join(username, "my_mailbox")
+
+    def words_path(self, username):
+        return self.path(username) + search_index.WORDS_SUFFIX
+
+    def deliver(self, username, write, words=None):
+        # Accounts added while running get their mailbox directory on first mail.
+        os.makedirs(username, exist_ok=True)
+        path = self.path(username)
+        with locking.mailbox_lock(path):
+            with open(path, "ab+") as file:
+                end_previous_message(file)
+                write(file)
+            added = mailbox_index.update(path, self.store)
+        # After a rebuild the message is indexed by the first search instead.
+        if words is not None and added:
+            search_index.record(self.words_path(username), added[-1]["id"], words)
+        return [path]
+
+    def list(self, username):
+        """
+        The mailbox stays open in the Maildrop, which keeps the messages
+        readable when the mailbox is compacted meanwhile. The mailbox lock
+        is held only to check the cache or open the mailbox and its index;
+        a long index is read after releasing it.
+        """
+        path = self.path(username)
+        with locking.mailbox_lock(path):
+            found, opened, keys, headers = self._load(username, path)
+            f = open(path, "rb") if found or opened else None
+        if opened is not None:
+            index_file, size, partial = opened
+            with index_file:
+                entries = mailbox_index.read_stored(index_file, size)
+            if entries is None:
+                # Damaged in the middle: rebuild it, this time under the lock.
+                f.close()
+                with locking.mailbox_lock(path):
+                    found = mailbox_index.load_stored(path, self.store)
+                    keys = self._stat(path)
+                    f = open(path, "rb")
+            else:
+                found = entries, partial
+        keep = None
+        if self.cache is not None:
+            if found is None or keys is None:
+                self.cache.discard(username)
+            else:
+                self.cache.put(username, (keys, found[0], found[1]), found[0], headers)
+                keep = functools.partial(self.cache.keep_headers, username, found[0])
+        entries, partial = found or ([], None)
+        if partial:
+            entries = entries + [partial]
+            # Only the stored entries are kept; the partial one is indexed per session.
+            headers = headers.extended([partial]) if headers is not None else None
+            keep = None
+        return Maildrop([entry for entry in entries if not entry["deleted"]], f, headers=headers, keep=keep)
+
+    def _stat(self, path):
+        try:
+            return stat_key(os.stat(path)), stat_key(os.stat(mailbox_index.index_path(path)))
+        except FileNotFoundError:
+            return None
+
+    def _load(self, username, path):
+        """
+        Return (found, opened, keys, headers) with the mailbox lock held.
+        'found' is (stored entries, partial) from the cache when the mailbox
+        and its index are unchanged, or read from what was appended to them
+        when they grew; else 'opened' is what mailbox_index.open_stored()
+        returns. 'keys' are the inode, size and mtime of both files, and
+        'headers' the cached HeaderIndex of the stored entries, extended
+        with the appended ones, or None.
+        """
+        keys = self._stat(path)
+        cached = self.cache.get(username) if self.cache is not None else None
+        if cached is not None and keys is not None:
+            old_keys, entries, partial = cached
+            headers = self.cache.headers(username, entries)
+            if keys == old_keys:
+                return (entries, partial), None, keys, headers
+            if all(new[0] == old[0] and new[1] >= old[1] for new, old in zip(keys, old_keys)):
+                found = mailbox_index.load_since(path, entries, old_keys[1][1], self.store)
+                if found is not None:
+                    if headers is not None:
+                        headers = headers.extended(found[0][len(entries):])
+                    return found, None, self._stat(path), headers
+        opened = mailbox_index.open_stored(path, self.store)
+        return None, opened, self._stat(path), None
+
+    def fetch(self, maildrop, entry, limit=None):
+        f = os.fdopen(os.dup(maildrop.file.fileno()), "rb")
+        return f, entry["offset"], entry["offset"] + entry["length"]
+
+    def delete(self, username, entries):
+        """
+        Record the deletions, leaving the space the messages take to the compactor.
+        """
+        path = self.path(username)
+        with locking.mailbox_lock(path):
+            mailbox_index.delete(path, [entry["id"] for entry in entries], self.store)
+        search_index.record_deleted(self.words_path(username), [entry["id"] for entry in entries])
+        if self.compactor is not None:
+            self.compactor.request(path)
+
+    def size(self, username):
+        path = self.path(username)
+        with locking.mailbox_lock(path):
+            entries = [entry for entry in mailbox_index.load(path, self.store) if not entry["deleted"]]
+        return len(entries), sum(entry["size"] for entry in entries)
+
+
+# ---------------------------
+# Maildir: one file per message
+# ---------------------------
+def name_fields(name):
+    """
+    The ',key=value' fields of a Maildir file name, such as the size S.
+    """
+    fields = {}
+    for field in os.path.basename(name).split(":")[0].split(",")[1:]:
+        key, _, value = field.partition("=")
+        fields[key] = value
+    return fields
+
+
+class MaildirStorage:
+    name = "maildir"
+
+    def __init__(self, store, cache=None, compression=None):
+        self.store = store
+        self.cache = cache
+        # Codec new messages are compressed with, or None
+        self.compression = compression
+        # Dictionaries by Maildir and id, read once
+        self.dictionaries = {}
+        self.counter = itertools.count()
+        self.hostname = socket.gethostname().replace("/", "\\057").replace(":", "\\072")
+
+    def path(self, username):
+        return os.path.join(username, "Maildir")
+
+    def words_path(self, username):
+        return os.path.join(self.path(username), "words")
+
+    def _unique_name(self):
+        # Zero-padded, so names delivered within one mtime sort in order
+        now = time.time()
+        return f"{int(now)}.M{int(now % 1 * 1e6):06d}P{os.getpid()}Q{next(self.counter):06d}.{self.hostname}"
+
+    def _dictionary(self, maildir, dictionary_id):
+        key = (maildir, dictionary_id)
+        zdict = self.dictionaries.get(key)
+        if zdict is None:
+            with open(os.path.join(maildir, "dict", dictionary_id), "rb") as f:
+                zdict = self.dictionaries[key] = f.read()
+        return zdict
+
+    def _current_dictionary(self, maildir):
+        """
+        (id, dictionary) new messages are compressed against, or None.
+        """
+        try:
+            with open(os.path.join(maildir, "dict", "current")) as f:
+                dictionary_id = f.read().strip()
+        except FileNotFoundError:
+            return None
+        return dictionary_id, self._dictionary(maildir, dictionary_id)
+
+    def train_dictionary(self, username, texts):
+        """
+        Train a dictionary from sample message texts and compress the
+        messages delivered from now on against it. Messages compressed
+        against an earlier one keep using theirs. Returns its id.
+        """
+        zdict = compression.train_dictionary(texts)
+        dictionary_id = compression.dictionary_id(zdict)
+        directory = os.path.join(self.path(username), "dict")
+        os.makedirs(directory, exist_ok=True)
+        for name, data in ((dictionary_id, zdict), ("current", dictionary_id.encode())):
+            tmp_path = os.path.join(directory, f".{name}.tmp")
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, os.path.join(directory, name))
+        return dictionary_id
+
+    def _codec(self, maildir, name):
+        """
+        (codec, dictionary) of a compressed message, from the Z field of
+        its name, or None when it is stored as is.
+        """
+        field = name_fields(name).get("Z")
+        if field is None:
+            return None
+        codec, _, dictionary_id = field.partition("-")
+        return codec, self._dictionary(maildir, dictionary_id) if dictionary_id else None
+
+    def deliver(self, username, write, words=None):
+        """
+        Write the message to tmp/ and rename it into new/ once it is on disk,
+        so readers never see a partial message.
+        """
+        maildir = self.path(username)
+        for sub in ("tmp", "new", "cur"):
+            os.makedirs(os.path.join(maildir, sub), exist_ok=True)
+        name = self._unique_name()
+        tmp_path = os.path.join(maildir, "tmp", name)
+        try:
+            with open(tmp_path, "wb") as file:
+                if self.compression:
+                    name += self._write_compressed(maildir, file, write)
+                else:
+                    write(file)
+                    name += f",S={file.tell()}"
+                file.flush()
+                os.fsync(file.fileno())
+            os.rename(tmp_path, os.path.join(maildir, "new", name))
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+        if words is not None:
+            search_index.record(self.words_path(username), name.split(",")[0], words)
+        return [os.path.join(maildir, "new")]
+
+    def _write_compressed(self, maildir, file, write):
+        """
+        Compress the message into 'file'; returns the fields for its name.
+        """
+        zdict = None
+        codec = self.compression
+        if codec == "zlib":
+            current = self._current_dictionary(maildir)
+            if current is not None:
+                dictionary_id, zdict = current
+                codec += "-" + dictionary_id
+        writer = compression.CompressedWriter(file, self.compression, zdict)
+        write(writer)
+        writer.close()
+        # W: the size as served, with LF line ends
+        return f",S={writer.size},W={writer.size - writer.crlf},Z={codec}"
+
+    def _files(self, username):
+        """
+        Yield (id, path relative to the Maildir, stat) of every message.
+        """
+        maildir = self.path(username)
+        for sub in ("new", "cur"):
+            try:
+                scanner = os.scandir(os.path.join(maildir, sub))
+            except FileNotFoundError:
+                continue
+            with scanner:
+                for item in scanner:
+                    if item.name.startswith("."):
+                        continue
+                    try:
+                        stat = item.stat()
+                    except FileNotFoundError:
+                        continue
+                    # The id is the unique name, without size or flags.
+                    yield item.name.split(":")[0].split(",")[0], os.path.join(sub, item.name), stat
+
+    def _entry(self, username, entry_id, name, stat):
+        maildir = self.path(username)
+        codec = self._codec(maildir, name)
+        if codec is not None:
+            return self._compressed_entry(maildir, entry_id, name, codec)
+        with open(os.path.join(maildir, name), "rb") as f:
+            head = f.read(mailbox_index.HEADER_READ)
+            if stat.st_size <= len(head):
+                entry = mailbox_index.make_entry(0, head, None, self.store)
+            else:
+                f.seek(max(stat.st_size - TAIL_READ, len(head)))
+                tail = f.read()
+                offset = len(head) - len(head.lstrip())
+                length = stat.st_size - offset - (len(tail) - len(tail.rstrip()))
+                entry = mailbox_index.make_long_entry(offset, head[offset:], length, None, length)
+        entry.update(id=entry_id, path=name)
+        return entry
+
+    def _compressed_entry(self, maildir, entry_id, name, codec):
+        """
+        Compressed messages hold just their text, whose sizes are in the
+        name: only as much is decompressed as indexing needs.
+        """
+        fields = name_fields(name)
+        length = int(fields["S"])
+        with open(os.path.join(maildir, name), "rb") as f:
+            head = compression.decompress_head(f, *codec, mailbox_index.HEADER_READ)
+        if length <= len(head):
+            entry = mailbox_index.make_entry(0, head, None, self.store)
+        else:
+            entry = mailbox_index.make_long_entry(0, head, length, None, int(fields["W"]))
+        entry.update(id=entry_id, path=name)
+        return entry
+
+    def _stat(self, username):
+        """
+        Return the inode, size and mtime of new/ and cur/, or None when
+        missing or changed so recently that a change within the same mtime
+        could go unnoticed.
+        """
+        maildir = self.path(username)
+        try:
+            stats = [os.stat(os.path.join(maildir, sub)) for sub in ("new", "cur")]
+        except FileNotFoundError:
+            return None
+        if any(time.time() - stat.st_mtime < RACY_WINDOW for stat in stats):
+            return None
+        return [stat_key(stat) for stat in stats]
+
+    def list(self, username):
+        """
+        With a cache, the entries of messages listed before are reused and
+        only new messages are read; so is their HeaderIndex, extended with
+        the new messages as long as none of the old ones went away.
+        """
+        if self.cache is None:
+            return Maildrop(self._list(username, {})[0], root=self.path(username))
+        cached = self.cache.get(username)
+        keys = self._stat(username)
+        headers = self.cache.headers(username, cached[1]) if cached is not None else None
+        if cached is not None and keys is not None and cached[0] == keys:
+            keep = functools.partial(self.cache.keep_headers, username, cached[1])
+            return Maildrop(list(cached[1]), root=self.path(username), headers=headers, keep=keep)
+        known = {entry["path"]: entry for entry in cached[1]} if cached is not None else {}
+        entries, added = self._list(username, known)
+        if headers is not None:
+            headers = headers.extended(added) if len(entries) - len(added) == len(known) else None
+        self.cache.put(username, (keys, entries), entries, headers)
+        keep = functools.partial(self.cache.keep_headers, username, entries)
+        return Maildrop(list(entries), root=self.path(username), headers=headers, keep=keep)
+
+    def _list(self, username, known):
+        """
+        Return the entries of the messages, oldest first, reusing those in
+        'known' by file name, and the entries that were not known.
+        """
+        entries = []
+        added = []
+        for entry_id, name, stat in sorted(self._files(username), key=lambda item: (item[2].st_mtime_ns, item[1])):
+            entry = known.get(name)
+            if entry is None:
+                try:
+                    entry = self._entry(username, entry_id, name, stat)
+                except FileNotFoundError:
+                    # Deleted by another session meanwhile
+                    continue
+                added.append(entry)
+            entries.append(entry)
+        return entries, added
+
+    def fetch(self, maildrop, entry, limit=None):
+        """
+        A compressed message is decompressed into a temporary file, its
+        first 'limit' bytes only when given.
+        """
+        try:
+            f = open(os.path.join(maildrop.root, entry["path"]), "rb")
+        except FileNotFoundError:
+            return None
+        codec = self._codec(maildrop.root, entry["path"])
+        if codec is None:
+            return f, entry["offset"], entry["offset"] + entry["length"]
+        with f:
+            text = tempfile.TemporaryFile()
+            try:
+                length = compression.decompress_to(f, *codec, text, limit)
+                # Served through its descriptor (mmap, sendfile)
+                text.flush()
+            except BaseException:
+                text.close()
+                raise
+        return text, 0, length
+
+    def delete(self, username, entries):
+        maildir = self.path(username)
+        removed = []
+        for entry in entries:
+            try:
+                os.remove(os.path.join(maildir, entry["path"]))
+            except FileNotFoundError:
+                # Deleted by another session, which released the blob
+                continue
+            removed.append(entry["id"])
+            if entry["blob"] is not None:
+                self.store.release(entry["blob"])
+        search_index.record_deleted(self.words_path(username), removed)
+
+    def size(self, username):
+        entries = self.list(username).entries
+        return len(entries), sum(entry["size"] for entry in entries)
+
+
+BACKENDS = {backend.name: backend for backend in (MboxStorage, MaildirStorage)}
+
+def open_storage(name, store, cache=None, compression=None):
+    if compression:
+        return BACKENDS[name](store, cache, compression)
+    return BACKENDS[name](store, cache)
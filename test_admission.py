@@ -0,0 +1,47 @@
+"""
+Admission: connections wait for a session slot, but only so many of them;
+past that they are turned away at once.
+"""
+import asyncio
+import threading
+import time
+
+import admission
+
+
+def limits():
+    return admission.Admission(b"busy", max_sessions=1, queue_timeout=5, connection_rate=0, max_queued=1)
+
+
+def test_a_full_queue_rejects_at_once():
+    gate = limits()
+    assert gate.acquire("a")
+    waiter = threading.Thread(target=lambda: gate.acquire("b") and gate.release())
+    waiter.start()
+    while not gate.queued:
+        time.sleep(0.01)
+    start = time.monotonic()
+    assert not gate.allow("c")
+    assert not gate.acquire("c")
+    assert time.monotonic() - start < 1
+    gate.release()
+    waiter.join()
+    assert gate.queued == 0
+    assert gate.allow("c")
+
+
+def test_a_full_queue_rejects_at_once_with_asyncio():
+    async def run():
+        gate = limits()
+        assert await gate.admit_async("a")
+        waiter = asyncio.ensure_future(gate.admit_async("b"))
+        while not gate.queued:
+            await asyncio.sleep(0.01)
+        start = time.monotonic()
+        assert not await gate.admit_async("c")
+        assert time.monotonic() - start < 1
+        gate.release_async()
+        assert await waiter
+        assert gate.queued == 0
+
+    asyncio.run(run())
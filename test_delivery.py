@@ -0,0 +1,168 @@
+"""
+The delivery journal: mail accepted before a crash is delivered on the next
+start, a record cut short is ignored, and failed deliveries are retried.
+"""
+import json
+import os
+import re
+import threading
+import time
+
+import delivery
+import mailserver_smtp
+import message_store
+import storage
+
+
+def failing(item):
+    raise OSError("disk full")
+
+def restore(meta, payload):
+    return payload
+
+def submit(queue, payload):
+    queue.submit({"sender": "a@b.c"}, len(payload), [payload], payload)
+
+
+class Recorder:
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.items = []
+        self.lock = threading.Lock()
+
+    def __call__(self, item):
+        with self.lock:
+            if self.failures:
+                self.failures -= 1
+                raise OSError("try again")
+            self.items.append(item)
+        return []
+
+
+def test_pending_mail_is_delivered_after_a_restart(tmp_path):
+    path = str(tmp_path / "queue" / "journal")
+    crashed = delivery.DeliveryQueue(path, failing, restore, retry_attempts=0)
+    payloads = [b"message %d\n.\nwith a dot line" % i for i in range(3)]
+    for payload in payloads:
+        submit(crashed, payload)
+    crashed.drain(5)
+    assert sorted(payload for _, payload in delivery.read_journal(path)) == payloads
+
+    recorder = Recorder()
+    restarted = delivery.DeliveryQueue(path, recorder, restore)
+    restarted.drain(5)
+    assert sorted(recorder.items) == payloads
+    assert delivery.read_journal(path) == []
+
+
+def test_a_torn_record_is_ignored(tmp_path):
+    path = str(tmp_path / "journal")
+    meta = {"id": "whole", "size": 5, "sender": "a@b.c"}
+    with open(path, "wb") as f:
+        f.write(b"M " + json.dumps(meta).encode() + b"\nhello\n")
+        f.write(b"M " + json.dumps(dict(meta, id="torn", size=100)).encode() + b"\ncut sh")
+    assert [meta["id"] for meta, _ in delivery.read_journal(path)] == ["whole"]
+
+    recorder = Recorder()
+    queue = delivery.DeliveryQueue(path, recorder, restore)
+    queue.drain(5)
+    assert recorder.items == [b"hello"]
+    with open(path, "rb") as f:
+        assert b"cut sh" not in f.read()
+
+
+def test_a_failed_delivery_is_retried(tmp_path):
+    recorder = Recorder(failures=2)
+    released = []
+    queue = delivery.DeliveryQueue(str(tmp_path / "journal"), recorder, restore, retry_base=0.01,
+                                   release=released.append)
+    submit(queue, b"retried")
+    queue.drain(5)
+    assert recorder.items == [b"retried"]
+    assert released == [b"retried"]
+    assert delivery.read_journal(queue.journal_path) == []
+
+
+class FailingOnce:
+    """
+    Mailbox storage whose first delivery to 'username' fails.
+    """
+    def __init__(self, backend, username):
+        self.backend = backend
+        self.username = username
+
+    def deliver(self, username, write, words=None):
+        if username == self.username:
+            self.username = None
+            raise OSError("disk full")
+        return self.backend.deliver(username, write, words)
+
+
+def test_a_retried_mail_is_written_once_to_every_mailbox(workdir, monkeypatch):
+    monkeypatch.chdir(workdir)
+    blobs = message_store.BlobStore()
+    monkeypatch.setattr(mailserver_smtp, "blobStore", blobs)
+    monkeypatch.setattr(mailserver_smtp, "mailStorage", FailingOnce(storage.MboxStorage(blobs), "robbe"))
+    queue = delivery.DeliveryQueue("queue/journal", mailserver_smtp.writeMailOnDisk, mailserver_smtp.restoreMail,
+                                   retry_base=0.01, release=mailserver_smtp.Mail.close)
+    monkeypatch.setattr(mailserver_smtp, "deliveryQueue", queue)
+    body = b"".join(b"line %d\n" % i for i in range(100))
+    mail = mailserver_smtp.restoreMail({"sender": "a@b.c", "rcpts": ["lander@email.com", "robbe@email.com"],
+                                        "stored": True}, b"Subject: retried\n\n" + body + b"\n")
+    mailserver_smtp.queueMail(mail)
+    queue.drain(5)
+    assert delivery.read_journal(queue.journal_path) == []
+    assert mail.chunks == [] and mail.spool is None
+    for username in ["lander", "robbe"]:
+        with open(f"{username}/my_mailbox", "rb") as f:
+            mailbox = f.read()
+        assert mailbox.count(b"Subject: retried") == 1
+        digest = re.search(rb"Subject: retried\n+X-Blob: (\w+)", mailbox).group(1).decode()
+        with blobs.open(digest) as f:
+            assert f.read() == b"\n" + body + b"\n"
+
+
+def test_drain_does_not_wait_for_mail_given_up(tmp_path):
+    queue = delivery.DeliveryQueue(str(tmp_path / "journal"), failing, restore, retry_attempts=2, retry_base=0.01)
+    submit(queue, b"undeliverable")
+    start = time.monotonic()
+    queue.drain(10)
+    assert time.monotonic() - start < 5
+    assert queue.outstanding == 0
+    assert [payload for _, payload in delivery.read_journal(queue.journal_path)] == [b"undeliverable"]
+
+
+def test_concurrent_submissions_are_all_journaled(tmp_path):
+    recorder = Recorder()
+    queue = delivery.DeliveryQueue(str(tmp_path / "journal"), recorder, restore)
+    payloads = [b"%d" % i * (i * 1000 + 1) for i in range(20)]
+    threads = [threading.Thread(target=submit, args=(queue, payload)) for payload in payloads]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    queue.drain(5)
+    assert sorted(recorder.items) == sorted(payloads)
+    assert delivery.read_journal(queue.journal_path) == []
+
+
+def test_merged_journals_keep_their_pending_records(tmp_path):
+    target, source = str(tmp_path / "journal"), str(tmp_path / "journal.2")
+    for path, payload in [(target, b"kept"), (source, b"orphaned")]:
+        submit(delivery.DeliveryQueue(path, failing, restore, retry_attempts=0), payload)
+    assert delivery.merge_journal(source, target) == 2
+    assert sorted(payload for _, payload in delivery.read_journal(target)) == [b"kept", b"orphaned"]
+    assert not (tmp_path / "journal.2").exists()
+
+
+def test_mail_left_by_a_worker_no_longer_started_is_delivered(workdir, start_server, pop_login):
+    orphan = delivery.DeliveryQueue(str(workdir / "queue" / "journal.3"), failing, restore, retry_attempts=0)
+    meta = {"sender": "a@b.c", "rcpts": ["lander@email.com"], "stored": True}
+    payload = b"Subject: orphaned\nbody\n"
+    orphan.submit(meta, len(payload), [payload], payload)
+    orphan.drain(5)
+
+    start_server("mailserver_smtp.py")
+    client = pop_login(start_server("pop_server.py"), 4)
+    assert b"Subject: orphaned\nbody\n" in client.command("RETR 4", multiline=True)
+    assert sorted(os.listdir(workdir / "queue")) == ["journal"]
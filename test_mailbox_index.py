@@ -0,0 +1,133 @@
+"""
+Compaction of an mbox maildrop while mail is delivered to it: no message is
+lost or resurrected, the index keeps matching the mailbox, and a session
+that listed the mailbox before still reads its messages.
+"""
+import os
+import random
+import threading
+
+import mailbox_index
+import message_store
+import storage
+
+USER = "lander"
+
+
+def message(i):
+    return b"From: a@b.c\nTo: lander@email.com\nSubject: m%d\n" % i + b"line of m%d\n" % i * random.randint(1, 200)
+
+def subjects(mbox):
+    maildrop = mbox.list(USER)
+    try:
+        found = {}
+        for entry in maildrop.entries:
+            f, start, stop = mbox.fetch(maildrop, entry)
+            with f:
+                f.seek(start)
+                text = mailbox_index.decode(f.read(stop - start))
+            found[entry["subject"]] = text
+        return found
+    finally:
+        maildrop.close()
+
+
+def test_compaction_with_concurrent_deliveries(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(USER)
+    store = message_store.BlobStore()
+    mbox = storage.MboxStorage(store)
+    path = mbox.path(USER)
+    sent = 300
+    deleted = set()
+
+    def deliver():
+        for i in range(sent):
+            mbox.deliver(USER, lambda file, i=i: file.write(message(i) + b"\n\n"))
+
+    sender = threading.Thread(target=deliver)
+    sender.start()
+    compactions = 0
+    old = None
+    try:
+        while sender.is_alive() or compactions < 3:
+            maildrop = mbox.list(USER)
+            doomed = [entry for entry in maildrop.entries if random.random() < 0.3]
+            if old is None and len(maildrop.entries) > 20:
+                # Kept open across the compactions that follow
+                old = maildrop
+            else:
+                maildrop.close()
+            mbox.delete(USER, doomed)
+            deleted.update(entry["subject"] for entry in doomed)
+            if mailbox_index.compact(path, store, min_bytes=0, ratio=0):
+                compactions += 1
+    finally:
+        # Not left writing to relative paths once the test left tmp_path
+        sender.join()
+    mailbox_index.compact(path, store, min_bytes=0, ratio=0)
+
+    found = subjects(mbox)
+    assert set(found) == {"m%d" % i for i in range(sent)} - deleted
+    for subject, text in found.items():
+        assert text.startswith("From: a@b.c\nTo: lander@email.com\nSubject: %s\n" % subject)
+        assert set(text.splitlines()[3:]) == {"line of %s" % subject}
+
+    # The index is what a rebuild of the compacted mailbox finds.
+    indexed = [(entry["offset"], entry["length"]) for entry in mailbox_index.load(path, store) if not entry["deleted"]]
+    os.remove(mailbox_index.index_path(path))
+    rebuilt = [(entry["offset"], entry["length"]) for entry in mailbox_index.load(path, store)]
+    assert indexed == rebuilt
+
+    for entry in old.entries:
+        f, start, stop = mbox.fetch(old, entry)
+        with f:
+            f.seek(start)
+            assert mailbox_index.decode(f.read(stop - start)).splitlines()[2] == "Subject: " + entry["subject"]
+    old.close()
+
+
+def compacted_mailbox(mbox, store):
+    for i in range(10):
+        mbox.deliver(USER, lambda file, i=i: file.write(message(i) + b"\n\n"))
+    maildrop = mbox.list(USER)
+    maildrop.close()
+    mbox.delete(USER, maildrop.entries[:5])
+    path = mbox.path(USER)
+    with open(mailbox_index.index_path(path), "rb") as f:
+        old_index = f.read()
+    assert mailbox_index.compact(path, store, min_bytes=0, ratio=0)
+    return path, old_index
+
+
+def test_a_compaction_cut_short_after_the_mailbox_swap_is_finished(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(USER)
+    store = message_store.BlobStore()
+    mbox = storage.MboxStorage(store)
+    path, old_index = compacted_mailbox(mbox, store)
+    # The new mailbox is in place, its index not yet.
+    index = mailbox_index.index_path(path)
+    os.replace(index, index + mailbox_index.COMPACT_SUFFIX)
+    with open(index, "wb") as f:
+        f.write(old_index)
+
+    assert sorted(subjects(mbox)) == ["m%d" % i for i in range(5, 10)]
+    assert not os.path.exists(index + mailbox_index.COMPACT_SUFFIX)
+
+
+def test_a_compaction_cut_short_before_the_mailbox_swap_is_dropped(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(USER)
+    store = message_store.BlobStore()
+    mbox = storage.MboxStorage(store)
+    path, _ = compacted_mailbox(mbox, store)
+    index = mailbox_index.index_path(path)
+    # Both new files written, neither swapped in yet
+    with open(path + mailbox_index.COMPACT_SUFFIX, "wb") as f:
+        f.write(b"")
+    with open(index + mailbox_index.COMPACT_SUFFIX, "wb") as f:
+        f.write(b"not the index of this mailbox\n")
+
+    assert sorted(subjects(mbox)) == ["m%d" % i for i in range(5, 10)]
+    assert not os.path.exists(index + mailbox_index.COMPACT_SUFFIX)
@@ -0,0 +1,187 @@
+"""
+Receiving mail: the DATA end-of-data parser and dot transparency, and BDAT
+chunks, which must store the same bytes as DATA.
+"""
+import pytest
+
+import mailserver_smtp
+from mailserver_smtp import Mail, findTerminator
+
+MESSAGE = b"Subject: split\r\nReceived: 01/02/2025 : 10 : 00\r\n\r\nfirst line\r\nsecond line\r\n"
+
+
+def receive_data(chunks):
+    """
+    Feed DATA chunks to a Mail; returns it and what followed the terminator.
+    """
+    mail = Mail("a@b.c")
+    mail.addRcpt("lander@email.com")
+    mail.startReceivingData()
+    rest = b""
+    for chunk in chunks:
+        if mail.bodyComplete:
+            rest += chunk
+            continue
+        used = mail.appendToBody(chunk)
+        rest += chunk[used:]
+    return mail, rest
+
+def receive_bdat(chunks):
+    mail = Mail("a@b.c")
+    mail.addRcpt("lander@email.com")
+    for i, chunk in enumerate(chunks):
+        mail.startChunk(len(chunk), i == len(chunks) - 1)
+        mail.appendChunk(chunk)
+        mail.endChunk()
+    return mail
+
+def splits(data):
+    return [[data[:i], data[i:]] for i in range(1, len(data))]
+
+
+def test_find_terminator():
+    assert findTerminator(b"body\n.\n") == (4, 3)
+    assert findTerminator(b"body\r\n.\r\n") == (5, 4)
+    assert findTerminator(b"a\n.\r\nb\n.\n") == (1, 4)
+    assert findTerminator(b"body\n..\n") is None
+    assert findTerminator(b"body.\n") is None
+
+
+@pytest.mark.parametrize("chunks", splits(MESSAGE + b".\r\nQUIT\r\n"))
+def test_data_terminator_split_between_chunks(chunks):
+    mail, rest = receive_data(chunks)
+    assert mail.bodyComplete
+    assert rest == b"QUIT\r\n"
+    assert mail.subject == "split"
+    assert mail.body == MESSAGE.replace(b"\r\n", b"\n").decode().rstrip("\n")
+
+
+def test_data_without_terminator_is_incomplete():
+    mail, rest = receive_data([MESSAGE, b".line\r\n", b"\r\n."])
+    assert not mail.bodyComplete
+    assert rest == b""
+
+
+def test_data_spooled_to_file():
+    Mail.spoolThreshold, threshold = 1024, Mail.spoolThreshold
+    try:
+        body = b"".join(b"line %d\r\n" % i for i in range(1000))
+        mail, _ = receive_data([b"Subject: big\r\n" + body[:5000], body[5000:] + b".\r\n"])
+    finally:
+        Mail.spoolThreshold = threshold
+    assert mail.spool is not None
+    assert mail.body == "Subject: big\n" + body.replace(b"\r\n", b"\n").decode().rstrip("\n")
+    mail.close()
+
+
+@pytest.mark.parametrize("chunks", [[MESSAGE]] + splits(MESSAGE) + [[MESSAGE[:5], MESSAGE[5:15], b"", MESSAGE[15:]]])
+def test_bdat_stores_what_data_stores(chunks):
+    data, _ = receive_data([MESSAGE + b".\r\n"])
+    mail = receive_bdat(chunks)
+    assert mail.bodyComplete
+    assert mail.bodyLength == data.bodyLength
+    assert mail.headers == data.headers
+    assert mail.toString("lander@email.com") == data.toString("lander@email.com")
+
+
+def test_bdat_keeps_a_final_lone_cr():
+    mail = receive_bdat([b"Subject: cr\r\nbody\r"])
+    assert mail.body == "Subject: cr\nbody\r"
+
+
+def test_bdat_over_the_wire_matches_data(start_server, connect, send_mail, pop_login):
+    # Maildir, as the message holds a blank line
+    smtp_port = start_server("mailserver_smtp.py", "--storage", "maildir")
+    pop_port = start_server("pop_server.py", "--storage", "maildir")
+    assert send_mail(smtp_port, ["lander@email.com"], MESSAGE.decode()[:-2]).startswith(b"250")
+    client = connect(smtp_port)
+    client.smtp("EHLO me")
+    client.smtp("MAIL FROM: <a@b.c>")
+    client.smtp("RCPT TO: <lander@email.com>")
+    client.send(b"BDAT 20\r\n" + MESSAGE[:20])
+    assert client.sock.recv(100).startswith(b"250")
+    client.send(b"BDAT %d LAST\r\n" % (len(MESSAGE) - 20) + MESSAGE[20:])
+    assert client.sock.recv(100).startswith(b"250")
+
+    pop = pop_login(pop_port, 2)
+    sizes = [line.split()[1] for line in pop.command("LIST", multiline=True).splitlines()[1:-1]]
+    assert sizes[0] == sizes[1]
+    data = pop.command("RETR 1", multiline=True)
+    chunked = pop.command("RETR 2", multiline=True)
+    assert b"\r" not in chunked
+    assert chunked.split(b"\n", 1)[1] == data.split(b"\n", 1)[1]
+
+
+# Data that would be run as commands if a refused BDAT left it unread
+COMMANDS = b"RSET\r\nQUIT\r\n"
+
+
+@pytest.mark.parametrize("mode", ["threaded", "asyncio"])
+def test_a_refused_bdat_chunk_is_dropped(start_server, connect, mode):
+    client = connect(start_server("mailserver_smtp.py", "--mode", mode))
+    client.smtp("EHLO me")
+    client.send(b"BDAT %d LAST\r\n" % len(COMMANDS) + COMMANDS)
+    assert client.sock.recv(100).startswith(b"500")
+    assert client.smtp("NOOP") == b"250 OK"
+    client.smtp("MAIL FROM: <a@b.c>")
+    client.smtp("RCPT TO: <lander@email.com>")
+    client.send(b"BDAT %d NOW\r\n" % len(COMMANDS) + COMMANDS)
+    assert client.sock.recv(100).startswith(b"501")
+    client.send(b"BDAT %d LAST\r\n" % len(MESSAGE) + MESSAGE)
+    assert client.sock.recv(100).startswith(b"250 OK, message accepted")
+
+
+class Connection:
+    def sendall(self, data):
+        raise AssertionError("replied before the chunk was read")
+
+    def getpeername(self):
+        return ("127.0.0.1", 0)
+
+
+def test_bdat_after_data_is_refused():
+    mail, _ = receive_data([MESSAGE])
+    continues, rejected = mailserver_smtp.handleCommand(Connection(), "BDAT 12 LAST\r\n", mail)
+    assert continues and rejected.size == 12 and rejected.mail is mail
+    assert rejected.reply.startswith("503")
+
+
+DOTTED = b"..dotted\r\nmid..dle\r\n..\r\n...\r\nend"
+
+
+@pytest.mark.parametrize("chunks", splits(DOTTED + b"\r\n.\r\n"))
+def test_data_drops_the_transparency_dot(chunks):
+    mail, rest = receive_data(chunks)
+    assert mail.bodyComplete
+    assert rest == b""
+    assert mail.body == ".dotted\nmid..dle\n.\n..\nend"
+
+
+def test_empty_data():
+    mail, rest = receive_data([b".\r\nQUIT\r\n"])
+    assert mail.bodyComplete
+    assert rest == b"QUIT\r\n"
+    assert mail.body == ""
+
+
+class Journal:
+    def submit(self, meta, size, chunks, item):
+        self.meta, self.payload = meta, b"".join(chunks)
+        assert len(self.payload) == size
+
+
+def test_journal_record_restores_the_same_mail(monkeypatch):
+    journal = Journal()
+    monkeypatch.setattr(mailserver_smtp, "deliveryQueue", journal)
+    mail, _ = receive_data([b"Subject: s\r\n" + DOTTED + b"\r\n\r\n.\r\n"])
+    mailserver_smtp.queueMail(mail)
+    restored = mailserver_smtp.restoreMail(journal.meta, journal.payload)
+    assert restored.body == mail.body
+    assert restored.subject == "s"
+    assert restored.toString("lander@email.com") == mail.toString("lander@email.com")
+
+
+def test_journal_record_of_an_earlier_version():
+    restored = mailserver_smtp.restoreMail({"sender": "a@b.c", "rcpts": ["lander@email.com"], "chunked": False},
+                                           b"Subject: s\n..dotted\n.\n")
+    assert restored.body == "Subject: s\n.dotted"
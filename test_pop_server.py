@@ -0,0 +1,52 @@
+"""
+TOP: the header lines, a blank line and the first lines of the body, for
+messages stored inline and bodies stored as a shared blob.
+"""
+import pytest
+
+HEADERS = b"From: a@b.c\nTo: lander@email.com\nSubject: s\n"
+
+
+@pytest.fixture(params=["maildir", "mbox"])
+def servers(request, start_server):
+    storage = ["--storage", request.param]
+    return request.param, start_server("mailserver_smtp.py", *storage), start_server("pop_server.py", *storage)
+
+
+def top(client, number, lines):
+    reply = client.command(f"TOP {number} {lines}", multiline=True)
+    assert reply.startswith(b"+OK")
+    return reply.split(b"\n", 1)[1]
+
+
+def test_top_skips_the_blank_line_after_the_headers(servers, send_mail, pop_login):
+    storage, smtp_port, pop_port = servers
+    rcpts = ["lander@email.com"]
+    if storage == "mbox":
+        # Blank lines separate mbox messages, but a body shared with another
+        # recipient is kept whole in a blob.
+        rcpts.append("robbe@email.com")
+    send_mail(smtp_port, rcpts, "Subject: s\r\n\r\nbody1\r\nbody2")
+    client = pop_login(pop_port, 1)
+    number = int(client.command("STAT").split()[1])
+    assert top(client, number, 0) == HEADERS + b"\n.\n"
+    assert top(client, number, 1) == HEADERS + b"\nbody1\n.\n"
+    assert top(client, number, 5) == HEADERS + b"\nbody1\nbody2\n.\n"
+
+
+def test_top_of_a_message_without_a_blank_line(servers, send_mail, pop_login):
+    _, smtp_port, pop_port = servers
+    send_mail(smtp_port, ["lander@email.com"], "Subject: s\r\nline1\r\n..dot\r\nline3")
+    client = pop_login(pop_port, 1)
+    number = int(client.command("STAT").split()[1])
+    assert top(client, number, 0) == HEADERS + b"\n.\n"
+    # Lines starting with "." are stuffed as in RETR
+    assert top(client, number, 2) == HEADERS + b"\nline1\n..dot\n.\n"
+    assert top(client, number, 9) == HEADERS + b"\nline1\n..dot\nline3\n.\n"
+
+
+def test_top_errors(servers, pop_login):
+    _, _, pop_port = servers
+    client = pop_login(pop_port)
+    assert client.command("TOP 99 1").startswith(b"-ERR")
+    assert client.command("TOP 1").startswith(b"-ERR")
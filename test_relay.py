@@ -0,0 +1,161 @@
+"""
+Relaying mail for remote recipients through --relay-host, against a local
+stand-in SMTP listener.
+"""
+import json
+import os
+import socketserver
+import threading
+import time
+
+import pytest
+
+
+class StandIn(socketserver.ThreadingTCPServer):
+    """
+    Accepts mail like a remote server would. The first 'temporary' RCPT
+    commands get a 451 and recipients starting with "bad" a 550.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, temporary=0):
+        super().__init__(("127.0.0.1", 0), StandInHandler)
+        self.temporary = temporary
+        self.rcpts = []
+        self.messages = []
+        self.lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def wait_for(self, count, timeout=10):
+        deadline = time.monotonic() + timeout
+        while len(self.messages) < count and time.monotonic() < deadline:
+            time.sleep(0.05)
+        return self.messages
+
+
+class StandInHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line + b"\r\n")
+
+    def handle(self):
+        server = self.server
+        self.reply(b"220 stand-in")
+        envelope = {"rcpts": []}
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line[:4].upper()
+            if command == b"EHLO":
+                self.reply(b"250-stand-in\r\n250 8BITMIME")
+            elif command == b"MAIL":
+                envelope = {"sender": line[10:].strip(), "rcpts": []}
+                self.reply(b"250 OK")
+            elif command == b"RCPT":
+                rcpt = line[8:].strip().strip(b"<>")
+                with server.lock:
+                    server.rcpts.append(rcpt)
+                    if server.temporary:
+                        server.temporary -= 1
+                        self.reply(b"451 Try again later")
+                        continue
+                if rcpt.startswith(b"bad"):
+                    self.reply(b"550 No such user")
+                    continue
+                envelope["rcpts"].append(rcpt)
+                self.reply(b"250 OK")
+            elif command == b"DATA":
+                self.reply(b"354 Go ahead")
+                lines = []
+                while True:
+                    line = self.rfile.readline()
+                    if line in (b".\r\n", b""):
+                        break
+                    lines.append(line)
+                with server.lock:
+                    server.messages.append(dict(envelope, data=b"".join(lines)))
+                self.reply(b"250 OK")
+            elif command == b"QUIT":
+                self.reply(b"221 Bye")
+                return
+            else:
+                self.reply(b"250 OK")
+
+
+@pytest.fixture
+def stand_in():
+    servers = []
+
+    def start(temporary=0):
+        server = StandIn(temporary)
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def relay_server(start_server, stand_in):
+    return start_server("mailserver_smtp.py", "--relay", "--relay-host", "127.0.0.1:%d" % stand_in.server_address[1],
+                        "--relay-retry", "0.2")
+
+
+def test_remote_mail_is_relayed(workdir, start_server, stand_in, send_mail, pop_login):
+    remote = stand_in()
+    smtp_port = relay_server(start_server, remote)
+    pop_port = start_server("pop_server.py")
+    reply = send_mail(smtp_port, ["far@remote.org", "lander@email.com", "bad@remote.org"],
+                      "Subject: hi\r\n..line\r\nbody", sender="x@y.com")
+    assert reply.startswith(b"250")
+
+    message, = remote.wait_for(1)
+    assert message["sender"] == b"<x@y.com>"
+    assert message["rcpts"] == [b"far@remote.org"]
+    # CRLF line endings, and the dot line stuffed on the wire as it came in
+    assert b"Subject: hi\r\n..line\r\nbody\r\n" in message["data"]
+    # The local recipient gets its copy as usual.
+    client = pop_login(pop_port, 4)
+    assert b"Subject: hi\n..line\nbody\n.\n" in client.command("RETR 4", multiline=True)
+
+    deadline = time.monotonic() + 5
+    outbound = workdir / "queue" / "outbound"
+    while os.listdir(outbound) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert os.listdir(outbound) == []
+    # Refused for good: not tried again
+    time.sleep(0.5)
+    assert remote.rcpts.count(b"bad@remote.org") == 1
+
+
+def test_temporary_failures_are_retried(start_server, stand_in, send_mail):
+    remote = stand_in(temporary=2)
+    smtp_port = relay_server(start_server, remote)
+    assert send_mail(smtp_port, ["far@remote.org"], "Subject: later\r\nbody").startswith(b"250")
+    message, = remote.wait_for(1)
+    assert message["rcpts"] == [b"far@remote.org"]
+    assert remote.rcpts.count(b"far@remote.org") == 3
+
+
+def test_relay_refused_without_relay(start_server, connect):
+    client = connect(start_server("mailserver_smtp.py"))
+    client.smtp("HELO me")
+    client.smtp("MAIL FROM: <x@y.com>")
+    assert client.smtp("RCPT TO: <far@remote.org>").startswith(b"550")
+
+
+def test_a_queue_left_by_a_worker_no_longer_started_is_sent(workdir, start_server, stand_in):
+    remote = stand_in()
+    host = "127.0.0.1:%d" % remote.server_address[1]
+    orphan = workdir / "queue" / "outbound.2"
+    os.makedirs(orphan)
+    (orphan / "e1.msg").write_bytes(b"Subject: orphaned\nbody\n")
+    (orphan / "e1.json").write_text(json.dumps({"id": "e1", "sender": "x@y.com", "rcpts": ["far@remote.org"],
+                                                "host": host, "queued": time.time(), "attempts": 0,
+                                                "next_attempt": 0}))
+    relay_server(start_server, remote)
+    message, = remote.wait_for(1)
+    assert b"Subject: orphaned\r\nbody\r\n" in message["data"]
+    assert not orphan.exists()
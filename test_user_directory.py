@@ -0,0 +1,33 @@
+"""
+Logins: failed ones are counted per user and client address, and unknown
+users are hashed like known ones.
+"""
+import user_directory
+
+
+def directory(tmp_path):
+    path = tmp_path / "userinfo.txt"
+    path.write_text(f"lander {user_directory.hash_password('wachtwoord', n=2 ** 10)}\n")
+    return user_directory.UserDirectory(str(path), failure_limit=2)
+
+
+def test_failed_logins_are_counted_per_client_address(tmp_path):
+    users = directory(tmp_path)
+    for _ in range(2):
+        assert not users.authenticate("lander", "guess", "10.0.0.1")
+    assert users.throttled("lander", "10.0.0.1")
+    assert not users.authenticate("lander", "wachtwoord", "10.0.0.1")
+    # The owner, elsewhere, is not locked out.
+    assert not users.throttled("lander", "10.0.0.2")
+    assert users.authenticate("lander", "wachtwoord", "10.0.0.2")
+
+
+def test_unknown_users_are_hashed_too(tmp_path, monkeypatch):
+    users = directory(tmp_path)
+    checked = []
+    verify = user_directory.verify_password
+    monkeypatch.setattr(user_directory, "verify_password",
+                        lambda credential, password: checked.append(credential) or verify(credential, password))
+    assert not users.authenticate("nobody", "guess", "10.0.0.1")
+    assert not users.authenticate("lander", "guess", "10.0.0.1")
+    assert len(checked) == 2 and all(user_directory.is_hashed(credential) for credential in checked)
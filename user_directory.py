@@ -0,0 +1,294 @@
+"""
+User directory shared by the SMTP and POP3 servers.
+
+Accounts are read from userinfo.txt, one per line:
+
+  <username> <password> [<address> [<alias> ...]]
+
+The address defaults to <username>@DEFAULT_DOMAIN; aliases are extra
+addresses delivering to the same mailbox. Lookups by name and by address are
+dictionary hits. The file is checked for changes at most every
+POLL_INTERVAL seconds and reloaded into a new snapshot that replaces the old
+one in a single assignment, so lookups never see a half-loaded directory.
+
+The password is stored salted and hashed with scrypt
+('scrypt$<n>$<r>$<p>$<salt>$<hash>'); plaintext passwords still work, and
+'python user_directory.py' hashes those in place. scrypt is slow on
+purpose, so a login it verified is remembered for VERIFIED_TTL seconds
+(keyed by a keyed digest of the password, never the password itself) and
+clients polling every minute pay for it about once per TTL. After
+FAILURE_LIMIT failed logins from one client address a user is refused there
+for FAILURE_WINDOW seconds without hashing anything, so others cannot lock
+the owner out. A login as an unknown user is checked against a dummy hash,
+taking as long as one with a wrong password.
+"""
+import argparse
+import base64
+import collections
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+import time
+
+USERINFO_FILE = "userinfo.txt"
+DEFAULT_DOMAIN = "email.com"
+POLL_INTERVAL = 1.0
+
+# scrypt cost parameters of new hashes (16 MiB, ~50 ms per check)
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+SALT_BYTES = 16
+# Seconds a verified login is remembered, and how many are
+VERIFIED_TTL = 300.0
+VERIFIED_ENTRIES = 10000
+# Failed logins after which a user is refused from that client address,
+# for FAILURE_WINDOW seconds
+FAILURE_LIMIT = 5
+FAILURE_WINDOW = 60.0
+# (user, client address) pairs whose failed logins are tracked at once
+FAILURE_ENTRIES = 10000
+
+User = collections.namedtuple("User", "name password address aliases")
+Snapshot = collections.namedtuple("Snapshot", "by_name by_address")
+
+
+def load_users(path, domain=DEFAULT_DOMAIN):
+    """
+    Parse the user file into a Snapshot indexed by username and address.
+    """
+    by_name = {}
+    by_address = {}
+    with open(path, "r") as f:
+        for line in f:
+            parts = line.strip().split()
+            if len(parts) < 2 or parts[0].startswith("#"):
+                continue
+            name, password = parts[0], parts[1]
+            addresses = parts[2:] or [f"{name}@{domain}"]
+            user = User(name, password, addresses[0], tuple(addresses[1:]))
+            by_name[name] = user
+            for address in addresses:
+                by_address[address.lower()] = user
+    return Snapshot(by_name, by_address)
+
+
+# ---------------------------
+# Password hashing
+# ---------------------------
+def _b64(data):
+    return base64.b64encode(data).decode()
+
+def hash_password(password, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P):
+    """
+    Return the stored form of a password, salted and hashed with scrypt.
+    """
+    salt = secrets.token_bytes(SALT_BYTES)
+    digest = hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p)
+    return f"scrypt${n}${r}${p}${_b64(salt)}${_b64(digest)}"
+
+def is_hashed(credential):
+    return credential.startswith("scrypt$")
+
+def verify_password(credential, password):
+    """
+    Check a password against its stored form, hashed or plaintext.
+    """
+    if not is_hashed(credential):
+        return hmac.compare_digest(credential.encode(), password.encode())
+    try:
+        _, n, r, p, salt, digest = credential.split("$")
+        digest = base64.b64decode(digest)
+        computed = hashlib.scrypt(password.encode(), salt=base64.b64decode(salt), n=int(n), r=int(r), p=int(p),
+                                  maxmem=2 * 128 * int(n) * int(r) + 1024 * 1024, dklen=len(digest))
+    except ValueError:
+        print("ERROR: malformed password hash")
+        return False
+    return hmac.compare_digest(computed, digest)
+
+
+class RecentCache:
+    """
+    Thread-safe map whose entries expire 'ttl' seconds after they were put,
+    dropping the oldest beyond 'capacity' entries.
+    """
+    def __init__(self, capacity, ttl):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.entries.get(key)
+            if item is None:
+                return None
+            value, expires = item
+            if time.monotonic() >= expires:
+                del self.entries[key]
+                return None
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def increment(self, key):
+        """
+        Add one to a counter; it expires 'ttl' seconds after it started.
+        """
+        with self.lock:
+            item = self.entries.get(key)
+            if item is not None and time.monotonic() < item[1]:
+                self.entries[key] = (item[0] + 1, item[1])
+                return
+        self.put(key, 1)
+
+    def pop(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+
+class UserDirectory:
+    def __init__(self, path=USERINFO_FILE, domain=DEFAULT_DOMAIN, poll_interval=POLL_INTERVAL,
+                 verified_ttl=VERIFIED_TTL, failure_limit=FAILURE_LIMIT, failure_window=FAILURE_WINDOW):
+        self.path = path
+        self.domain = domain
+        self.poll_interval = poll_interval
+        self.snapshot = Snapshot({}, {})
+        self._signature = None
+        self._next_check = 0.0
+        self._reload_lock = threading.Lock()
+        # (name, keyed password digest) -> the credential it was verified against
+        self._verified = RecentCache(VERIFIED_ENTRIES, verified_ttl)
+        self._digest_key = secrets.token_bytes(32)
+        # (name, client address) -> failed logins since the first of them
+        self._failures = RecentCache(FAILURE_ENTRIES, failure_window)
+        self.failure_limit = failure_limit
+        # Checked for unknown users, so they take as long as known ones
+        self._dummy = hash_password(secrets.token_urlsafe())
+
+    def _current(self):
+        """
+        Return the current snapshot, reloading the file first when it changed.
+        Until the file was read once, callers wait for the first load rather
+        than see an empty directory; later reloads never make them wait.
+        """
+        now = time.monotonic()
+        if self._signature is None:
+            with self._reload_lock:
+                if self._signature is None:
+                    self._next_check = now + self.poll_interval
+                    self.reload_if_changed()
+        elif now >= self._next_check and self._reload_lock.acquire(blocking=False):
+            try:
+                self._next_check = now + self.poll_interval
+                self.reload_if_changed()
+            finally:
+                self._reload_lock.release()
+        return self.snapshot
+
+    def reload_if_changed(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            if self._signature != "missing":
+                print(f"ERROR: {self.path} not found.")
+                self._signature = "missing"
+                self.snapshot = Snapshot({}, {})
+            return
+        signature = (st.st_mtime_ns, st.st_size, st.st_ino)
+        if signature == self._signature:
+            return
+        try:
+            snapshot = load_users(self.path, self.domain)
+        except OSError as e:
+            print(f"ERROR: could not read {self.path}: {e}")
+            return
+        if self._signature is not None:
+            print(f"Reloaded {len(snapshot.by_name)} users from {self.path}")
+        self.snapshot = snapshot
+        self._signature = signature
+
+    def __len__(self):
+        return len(self._current().by_name)
+
+    def by_name(self, name):
+        return self._current().by_name.get(name)
+
+    def by_address(self, address):
+        return self._current().by_address.get(address.lower())
+
+    def lookup(self, key):
+        """
+        Find a user by username or by any of their addresses.
+        """
+        snapshot = self._current()
+        return snapshot.by_name.get(key) or snapshot.by_address.get(key.lower())
+
+    def throttled(self, name, address=None):
+        """
+        True while 'name' is refused to client 'address' for too many
+        failed logins from there.
+        """
+        return (self._failures.get((name, address)) or 0) >= self.failure_limit
+
+    def authenticate(self, name, password, address=None):
+        """
+        Check a login from client 'address', skipping the hash when the same
+        password was verified against the same credential within the TTL: a
+        changed password in the reloaded file misses the cache.
+        """
+        if self.throttled(name, address):
+            return False
+        user = self.by_name(name)
+        key = (name, hmac.new(self._digest_key, password.encode(), hashlib.sha256).digest())
+        if user is None:
+            verify_password(self._dummy, password)
+        else:
+            if self._verified.get(key) == user.password:
+                return True
+            if verify_password(user.password, password):
+                self._verified.put(key, user.password)
+                self._failures.pop((name, address))
+                return True
+        self._failures.increment((name, address))
+        return False
+
+
+def hash_file(path):
+    """
+    Replace the plaintext passwords of a user file by their hashes.
+    Returns the number of passwords hashed.
+    """
+    hashed = 0
+    lines = []
+    with open(path, "r") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 2 and not parts[0].startswith("#") and not is_hashed(parts[1]):
+                parts[1] = hash_password(parts[1])
+                line = " ".join(parts) + "\n"
+                hashed += 1
+            lines.append(line)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.writelines(lines)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return hashed
+
+def main():
+    parser = argparse.ArgumentParser(description="Hash the plaintext passwords of a user file in place")
+    parser.add_argument('--userinfo', default=USERINFO_FILE, help='File listing the accounts and passwords')
+    args = parser.parse_args()
+    print(f"Hashed {hash_file(args.userinfo)} passwords in {args.userinfo}")
+
+if __name__ == '__main__':
+    main()